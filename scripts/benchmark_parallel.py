@@ -0,0 +1,73 @@
+"""
+This script measures how batch evaluation scales with the number of workers.
+
+It evaluates the same batch of expressions serially and with an
+EvaluationPool of an increasing number of worker processes, and prints the
+time and speedup of each.
+
+"""
+
+import os
+import sys
+import time
+import random
+import multiprocessing
+
+####################
+# START OF OPTIONS #
+####################
+
+# number of expressions to evaluate
+expression_count = 100000
+
+# number of expressions sent to a worker at once
+chunk_size = 1000
+
+##################
+# END OF OPTIONS #
+##################
+
+# use the ucal in this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ucal
+from ucal.ucal_parallel import EvaluationPool
+
+
+def create_expressions(count):
+    """Return a list of random unit conversions."""
+    units = ['ft', 'in', 'm', 'mi', 'km', 'yd', 'mm']
+    generator = random.Random(0)
+    return ['%d %s + %d %s in %s' % (generator.randint(1, 1000),
+                                     generator.choice(units),
+                                     generator.randint(1, 1000),
+                                     generator.choice(units),
+                                     generator.choice(units))
+            for _ in range(count)]
+
+
+def main():
+    expressions = create_expressions(expression_count)
+    start = time.perf_counter()
+    expected = [x.text for x in ucal.evaluate_many(expressions)]
+    serial_time = time.perf_counter() - start
+    print('%d expressions on %d CPUs'
+          % (expression_count, multiprocessing.cpu_count()))
+    print('serial:    %7.2f s' % serial_time)
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        with EvaluationPool(workers) as pool:
+            # start the workers before timing
+            list(pool.evaluate_many(expressions[:workers]))
+            start = time.perf_counter()
+            results = pool.evaluate_many(expressions, chunk_size=chunk_size)
+            results = [x.text for x in results]
+            elapsed = time.perf_counter() - start
+        assert results == expected
+        print('%2d workers: %7.2f s (%.2fx)'
+              % (workers, elapsed, serial_time / elapsed))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
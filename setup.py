@@ -15,6 +15,9 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     package_data={'ucal_gui': ['*.ico', 'BaseCalculatorWindow.py']},
     install_requires=['pyperclip', 'wxPython'],
+    extras_require={'numpy': ['numpy'],
+                    'toml': ['tomli; python_version < "3.11"']},
+    entry_points={'console_scripts': ['ucal-client=ucal.client:main']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
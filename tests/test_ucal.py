@@ -3,10 +3,24 @@ Perform unit tests on ucal.py.
 
 """
 
+import decimal
+import http.client
+import itertools
+import json
 import os
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # add parent directory to path to ensure we test the correct ucal
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
@@ -166,6 +180,38 @@ class TestSyntax(unittest.TestCase):
         """Test fallback conversion if target units are invalid."""
         self.assertEqual(ucal.interpret('1 in kg'), '0.0254 kg m')
 
+    def test_output_prefixes(self):
+        """Test results are written with a prefix giving 1 to 1000."""
+        self.assertEqual(ucal.evaluate('0.000003 s'), '3 us')
+        self.assertEqual(ucal.evaluate('2.4e9 / s'), '2.4 GHz')
+        self.assertEqual(ucal.evaluate('12000 N'), '12 kN')
+        self.assertEqual(ucal.evaluate('500 kbps'), '500 kbps')
+        self.assertEqual(ucal.evaluate('2 A hr'), '7200 C')
+        self.assertEqual(ucal.evaluate('5e-10 m'), '500 pm')
+        self.assertEqual(ucal.evaluate('0.001 N'), '1 mN')
+        self.assertEqual(ucal.evaluate('0.0005 N'), '500 uN')
+        self.assertEqual(ucal.evaluate('999e-6 W'), '999 uW')
+        self.assertEqual(ucal.evaluate('1e-12 H'), '1 pH')
+        self.assertEqual(ucal.evaluate('1e6 m'), '1 Mm')
+        self.assertEqual(ucal.evaluate('999999 m'), '999.999 km')
+
+    def test_list_units(self):
+        """Test listing the units of a dimension by magnitude."""
+        self.assertEqual(ucal.list_units('Hz'),
+                         ['Hz', 'kHz', 'MHz', 'GHz'])
+        self.assertEqual(ucal.list_units('kHz'), ucal.list_units('1/s'))
+        self.assertIn('mph', ucal.list_units('m/s'))
+
+    def test_target_clause(self):
+        """Test conversion clauses which are ambiguous with units."""
+        self.assertEqual(ucal.interpret('1 ft in in'), '12 in')
+        self.assertEqual(ucal.interpret('3 in + 2 in'), '127 mm')
+        self.assertEqual(ucal.interpret('1 m^2 + 1 in m'), '1.0254 m^2')
+        self.assertEqual(ucal.interpret('3! in hex'), '0x6')
+        self.assertEqual(ucal.interpret('50% to hex'),
+                         'only integers can be written as hex')
+        self.assertRaises(ucal.ParserError, ucal.interpret, '1 m to')
+
     def test_factorial(self):
         """Test the factorial postfix operator."""
         self.assertEqual(ucal.evaluate('0!'), '1')
@@ -173,6 +219,12 @@ class TestSyntax(unittest.TestCase):
         self.assertEqual(ucal.evaluate('2!'), '2')
         self.assertEqual(ucal.evaluate('5!'), '120')
         self.assertEqual(ucal.evaluate('18!'), '6402373705728000')
+        self.assertEqual(ucal.evaluate('3001! / 3000!'), '3001')
+        self.assertEqual(ucal.evaluate('1000000!'),
+                         '8.26393168833124e5565708')
+        x = ucal.ucal.calculate('5')
+        self.assertEqual(str(x.factorial()), '120')
+        self.assertEqual(str(x), '5')
 
     def test_factorial_error(self):
         """Test invalid uses of the factorial postfix operator."""
@@ -223,6 +275,26 @@ class TestSyntax(unittest.TestCase):
         """Test order of power/factorial evaluations."""
         self.assertEqual(ucal.evaluate('3^2!'), '9')
 
+    def test_evaluation_order_3(self):
+        """Test order of prefix/power/factorial evaluations."""
+        self.assertEqual(ucal.evaluate('2!^3'), '8')
+        self.assertEqual(ucal.evaluate('-(2)^2'), '-4')
+        self.assertEqual(ucal.evaluate('2^-(1)'), '0.5')
+        self.assertEqual(ucal.evaluate('-(3)!'), '-6')
+        self.assertEqual(ucal.evaluate('2*3^2+1'), '19')
+        self.assertEqual(ucal.evaluate('8/2/2'), '2')
+
+    def test_deep_nesting(self):
+        """Test deeply nested expressions do not exhaust the stack."""
+        depth = 5000
+        self.assertEqual(ucal.evaluate('(' * depth + '1' + ')' * depth), '1')
+        equation = '1' + '+(1' * depth + ')' * depth
+        self.assertEqual(ucal.evaluate(equation), str(depth + 1))
+        equation = 'x' + '*(1+x' * depth + ')' * depth
+        expression = ucal.compile(equation)
+        result = expression.evaluate(x=ucal.ucal.calculate('1'))
+        self.assertEqual(ucal.ucal.to_string(result), str(depth + 1))
+
     def test_unrecognized_function(self):
         """Test for an unrecognized function function."""
         self.assertRaises(ucal.ParserError,
@@ -264,6 +336,36 @@ class TestSyntax(unittest.TestCase):
         self.assertEqual(ucal.evaluate('log10(100)'), '2')
         self.assertRaises(ucal.QuantityError, ucal.evaluate, 'log10(1m)')
 
+    def test_function_trig(self):
+        """Test trigonometric functions."""
+        self.assertEqual(ucal.evaluate('sin(0)'), '0')
+        self.assertEqual(ucal.evaluate('sin(30 deg)'), '0.5')
+        self.assertEqual(ucal.evaluate('cos(-3)'), '-0.9899924966004455')
+        self.assertEqual(ucal.evaluate('tan(45 deg)'), '1')
+        self.assertEqual(ucal.evaluate('sin(1e20)'), '-0.6452512852657808')
+        self.assertEqual(ucal.interpret('asin(0.5) in deg'), '30 deg')
+        self.assertEqual(ucal.evaluate('acos(-1) / pi'), '1')
+        self.assertEqual(ucal.interpret('atan(-1) in deg'), '-45 deg')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'asin(2)')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'atan(1m)')
+        session = ucal.Session(working_precision_digits=60,
+                               output_precision_digits=50)
+        pi = '3.1415926535897932384626433832795028841971693993751'
+        self.assertEqual(session.interpret('atan(1) * 4'), pi)
+        sin_1 = '0.84147098480789650665250232163029899962256306079837'
+        self.assertEqual(session.interpret('sin(1)'), sin_1)
+
+    def test_function_gamma(self):
+        """Test gamma and lgamma functions."""
+        self.assertEqual(ucal.evaluate('gamma(5)'), '24')
+        self.assertEqual(ucal.evaluate('gamma(0.5)^2 / pi'), '1')
+        self.assertEqual(ucal.evaluate('gamma(-0.5)'), '-3.544907701811032')
+        self.assertEqual(ucal.evaluate('lgamma(1)'), '0')
+        self.assertEqual(ucal.evaluate('lgamma(1e6)'), '12815504.56914761')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'gamma(0)')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'lgamma(-2)')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'gamma(1m)')
+
     def test_mod(self):
         """Test __mod__ function."""
         self.assertEqual(ucal.evaluate('1 % 7'), '1')
@@ -292,5 +394,828 @@ class TestSyntax(unittest.TestCase):
         self.assertRaises(ucal.ParserError, ucal.evaluate, '1ft', units='s')
 
 
+    def test_tokens(self):
+        """Test the tokens found for an equation."""
+        ucal_module = ucal.ucal
+
+        def tokens(equation):
+            return [ucal_module.token_text(x)
+                    for x in ucal_module.tokenize(equation)]
+
+        self.assertEqual(tokens('-0x1F + 0b101'), ['-31', '+', '5'])
+        self.assertEqual(tokens('2*-0b11'), ['2', '*', '-3'])
+        self.assertEqual(ucal.interpret('-0x1F - 1'), '-32')
+        self.assertEqual(tokens('(2)(3) ft m'),
+                         ['(', '2', ')', '*', '(', '3', ')', '*', 'ft',
+                          '*', 'm'])
+        self.assertEqual(tokens('50%'), ['50', '*', '0.01'])
+        # conversion clauses outside of parentheses are found as the
+        # equation is scanned
+        tokens_found, conversions, _ = ucal_module.scan_tokens('1 m to ft')
+        self.assertEqual(len(tokens_found), 7)
+        self.assertEqual(conversions, [(3, 6, 4, 7, False)])
+        _, conversions, _ = ucal_module.scan_tokens('3 ft in in')
+        self.assertEqual(conversions, [(3, 6, 5, 8, False)])
+        _, conversions, _ = ucal_module.scan_tokens('(1 m to ft)')
+        self.assertEqual(conversions, [])
+        try:
+            ucal.interpret('1 +')
+        except ucal.ParserError as error:
+            self.assertEqual(error.args,
+                             ('Invalid ending token "+"', ['infix_op', '+']))
+        else:
+            self.fail('no ParserError raised')
+
+
+class TestQuantity(unittest.TestCase):
+    """Test the Quantity class."""
+
+    def test_immutable(self):
+        """Test quantities cannot be changed."""
+        value = ucal.ucal.calculate('2 m')
+        with self.assertRaises(AttributeError):
+            value.value = 3
+        with self.assertRaises(AttributeError):
+            value.other = 3
+        self.assertEqual(ucal.ucal.to_string(-value), '-2 m')
+        self.assertEqual(ucal.ucal.to_string(value), '2 m')
+
+    def test_hash(self):
+        """Test quantities may be used as keys."""
+        calculate = ucal.ucal.calculate
+        values = {calculate('2 m'), calculate('200 cm'), calculate('2 s')}
+        self.assertEqual(len(values), 2)
+        self.assertEqual(hash(calculate('2')), hash(2))
+
+    def test_dimension(self):
+        """Test dimensions are interned and exact."""
+        calculate = ucal.ucal.calculate
+        self.assertIs(calculate('N').units, calculate('kg m / s^2').units)
+        self.assertIs(calculate('(m^(1/3))^3').units, calculate('m').units)
+        self.assertEqual(ucal.interpret('sqrt(sqrt(m^2)) * m'), '1 m^1.5')
+        self.assertEqual(ucal.interpret('m^(1/3)'), '1 m^(1/3)')
+        self.assertEqual(ucal.interpret('sqrt(m)^2'), '1 m')
+        self.assertEqual(ucal.interpret('m^(pi/180)'),
+                         '1 m^0.017453292519943295')
+
+    def test_dimension_memory(self):
+        """Test dimensions are not kept after they are used."""
+        import gc
+        interned = ucal.ucal.Dimension.interned
+        count = len(interned)
+        for i in range(1000):
+            ucal.interpret('2 m^(%d.123)' % i)
+        gc.collect()
+        # only those held by the memo of m remain
+        self.assertLessEqual(len(interned),
+                             count + ucal.ucal.Dimension.memo_size)
+
+
+class TestUnitCache(unittest.TestCase):
+    """Test the cache of resolved unit definitions."""
+
+    def test_round_trip(self):
+        """Test units read from the cache match those written."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'units.json')
+            ucal.ucal.save_unit_cache(path)
+            before = dict(ucal.unit_def)
+            self.assertTrue(ucal.ucal.load_unit_cache(path))
+            for name, value in before.items():
+                self.assertEqual(ucal.unit_def[name], value)
+                self.assertIs(ucal.unit_def[name].units, value.units)
+        self.assertEqual(ucal.interpret('1 mi in ft'), '5280 ft')
+
+    def test_stale_files(self):
+        """Test unused cache files for other unit definitions are removed."""
+        with tempfile.TemporaryDirectory() as directory:
+            names = ['units-0123abcd.json', 'notes.json',
+                     'units-456789ab.json', 'units-89abcdef.json']
+            for name in names:
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write('{}')
+            old = time.time() - ucal.ucal.unit_cache_max_age - 60
+            for name in names[:2]:
+                os.utime(os.path.join(directory, name), (old, old))
+            ucal.ucal.save_unit_cache(os.path.join(directory, names[3]))
+            self.assertEqual(sorted(os.listdir(directory)), names[1:])
+            self.assertTrue(ucal.ucal.load_unit_cache(
+                os.path.join(directory, names[3])))
+
+    def test_unwritable_directory(self):
+        """Test nothing is written to a directory which is not writable."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'file', 'units-01234567.json')
+            with open(os.path.join(directory, 'file'), 'w') as f:
+                f.write('')
+            ucal.ucal.save_unit_cache(path)
+            self.assertEqual(os.listdir(directory), ['file'])
+
+    def test_invalid_file(self):
+        """Test an unreadable cache file is ignored."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'units.json')
+            self.assertFalse(ucal.ucal.load_unit_cache(path))
+            with open(path, 'w') as f:
+                f.write('{"units": {"m": [null, "x"]}')
+            self.assertFalse(ucal.ucal.load_unit_cache(path))
+
+
+class TestUnitDefinitions(unittest.TestCase):
+    """Test units defined from other units."""
+
+    def tearDown(self):
+        for name in list(ucal.unit_def):
+            if name.startswith('tst'):
+                del ucal.unit_def[name]
+
+    def test_lazy_resolution(self):
+        """Test units are resolved when first used."""
+        ucal.ucal.define_units({'tstb': '2 tsta', 'tsta': '3 ft'})
+        self.assertIn('tstb', ucal.unit_def.pending)
+        self.assertIn('tstb', ucal.unit_def)
+        self.assertEqual(ucal.interpret('tstb in ft'), '6 ft')
+        self.assertNotIn('tsta', ucal.unit_def.pending)
+        self.assertNotIn('tstb', ucal.unit_def.pending)
+
+    def test_concurrent_resolution(self):
+        """Test units being resolved are never missing to other threads."""
+        names = ['tst%d' % i for i in range(2000)]
+        ucal.ucal.define_units(dict((x, '2 ft') for x in names))
+        missing = []
+
+        def check():
+            for name in names:
+                if name not in ucal.unit_def:
+                    missing.append(name)
+
+        thread = threading.Thread(target=check)
+        thread.start()
+        for name in names:
+            ucal.unit_def[name]
+        thread.join()
+        self.assertEqual(missing, [])
+
+    def test_long_chain(self):
+        """Test resolving a long chain of units does not recurse."""
+        definitions = dict(('tst%d' % (i + 1), '1 tst%d' % i)
+                           for i in range(5000))
+        definitions['tst0'] = '1 m'
+        ucal.ucal.define_units(definitions)
+        self.assertEqual(ucal.evaluate('tst5000'), '1 m')
+
+    def test_cycle(self):
+        """Test definitions which form a cycle are reported."""
+        with self.assertRaises(ValueError) as context:
+            ucal.ucal.define_units({'tstx': '2 tsty',
+                                    'tsty': 'm / tstz',
+                                    'tstz': 'tstx^2'})
+        self.assertIn('tstx -> tsty -> tstz -> tstx',
+                      str(context.exception))
+        self.assertNotIn('tstx', ucal.unit_def)
+        with self.assertRaises(ValueError):
+            ucal.ucal.define_units({'tstx': '2 tstundefined'})
+
+    def test_resolution_context(self):
+        """Test units are resolved at the working precision."""
+        ucal.ucal.define_units({'tstsixth': '1 / 7 m'})
+        # writing a charge builds the index of units by dimension, which
+        # resolves pending units within the output precision
+        self.assertEqual(ucal.interpret('2 A hr'), '7200 C')
+        self.assertNotIn('tstsixth', ucal.unit_def.pending)
+        session = ucal.Session(output_precision_digits=25)
+        self.assertEqual(session.interpret('7 tstsixth in m'), '1 m')
+
+    def test_prefixes(self):
+        """Test units written with a prefix are defined when first used."""
+        self.assertNotIn('dam', ucal.unit_def)
+        self.assertEqual(ucal.interpret('3 dam in m'), '30 m')
+        self.assertIn('dam', ucal.unit_def)
+        self.assertEqual(ucal.interpret('3 Mm in km'), '3000 km')
+        # prefixes which have been used are not listed
+        self.assertEqual(ucal.interpret('2 THz'), '2 THz')
+        self.assertEqual(ucal.list_units('Hz'),
+                         ['Hz', 'kHz', 'MHz', 'GHz'])
+        self.assertEqual(ucal.interpret('2 ks in s'), '2000 s')
+        self.assertEqual(ucal.interpret('1 TPa in GPa'), '1000 GPa')
+        self.assertEqual(ucal.interpret('1 KiB in B'), '1024 B')
+        self.assertEqual(ucal.interpret('1 kibibyte in byte'), '1024 byte')
+        self.assertEqual(ucal.interpret('1 Mibit in kbit'), '1048.576 kbit')
+        self.assertEqual(ucal.interpret('1 kilobit in bit'), '1000 bit')
+        self.assertRaises(ucal.ParserError, ucal.interpret, '1 Kim')
+        # "as" is a conversion word rather than attoseconds
+        self.assertRaises(ucal.ParserError, ucal.interpret, '1 m as')
+        self.assertEqual(ucal.ucal.split_prefixed_unit('as'), [])
+        ucal.ucal.define_units({'tstkph': '2 Mm / hr'})
+        self.assertEqual(ucal.interpret('tstkph in kph'), '2000 kph')
+
+    def test_ambiguous_prefix(self):
+        """Test names with more than one prefixed reading are reported."""
+        stems = ucal.ucal.ucal_units.si_prefixed_units
+        stems.append('tstaB')
+        try:
+            ucal.ucal.define_units({'tstaB': '2 B'})
+            # "datstaB" could be deca-tstaB or deci-atstaB
+            stems.append('atstaB')
+            ucal.ucal.define_units({'atstaB': '3 B'})
+            self.assertEqual(ucal.ucal.split_prefixed_unit('ktstaB'),
+                             ['1e3 tstaB'])
+            with self.assertRaises(ucal.ParserError) as context:
+                ucal.ucal.calculate('datstaB')
+            self.assertIn('ambiguous', str(context.exception))
+            self.assertNotIn('datstaB', ucal.unit_def)
+        finally:
+            stems.remove('tstaB')
+            stems.remove('atstaB')
+            del ucal.unit_def['atstaB']
+
+
+class TestRegistry(unittest.TestCase):
+    """Test defining units at runtime."""
+
+    def tearDown(self):
+        for name in list(ucal.unit_def):
+            if name.startswith('tst'):
+                del ucal.unit_def[name]
+
+    def test_define(self):
+        """Test defining a unit and the checks made."""
+        ucal.define('tstfurlong', '220 yd')
+        self.assertEqual(ucal.interpret('1 tstfurlong in m'), '201.168 m')
+        self.assertRaises(ValueError, ucal.define, 'tst x', '1 m')
+        self.assertRaises(ValueError, ucal.define, 'kg', '1000 gm')
+        self.assertRaises(ValueError, ucal.define, 'tsty', '2 tstundefined')
+        self.assertNotIn('tsty', ucal.unit_def)
+
+    def test_redefine(self):
+        """Test units which use a redefined unit are resolved again."""
+        ucal.define('tsta', '3 ft')
+        ucal.define('tstb', '2 tsta')
+        ucal.define('tstc', '2 tstb')
+        self.assertEqual(ucal.interpret('tstc in ft'), '12 ft')
+        ucal.define('tsta', '1 m')
+        self.assertIn('tstc', ucal.unit_def.pending)
+        self.assertNotIn('ft', ucal.unit_def.pending)
+        self.assertEqual(ucal.interpret('tstc in ft'),
+                         '13.12335958005249 ft')
+        with self.assertRaises(ValueError):
+            ucal.define('tsta', '1 tstc')
+        self.assertEqual(ucal.interpret('tstc in m'), '4 m')
+
+    def test_cached_equations(self):
+        """Test cached equations see units defined after they are parsed."""
+        self.assertRaises(ucal.ParserError, ucal.interpret, '2 tstnew')
+        ucal.define('tstnew', '3 m')
+        self.assertEqual(ucal.interpret('2 tstnew'), '6 m')
+        length = ucal.ucal.calculate('1 m').units
+        units = ucal.ucal.get_output_units(length)
+        ucal.define('tstother', '2 s')
+        self.assertIs(ucal.ucal.get_output_units(length), units)
+
+    def test_load_pack(self):
+        """Test loading units from JSON and TOML unit packs."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pack.json')
+            with open(path, 'w') as f:
+                json.dump({'units': {'tstchain': '22 yd',
+                                     'tstpole': '1 / 4 tstchain'}}, f)
+            self.assertEqual(sorted(ucal.load_pack(path)),
+                             ['tstchain', 'tstpole'])
+            self.assertEqual(ucal.interpret('1 tstpole in ft'),
+                             '16.5 ft')
+            path = os.path.join(directory, 'bad.json')
+            with open(path, 'w') as f:
+                json.dump({'units': {'tstgood': '1 m',
+                                     'tstbad': '1 tstundefined'}}, f)
+            self.assertRaises(ValueError, ucal.load_pack, path)
+            self.assertNotIn('tstgood', ucal.unit_def)
+            if ucal.ucal.tomllib is None:
+                return
+            path = os.path.join(directory, 'pack.toml')
+            with open(path, 'w') as f:
+                f.write('[units]\ntstleague = "3 mi"\n')
+            self.assertEqual(ucal.load_pack(path), ['tstleague'])
+            self.assertEqual(ucal.interpret('1 tstleague in mi'), '3 mi')
+
+
+class TestSession(unittest.TestCase):
+    """Test evaluation sessions."""
+
+    def test_variables(self):
+        """Test each session has its own Ans and variables."""
+        first = ucal.Session()
+        second = ucal.Session()
+        first.interpret('2 m')
+        second.interpret('3 s')
+        self.assertEqual(first.interpret('Ans * 2'), '4 m')
+        self.assertEqual(second.interpret('Ans * 2'), '6 s')
+        first.variables['r'] = first.calculate('3 ft')
+        self.assertEqual(first.interpret('2 r in ft'), '6 ft')
+        self.assertEqual(first.evaluate('r', units='in'), ('36', 'in'))
+        self.assertEqual(first.evaluate('x in hex', x=255), ('0xFF', 'hex'))
+        self.assertEqual(first.evaluate('x + 1', units='bin', x=4),
+                         ('0b101', 'bin'))
+        with self.assertRaises(ucal.ParserError):
+            second.calculate('2 r')
+
+    def test_precision(self):
+        """Test sessions do not change the decimal context."""
+        precision = decimal.getcontext().prec
+        session = ucal.Session(output_precision_digits=6)
+        self.assertEqual(session.interpret('2 pi'), '6.28319')
+        self.assertEqual(ucal.interpret('2 pi'), '6.283185307179586')
+        self.assertEqual(decimal.getcontext().prec, precision)
+
+    def test_threads(self):
+        """Test sessions may be used from several threads at once."""
+        equations = ['%d ft + %d in in in' % (i, i) for i in range(1, 200)]
+        expected = [ucal.interpret(x) for x in equations]
+        results = dict()
+
+        def run(index):
+            session = ucal.Session(output_precision_digits=10 + index)
+            results[index] = [session.interpret(x) for x in equations]
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for index in range(8):
+            self.assertEqual(results[index], expected)
+
+
+class TestEvaluateMany(unittest.TestCase):
+    """Test batch evaluation."""
+
+    def test_results(self):
+        """Test results and errors are returned as records."""
+        results = list(ucal.evaluate_many(['1 ft in in', '1 ft + 1 s',
+                                           '1/0', 'x', '255 in hex']))
+        self.assertEqual([x.text for x in results],
+                         ['12 in', None, None, None, '0xFF'])
+        self.assertEqual([x.error for x in results],
+                         [None, 'QuantityError', 'DivisionByZero',
+                          'ParserError', None])
+        self.assertEqual(results[0].units, 'in')
+        self.assertIs(results[0].dimension, ucal.ucal.calculate('m').units)
+        self.assertEqual(results[3].message, 'Variable "x" is undefined.')
+
+    def test_units(self):
+        """Test results may be converted to the given units."""
+        results = ucal.evaluate_many(['1 ft', '2 s'], units='in')
+        self.assertEqual([(x.text, x.error) for x in results],
+                         [('12 in', None), (None, 'QuantityError')])
+
+    def test_streaming(self):
+        """Test expressions are read only as results are used."""
+        expressions = ('%d mi in ft' % (i % 3) for i in itertools.count())
+        results = ucal.evaluate_many(expressions)
+        first = [next(results) for _ in range(6)]
+        self.assertEqual(first[1].text, '5280 ft')
+        self.assertIs(first[4], first[1])
+
+    def test_workers(self):
+        """Test expressions may be evaluated by worker processes."""
+        expressions = ['%d ft in in' % i for i in range(1, 50)] + ['1 s + x']
+        expected = [x.text for x in ucal.evaluate_many(expressions)]
+        results = ucal.evaluate_many(expressions, workers=2, chunk_size=7)
+        self.assertEqual([x.text for x in results], expected)
+        results = ucal.evaluate_many(expressions, workers=2, chunk_size=7,
+                                     ordered=False)
+        self.assertEqual(sorted(map(str, [x.text for x in results])),
+                         sorted(map(str, expected)))
+
+    def test_profiling(self):
+        """Test each evaluation is profiled while profiling is in use."""
+        with ucal.profiling() as profiles:
+            ucal.interpret('((1 ft)) * 2 in kg')
+            list(ucal.evaluate_many(['1 s + 1 m']))
+        ucal.interpret('1 m')
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(list(profiles[0].stages),
+                         ['parse', 'convert', 'evaluate', 'format'])
+        self.assertEqual(profiles[0].depth, 2)
+        self.assertEqual(profiles[0].precision, 32)
+        self.assertEqual(profiles[0].total_ns,
+                         sum(profiles[0].stages.values()))
+        self.assertEqual(profiles[1].error, 'QuantityError')
+        self.assertEqual(list(profiles[1].stages), ['parse', 'error'])
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'server requires Python 3.7')
+class TestServer(unittest.TestCase):
+    """Test the evaluation server."""
+
+    def setUp(self):
+        import asyncio
+        from ucal import server
+        self.loop = asyncio.new_event_loop()
+        self.server = server.EvaluationServer(port=0, batch_size=8,
+                                              queue_size=4, workers=2)
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        import asyncio
+        asyncio.run_coroutine_threadsafe(self.server.stop(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_json_lines(self):
+        """Test responses are in the order of the requests."""
+        requests = ['"%d ft in in"' % i for i in range(1, 30)]
+        requests += ['{"id": 7, "expression": "1 mi", "units": "ft"}',
+                     '{"expression": "1 s + x"}', 'not json',
+                     '{"expression": "1 m", "units": ["m"]}']
+        with socket.create_connection(('127.0.0.1', self.server.port)) as s:
+            s.sendall(('\n'.join(requests) + '\n').encode('utf-8'))
+            s.shutdown(socket.SHUT_WR)
+            responses = [json.loads(x) for x in s.makefile('rb')]
+        self.assertEqual([x['text'] for x in responses[:29]],
+                         ['%d in' % (12 * i) for i in range(1, 30)])
+        self.assertEqual(responses[29]['id'], 7)
+        self.assertEqual(responses[29]['text'], '5280 ft')
+        self.assertGreater(responses[29]['latency_ms'], 0)
+        self.assertEqual(responses[30]['error'], 'ParserError')
+        self.assertEqual(responses[31]['error'], 'ValueError')
+        self.assertEqual(responses[32]['error'], 'ValueError')
+
+    def test_failed_group(self):
+        """Test a group which fails does not fail the rest of a batch."""
+        from ucal import server
+        settings = self.server.settings
+        results = server.evaluate_requests(
+            [('1 ft', 'in'), ('1 m', ['m']), ('2 ft', 'in')], settings)
+        self.assertEqual(results[0].text, '12 in')
+        self.assertIsNotNone(results[1].error)
+        self.assertEqual(results[2].text, '24 in')
+
+    def test_http(self):
+        """Test evaluating and reading statistics over HTTP."""
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        connection.request('POST', '/evaluate',
+                           json.dumps(['1 ft in in', {'expression': '2 m'}]))
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual([x['text'] for x in json.loads(response.read())],
+                         ['12 in', '2 m'])
+        connection.request('GET', '/stats')
+        stats = json.loads(connection.getresponse().read())
+        self.assertEqual(stats['requests'], 2)
+        connection.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 7) or os.name != 'posix',
+                 'client requires Unix domain sockets and Python 3.7')
+class TestClient(unittest.TestCase):
+    """Test the thin client and its background server."""
+
+    def test_client(self):
+        """Test a server is started, used and stopped when idle."""
+        from ucal import client
+        self.assertEqual(client.unescape_field(client.escape_field('\\t\t')),
+                         '\\t\t')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ucal.sock')
+            self.assertRaises(OSError, client.evaluate, '1 m', path=path,
+                              start=False)
+            self.assertEqual(client.evaluate('1 mi', 'ft', path=path,
+                                             idle_timeout=0.5),
+                             ('5280 ft', 'ft', None, None))
+            self.assertEqual(client.evaluate('1 s + 1 m', path=path)[2],
+                             'QuantityError')
+            for _ in range(100):
+                if not os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(path))
+
+
+    def test_replaced_socket(self):
+        """Test a server does not remove a socket it did not bind."""
+        import asyncio
+        from ucal import server
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ucal.sock')
+            evaluation_server = server.EvaluationServer(path=path)
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(evaluation_server.start())
+                # another server binding the same path replaces the file
+                with open(path + '.new', 'w') as f:
+                    f.write('')
+                os.replace(path + '.new', path)
+                loop.run_until_complete(evaluation_server.stop())
+            finally:
+                loop.close()
+            self.assertTrue(os.path.exists(path))
+
+
+class TestCommandLine(unittest.TestCase):
+    """Test evaluating expressions with "python -m ucal"."""
+
+    def run_ucal(self, arguments, text):
+        return subprocess.run([sys.executable, '-m', 'ucal'] + arguments,
+                              input=text.encode('utf-8'),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              cwd=test_dir)
+
+    def test_text(self):
+        """Test results are written one per line."""
+        process = self.run_ucal([], '1 ft in in\n\n1 ft + 1 s\n2 m\n')
+        self.assertEqual(process.stdout.decode().splitlines(),
+                         ['12 in', '', '2 m'])
+        self.assertIn(b'QuantityError', process.stderr)
+        self.assertEqual(process.returncode, 1)
+
+    def test_formats(self):
+        """Test TSV and JSON lines output with target units."""
+        process = self.run_ucal(['--to', 'in', '--format', 'tsv'],
+                                '1 ft\n1 s\n')
+        self.assertEqual(process.stdout.decode().splitlines(),
+                         ['1 ft\t12 in\tin\t\t',
+                          '1 s\t\t\tQuantityError\tInconsistent units'])
+        process = self.run_ucal(['--format', 'jsonl', '--jobs', '2'],
+                                '1 mi in ft\n')
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(json.loads(process.stdout.decode())['text'],
+                         '5280 ft')
+
+
+class TestTrace(unittest.TestCase):
+    """Test trace events."""
+
+    def tearDown(self):
+        ucal.set_trace_sink(None)
+
+    def test_ring_buffer(self):
+        """Test events are sent to a sink while one is set."""
+        from ucal import ucal_trace
+        sink = ucal_trace.RingBufferSink()
+        ucal.set_trace_sink(sink)
+        ucal.interpret('4 m')
+        ucal.ucal.define_units({'tracelength': '2 m'})
+        ucal.interpret('3 tracelength')
+        ucal.set_trace_sink(None)
+        ucal.interpret('5 m')
+        kinds = [x.kind for x in sink]
+        self.assertIn('implicit-multiply-inserted', kinds)
+        self.assertEqual(kinds.count('output-formatted'), 2)
+        tokens = [x.fields['text'] for x in sink
+                  if x.kind == 'token-emitted']
+        self.assertIn('3 * tracelength', ' '.join(tokens))
+        resolved = [x.fields for x in sink if x.kind == 'unit-resolved']
+        self.assertEqual(resolved, [{'unit': 'tracelength',
+                                     'definition': '2 m', 'value': '2 m'}])
+
+    def test_cached_tokens(self):
+        """Test tokens are traced on cache hits and before errors."""
+        from ucal import ucal_trace
+        sink = ucal_trace.RingBufferSink()
+        ucal.set_trace_sink(sink)
+        ucal.interpret('1 ft + 1 in')
+        traces = []
+        for _ in range(2):
+            sink.clear()
+            ucal.interpret('6 ft + 2 in')
+            traces.append([x.fields['text'] for x in sink
+                           if x.kind == 'token-emitted'])
+        self.assertEqual(traces[0], ['6', '*', 'ft', '+', '2', '*', 'in'])
+        self.assertEqual(traces[0], traces[1])
+        sink.clear()
+        self.assertRaises(ucal.ParserError, ucal.interpret, '2 ft $')
+        self.assertEqual([x.fields['text'] for x in sink
+                          if x.kind == 'token-emitted'], ['2', '*', 'ft'])
+
+    def test_json_lines(self):
+        """Test events are written as JSON lines."""
+        from ucal import ucal_trace
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.jsonl')
+            sink = ucal_trace.JsonLinesSink(path)
+            ucal.set_trace_sink(sink)
+            ucal.interpret('17 ft + 2 in in mm')
+            ucal.set_trace_sink(None)
+            sink.close()
+            with open(path) as f:
+                events = [json.loads(x) for x in f]
+        self.assertEqual(events[-1]['event'], 'output-formatted')
+        self.assertEqual(events[-1]['units'], 'mm')
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test the benchmarks in ucal.bench."""
+
+    def test_run(self):
+        """Test a small run is timed and can be compared."""
+        from ucal import bench
+        results = bench.run_benchmarks(scale=0.01, repeat=1, startup=False)
+        results = json.loads(json.dumps(results))
+        self.assertEqual(sorted(results['stages']),
+                         sorted(bench.create_corpus()))
+        self.assertEqual(sorted(results['stages']['conversions']),
+                         ['evaluate', 'interpret', 'parse', 'to_string',
+                          'tokenize'])
+        self.assertGreater(results['memory']['bytes_per_quantity'], 0)
+        lines = bench.compare_results(results, results)
+        self.assertTrue(lines[1].endswith('1.00x'))
+
+
+class TestCompile(unittest.TestCase):
+    """Test compiled expressions."""
+
+    def test_compiled_constant(self):
+        """Test a compiled expression with no variables."""
+        expression = ucal.compile('5V * 500mA')
+        self.assertFalse(expression.instructions)
+        self.assertEqual(ucal.ucal.to_string(expression.evaluate()), '2.5 W')
+
+    def test_compiled_variables(self):
+        """Test binding variables of a compiled expression."""
+        expression = ucal.compile('x * kg * m / s^2 + 3^2! * N')
+        self.assertEqual(len(expression.instructions), 2)
+        result = expression.evaluate(x=ucal.ucal.calculate('2'))
+        self.assertEqual(ucal.ucal.to_string(result), '11 N')
+        result = expression.evaluate(x=ucal.ucal.calculate('4'))
+        self.assertEqual(ucal.ucal.to_string(result), '13 N')
+
+    def test_compiled_shared_subexpressions(self):
+        """Test repeated subexpressions are only evaluated once."""
+        expression = ucal.compile('sqrt(x) + sqrt(x)')
+        self.assertEqual(len(expression.instructions), 2)
+        result = expression.evaluate(x=ucal.ucal.calculate('4 m^2'))
+        self.assertEqual(ucal.ucal.to_string(result), '4 m')
+
+    def test_compiled_division(self):
+        """Test folding of constants around divided variables."""
+        expression = ucal.compile('3 / x * ft')
+        self.assertEqual(len(expression.instructions), 1)
+        result = expression.evaluate(x=ucal.ucal.calculate('4 ft'))
+        self.assertEqual(ucal.ucal.to_string(result), '0.75')
+
+    def test_compiled_undefined_variable(self):
+        """Test evaluating with a missing variable."""
+        expression = ucal.compile('2 x')
+        self.assertRaises(ucal.ParserError, expression.evaluate)
+
+
+class TestTokenCache(unittest.TestCase):
+    """Test the cache of parsed equations."""
+
+    def setUp(self):
+        ucal.token_cache.clear()
+
+    def test_cache_hits(self):
+        """Test repeated equations are served from the cache."""
+        self.assertEqual(ucal.interpret('1 psi in kPa'),
+                         '6.894757293168361 kPa')
+        misses = ucal.token_cache.misses
+        self.assertEqual(ucal.interpret('1  psi in kPa'),
+                         '6.894757293168361 kPa')
+        self.assertEqual(ucal.token_cache.misses, misses)
+        # the conversion clause is parsed with the equation
+        self.assertEqual(ucal.token_cache.hits, 1)
+        ucal.token_cache.clear()
+        self.assertEqual(len(ucal.token_cache), 0)
+        self.assertEqual(ucal.token_cache.hits, 0)
+
+    def test_cache_size(self):
+        """Test the cache does not grow beyond its maximum size."""
+        maxsize = ucal.token_cache.maxsize
+        try:
+            ucal.token_cache.maxsize = 2
+            for x in ['1', '2', '3', '1']:
+                ucal.evaluate(x)
+            self.assertEqual(len(ucal.token_cache), 2)
+            self.assertEqual(ucal.token_cache.hits, 0)
+        finally:
+            ucal.token_cache.maxsize = maxsize
+
+    def test_cache_invalidation(self):
+        """Test cached equations see changes to unit definitions."""
+        ucal.interpret('2')
+        self.assertEqual(ucal.interpret('Ans + 1'), '3')
+        self.assertEqual(ucal.interpret('Ans + 1'), '4')
+        ucal.unit_def['widget'] = ucal.ucal.calculate('2 m')
+        try:
+            self.assertEqual(ucal.evaluate('3 widget'), '6 m')
+            ucal.unit_def['widget'] = ucal.ucal.calculate('3 m')
+            self.assertEqual(ucal.evaluate('3 widget'), '9 m')
+        finally:
+            del ucal.unit_def['widget']
+        self.assertRaises(ucal.ParserError, ucal.evaluate, '3 widget')
+
+
+class TestBackends(unittest.TestCase):
+    """Test the numeric backends."""
+
+    def test_fraction(self):
+        """Test the fraction backend is exact."""
+        self.assertEqual(ucal.interpret('1/3*3-1', backend='fraction'), '0')
+        self.assertEqual(ucal.interpret('1 ft in in', backend='fraction'),
+                         '12 in')
+        self.assertEqual(ucal.interpret('sqrt(9/4)', backend='fraction'),
+                         '1.5')
+        self.assertEqual(ucal.interpret('sqrt(2)', backend='fraction'),
+                         '1.414213562373095')
+        self.assertEqual(ucal.interpret('3001!/3000!', backend='fraction'),
+                         '3001')
+        self.assertRaises(ucal.QuantityError, ucal.interpret, '(10^9)!',
+                          backend='fraction')
+        self.assertRaises(ucal.QuantityError, ucal.interpret, 'ln(0)',
+                          backend='fraction')
+
+    def test_float(self):
+        """Test the float backend."""
+        self.assertEqual(ucal.interpret('0.1+0.2', backend='float'), '0.3')
+        self.assertEqual(ucal.evaluate('5km + 1mi', backend='float'),
+                         '6.609344 km')
+        self.assertEqual(ucal.evaluate('x ft', units='in', backend='float',
+                                       x=2), ('24', 'in'))
+        for equation in ['sqrt(-1)', '1/0', '10^400', '5 % 0', '171!',
+                         '1e308*10', 'ln(0)']:
+            self.assertRaises(ucal.QuantityError, ucal.interpret, equation,
+                              backend='float')
+        compiled = ucal.compile('x / y', ['x', 'y'], backend='float')
+        self.assertRaises(ucal.QuantityError, compiled.evaluate,
+                          x=ucal.ucal.calculate('1', backend='float'),
+                          y=ucal.ucal.calculate('0', backend='float'))
+
+    def test_default_backend(self):
+        """Test the default backend may be changed."""
+        default = ucal.ucal.numeric_backend
+        try:
+            ucal.ucal.numeric_backend = 'fraction'
+            self.assertEqual(ucal.interpret('1/3*3-1'), '0')
+        finally:
+            ucal.ucal.numeric_backend = default
+
+    def test_invalid_backend(self):
+        """Test an unknown backend raises an error."""
+        with self.assertRaises(ValueError):
+            ucal.interpret('1', backend='binary')
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class TestQuantityArray(unittest.TestCase):
+    """Test vectorized evaluation with QuantityArray."""
+
+    def test_array_conversion(self):
+        """Test evaluating an array of values into target units."""
+        heights = ucal.QuantityArray([1.0, 10.0, 30.0], 'ft')
+        values, units = ucal.evaluate('sqrt(2 * g * h) in fps', h=heights)
+        self.assertEqual(units, 'fps')
+        self.assertEqual(values.shape, (3,))
+        self.assertAlmostEqual(values[2], 43.9368059078698)
+
+    def test_array_operators(self):
+        """Test operators and functions on arrays."""
+        result = ucal.evaluate('x^2 + 2 x + 1', x=[1, 2, 3])
+        self.assertEqual(list(result.value), [4.0, 9.0, 16.0])
+        result = ucal.evaluate('abs(-x) m - 1 m', x=numpy.array([1.0, 3.0]))
+        self.assertEqual(str(result[1]), '2 m')
+        # an unused array gives a result written as usual
+        self.assertEqual(ucal.evaluate('2 in', x=[1, 2]), '50.8 mm')
+        self.assertEqual(ucal.evaluate('2 in', units='mm', x=[1, 2]),
+                         ('50.8', 'mm'))
+        self.assertRaises(ucal.ParserError, ucal.evaluate, 'x in hex',
+                          x=[1])
+        result = ucal.evaluate('x!', x=[3, 4, 200])
+        self.assertEqual(list(result.value), [6.0, 24.0, float('inf')])
+        result = ucal.evaluate('gamma(x)', x=[0.5, 200])
+        self.assertAlmostEqual(result.value[0] ** 2, 3.141592653589793)
+        self.assertEqual(result.value[1], float('inf'))
+
+    def test_array_decimal(self):
+        """Test arrays holding Decimal values."""
+        lengths = ucal.QuantityArray([1, 4], 'm^2', dtype=object)
+        result = ucal.evaluate('sqrt(x)', x=lengths)
+        self.assertEqual(str(result[1]), '2 m')
+        angles = ucal.QuantityArray(
+            [decimal.Decimal(1), decimal.Decimal('0.5')], dtype=object)
+        # values keep the working precision
+        for function in ['sin', 'cos', 'tan', 'asin', 'acos', 'atan']:
+            result = ucal.evaluate('%s(x)' % function, x=angles)
+            self.assertEqual(result.value.dtype, object)
+            with ucal.ucal.default_session.working_context():
+                value = ucal.ucal.calculate('%s(1)' % function).value
+            self.assertEqual(result.value[0], value)
+        result = angles.function_atan2(angles)
+        self.assertEqual(result.value.dtype, object)
+
+    def test_array_units_error(self):
+        """Test units are checked for arrays."""
+        heights = ucal.QuantityArray([1.0, 2.0], 'm')
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'h + 1',
+                          h=heights)
+        self.assertRaises(ucal.QuantityError, ucal.evaluate, 'exp(h)',
+                          h=heights)
+
+
 if __name__ == '__main__':
     unittest.main()
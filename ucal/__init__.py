@@ -1 +1,52 @@
-from ucal.ucal import *
+"""
+The ucal package evaluates expressions with automatic unit conversions.
+
+The unit definitions are resolved when ucal.ucal is imported, which is
+deferred until one of the names below is first used.
+
+"""
+
+import importlib
+import sys
+
+# names provided by ucal.ucal
+__all__ = ['evaluate', 'ParserError', 'interpret', 'infix_operators',
+           'QuantityError', 'unit_def', 'compile', 'CompiledExpression',
+           'token_cache', 'Session', 'evaluate_many', 'EvaluationResult',
+           'list_units', 'profiling', 'EvaluationProfile', 'set_trace_sink',
+           'define', 'load_pack']
+
+
+def __getattr__(name):
+    """Import ucal.ucal, or ucal.ucal_array, when first needed."""
+    if name in __all__ or name == 'ucal':
+        module = importlib.import_module('ucal.ucal')
+        if name == 'ucal':
+            return module
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    # QuantityArray is only available if NumPy is installed
+    if name == 'QuantityArray':
+        try:
+            module = importlib.import_module('ucal.ucal_array')
+        except ImportError:
+            raise AttributeError('QuantityArray requires NumPy')
+        globals()[name] = module.QuantityArray
+        return module.QuantityArray
+    raise AttributeError("module 'ucal' has no attribute '%s'" % name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# module __getattr__ is only supported from Python 3.7
+if sys.version_info < (3, 7):
+    from ucal.ucal import *
+    try:
+        from ucal.ucal_array import QuantityArray
+    except ImportError:
+        pass
+    else:
+        __all__ += ['QuantityArray']
@@ -0,0 +1,107 @@
+"""
+This file evaluates expressions from the command line.
+
+Expressions are read one per line from the given files, or from stdin,
+and the result of each is written to stdout as it is evaluated.  Input is
+read as results are written, so inputs of any size use constant memory.
+
+Usage:
+> echo 5 km in mi | python -m ucal
+3.10685596118667 mi
+> python -m ucal --to ft --format tsv --jobs 4 lengths.txt
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from ucal import ucal
+from ucal.client import escape_field
+
+
+def read_expressions(paths):
+    """Yield each non-blank line of the given files, or of stdin."""
+    for path in paths or ['-']:
+        if path == '-':
+            lines = sys.stdin
+        else:
+            lines = open(path, encoding='utf-8')
+        with lines:
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def format_text(result):
+    """Return the result text, or an empty line for an error."""
+    return result.text or ''
+
+
+def format_tsv(result):
+    """Return the fields of the result separated by tabs."""
+    return '\t'.join(escape_field(x)
+                     for x in [result.expression, result.text, result.units,
+                               result.error, result.message])
+
+
+def format_jsonl(result):
+    """Return the fields of the result as a JSON object."""
+    return json.dumps({'expression': result.expression,
+                       'text': result.text,
+                       'units': result.units,
+                       'error': result.error,
+                       'message': result.message})
+
+
+formatters = {'text': format_text, 'tsv': format_tsv, 'jsonl': format_jsonl}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m ucal',
+        description='Evaluate expressions read one per line.')
+    parser.add_argument('files', nargs='*',
+                        help='files to read, or stdin if none or "-"')
+    parser.add_argument('--to', metavar='UNITS',
+                        help='convert all results to these units')
+    parser.add_argument('--format', choices=sorted(formatters),
+                        default='text', help='output format')
+    parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                        help='evaluate in N processes, in order')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='expressions sent to a process at once')
+    parser.add_argument('--line-buffered', action='store_true',
+                        help='flush output after each result')
+    args = parser.parse_args()
+    formatter = formatters[args.format]
+    results = ucal.evaluate_many(read_expressions(args.files), args.to,
+                                 workers=args.jobs,
+                                 chunk_size=args.chunk_size)
+    error_count = 0
+    try:
+        for result in results:
+            if result.error:
+                error_count += 1
+                # in text format, errors are reported on stderr
+                if args.format == 'text':
+                    print('%s: %s: %s' % (result.expression, result.error,
+                                          result.message), file=sys.stderr)
+            sys.stdout.write(formatter(result) + '\n')
+            if args.line_buffered:
+                sys.stdout.flush()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # output was closed early, such as by "head", so discard the rest
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    return 1 if error_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+The ucal.bench package measures the performance of each stage of ucal.
+
+A corpus of expressions is generated for each of the following categories,
+and each stage of the engine is timed over every category.
+
+* conversions: short unit conversions such as "37 ft in m"
+* long: generated sums of many terms with mixed units
+* nested: expressions with deeply nested parentheses
+* factorials: large factorials and the gamma function
+* transcendental: calls to sin, atan, exp, ln and the like
+
+The stages are tokenizing (scan_tokens), parsing with units bound
+(parse_equation, without the token cache), evaluating the tokens
+(evaluate_tokens), formatting the result (to_string) and the whole of
+interpret().  The time to start Python and import ucal, and memory use
+measured with tracemalloc, are also reported.
+
+Results are returned as a dict which is written as JSON, so that runs on
+different commits can be compared.
+
+Usage:
+> python -m ucal.bench --output before.json
+> python -m ucal.bench --compare before.json
+
+"""
+
+import decimal
+import gc
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from ucal import ucal
+
+# number of expressions in each generated category at a scale of 1
+corpus_sizes = {'conversions': 1000, 'long': 50, 'nested': 50,
+                'transcendental': 500}
+
+# units of the same dimension, which may be added and converted
+unit_groups = [['ft', 'in', 'm', 'mi', 'km', 'yd', 'mm'],
+               ['kg', 'lb', 'oz', 'ton'],
+               ['s', 'min', 'hr', 'day'],
+               ['N', 'lbf', 'kN']]
+
+# expressions with factorials and gamma, which are used at any scale
+factorial_expressions = ['100!', '1000!', '2000!', '5000!', '1000000!',
+                         '(10^9)!', 'gamma(123.5)', 'lgamma(1e6)']
+
+# functions of a unitless argument used in the transcendental category
+transcendental_functions = ['sin', 'cos', 'tan', 'atan', 'exp', 'ln',
+                            'sqrt', 'log10']
+
+# number of Quantity objects created to measure their size
+quantity_count = 10000
+
+# statements run in a new interpreter to measure the time to start
+startup_statements = [('python', 'pass'),
+                      ('import', 'import ucal'),
+                      ('first_interpret',
+                       'import ucal; ucal.interpret("1 ft in m")')]
+
+
+def create_corpus(scale=1.0, seed=0):
+    """Return a dict of the list of expressions in each category."""
+    generator = random.Random(seed)
+    sizes = dict((name, max(1, int(count * scale)))
+                 for name, count in corpus_sizes.items())
+    corpus = dict()
+    conversions = []
+    for _ in range(sizes['conversions']):
+        units = generator.choice(unit_groups)
+        conversions.append('%d %s in %s' % (generator.randint(1, 1000),
+                                            generator.choice(units),
+                                            generator.choice(units)))
+    corpus['conversions'] = conversions
+    long_expressions = []
+    for _ in range(sizes['long']):
+        units = generator.choice(unit_groups)
+        terms = ['%d.%d %s' % (generator.randint(1, 1000),
+                               generator.randint(0, 99),
+                               generator.choice(units))
+                 for _ in range(50)]
+        long_expressions.append(' + '.join(terms))
+    corpus['long'] = long_expressions
+    nested = []
+    for _ in range(sizes['nested']):
+        expression = '%d m' % generator.randint(1, 1000)
+        for _ in range(40):
+            expression = '(%s + %d ft) * %d / %d' % (
+                expression, generator.randint(1, 9),
+                generator.randint(1, 9), generator.randint(1, 9))
+        nested.append(expression)
+    corpus['nested'] = nested
+    corpus['factorials'] = list(factorial_expressions)
+    transcendental = []
+    for _ in range(sizes['transcendental']):
+        function = generator.choice(transcendental_functions)
+        transcendental.append('%s(%d.%d)' % (function,
+                                             generator.randint(1, 100),
+                                             generator.randint(0, 999)))
+    corpus['transcendental'] = transcendental
+    return corpus
+
+
+def time_calls(function, items, repeat):
+    """Return the fastest time in microseconds to call function(item)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / len(items)
+
+
+def find_tokens(equation, backend):
+    """
+    Return (tokens, target_units) of the expression which interpret() would
+    evaluate for the equation, which is that of a conversion clause if one
+    is used.
+
+    """
+    tokens, _, conversions, _ = ucal.parse_equation(equation, backend)
+    for left, _, target, dimension in conversions:
+        try:
+            result = ucal.evaluate_tokens(left)
+        except (ucal.QuantityError, ucal.ParserError):
+            continue
+        if dimension is None or result.units is dimension:
+            return left, target
+    return tokens, None
+
+
+def time_stages(expressions, repeat, session=None):
+    """Return the time per expression of each stage, in microseconds."""
+    session = session or ucal.default_session
+    backend = ucal.get_backend(session.backend)
+    texts = [ucal.TokenCache.normalize(x) for x in expressions]
+    stages = dict()
+    with session.working_context():
+        stages['tokenize'] = time_calls(
+            lambda x: ucal.scan_tokens(x, backend), texts, repeat)
+        # parse every time rather than taking entries from the cache
+        maxsize = ucal.token_cache.maxsize
+        ucal.token_cache.maxsize = 0
+        try:
+            ucal.token_cache.clear()
+            stages['parse'] = time_calls(
+                lambda x: ucal.parse_equation(x, backend), texts, repeat)
+        finally:
+            ucal.token_cache.maxsize = maxsize
+        parsed = [find_tokens(x, backend) for x in texts]
+        stages['evaluate'] = time_calls(
+            lambda x: ucal.evaluate_tokens(x[0]), parsed, repeat)
+        results = [(ucal.evaluate_tokens(x[0]), x[1]) for x in parsed]
+    stages['to_string'] = time_calls(
+        lambda x: session.format_result(*x), results, repeat)
+    stages['interpret'] = time_calls(
+        lambda x: session.interpret(x), expressions, repeat)
+    return stages
+
+
+def time_startup(repeat):
+    """Return the fastest time in seconds to run each startup statement."""
+    # run from the parent of this package so the same ucal is imported
+    directory = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    times = dict()
+    for name, statement in startup_statements:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', statement],
+                                  cwd=directory)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        times[name] = best
+    return times
+
+
+def measure_memory(corpus):
+    """
+    Return the memory used by a Quantity and by interpreting each category.
+
+    Bytes and allocations per Quantity include its Decimal value.  The
+    peak is the most memory allocated at once while interpreting the
+    expressions of a category.
+
+    """
+    memory = dict()
+    units = ucal.calculate('1 m/s').units
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        quantities = [ucal.Quantity(decimal.Decimal(i) / 7, units)
+                      for i in range(quantity_count)]
+        after = tracemalloc.take_snapshot()
+        differences = after.compare_to(before, 'filename')
+        memory['bytes_per_quantity'] = (
+            sum(x.size_diff for x in differences) / len(quantities))
+        memory['allocations_per_quantity'] = (
+            sum(x.count_diff for x in differences) / len(quantities))
+        del quantities
+        peaks = dict()
+        for name, expressions in sorted(corpus.items()):
+            gc.collect()
+            tracemalloc.clear_traces()
+            for expression in expressions:
+                ucal.interpret(expression)
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+        memory['interpret_peak_bytes'] = peaks
+    finally:
+        tracemalloc.stop()
+    return memory
+
+
+def run_benchmarks(scale=1.0, repeat=5, startup=True, memory=True):
+    """Run the benchmarks and return the results as a dict."""
+    corpus = create_corpus(scale)
+    results = dict()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['working_precision_digits'] = ucal.working_precision_digits
+    results['repeat'] = repeat
+    results['expressions'] = dict((name, len(expressions))
+                                  for name, expressions in corpus.items())
+    # time in microseconds per expression of each stage of each category
+    results['stages'] = dict((name, time_stages(expressions, repeat))
+                             for name, expressions in corpus.items())
+    if startup:
+        results['startup'] = time_startup(repeat)
+    if memory:
+        results['memory'] = measure_memory(corpus)
+    return results
+
+
+def compare_results(old, new):
+    """Return lines comparing the timings of two sets of results."""
+    # rows of (name, old time, new time, units)
+    rows = []
+    for category, stages in sorted(new['stages'].items()):
+        old_stages = old.get('stages', {}).get(category, {})
+        for stage, value in sorted(stages.items()):
+            rows.append(('%s.%s' % (category, stage), old_stages.get(stage),
+                         value, 'us'))
+    old_startup = old.get('startup', {})
+    for name, value in sorted(new.get('startup', {}).items()):
+        old_value = old_startup.get(name)
+        if old_value is not None:
+            old_value *= 1e3
+        rows.append(('startup.%s' % name, old_value, value * 1e3, 'ms'))
+    lines = ['%-32s %12s %12s %8s' % ('stage', 'old', 'new', 'ratio')]
+    for name, old_value, value, units in rows:
+        if not old_value:
+            lines.append('%-32s %12s %9.1f %s' % (name, '-', value, units))
+        else:
+            lines.append('%-32s %9.1f %s %9.1f %s %7.2fx'
+                         % (name, old_value, units, value, units,
+                            value / old_value))
+    return lines
@@ -0,0 +1,55 @@
+"""
+This file runs the ucal benchmarks from the command line.
+
+The results are written as JSON to stdout, or to the file given by
+--output.  With --compare, the timings are instead printed next to those
+of an earlier run.
+
+Usage:
+> python -m ucal.bench --output before.json
+> python -m ucal.bench --compare before.json
+
+"""
+
+import argparse
+import json
+import sys
+
+from ucal import bench
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m ucal.bench',
+        description='Time each stage of ucal over a corpus of expressions.')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the JSON results to this file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print timings next to those of an earlier run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='times each measurement is repeated')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='relative number of expressions generated')
+    parser.add_argument('--no-startup', action='store_true',
+                        help='do not time starting a new interpreter')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure memory use')
+    args = parser.parse_args()
+    results = bench.run_benchmarks(args.scale, args.repeat,
+                                   startup=not args.no_startup,
+                                   memory=not args.no_memory)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            old = json.load(f)
+        print('\n'.join(bench.compare_results(old, results)))
+    elif not args.output:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
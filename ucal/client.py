@@ -0,0 +1,179 @@
+"""
+This file evaluates an expression with a ucal server running in the
+background, which is started if needed.
+
+Starting Python and resolving units takes much longer than evaluating a
+typical expression, so shell scripts which call ucal many times should use
+this client.  The server listens on a Unix domain socket and stops itself
+after it has been idle for some time.  The client imports as little as
+possible so that it starts quickly.
+
+Usage:
+> python -m ucal.client 5 km in mi
+3.10685596118667 mi
+> python -m ucal.client --to ft 1 mi
+5280 ft
+
+Options:
+  --to UNITS            convert the result to these units
+  --socket PATH         path of the socket (default: $UCAL_SOCKET, or
+                        ucal-<uid>.sock in $XDG_RUNTIME_DIR or $TMPDIR)
+  --idle-timeout SECS   idle time before a started server stops (600)
+  --no-start            do not start a server if none is running
+
+"""
+
+import os
+import sys
+import time
+
+# the socket module imports much more than this
+import _socket
+
+# seconds to wait for a started server to listen
+start_timeout = 30.0
+
+
+def escape_field(text):
+    """Return the text with characters special to TSV escaped."""
+    if text is None:
+        return ''
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def unescape_field(text):
+    """Return the text of a field escaped by escape_field()."""
+    replacements = {'t': '\t', 'n': '\n', 'r': '\r'}
+    result = []
+    characters = iter(text)
+    for character in characters:
+        if character == '\\':
+            character = next(characters, '')
+            character = replacements.get(character, character)
+        result.append(character)
+    return ''.join(result)
+
+
+def get_socket_path():
+    """Return the default path of the server socket."""
+    path = os.environ.get('UCAL_SOCKET')
+    if path:
+        return path
+    directory = (os.environ.get('XDG_RUNTIME_DIR') or
+                 os.environ.get('TMPDIR') or '/tmp')
+    return os.path.join(directory, 'ucal-%d.sock' % os.getuid())
+
+
+def connect(path):
+    """Return a socket connected to the server at the given path."""
+    connection = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        raise
+    return connection
+
+
+def start_server(path, idle_timeout):
+    """Start a server in the background listening on the given path."""
+    import subprocess
+    # run from the parent of this package so the same ucal is used
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, '-m', 'ucal.server', '--unix', path,
+                      '--idle-timeout', str(idle_timeout),
+                      '--batch-delay', '0'],
+                     cwd=directory, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def connect_or_start(path, idle_timeout):
+    """Return a connection to the server, starting it if needed."""
+    try:
+        return connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    start_server(path, idle_timeout)
+    deadline = time.monotonic() + start_timeout
+    while True:
+        try:
+            return connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.01)
+
+
+def evaluate(expression, units=None, path=None, idle_timeout=600,
+             start=True):
+    """
+    Return the (text, units, error, message) of evaluating the expression.
+
+    Fields which do not apply are None.
+
+    """
+    path = path or get_socket_path()
+    if start:
+        connection = connect_or_start(path, idle_timeout)
+    else:
+        connection = connect(path)
+    request = ' '.join(expression.split())
+    if units:
+        request += '\t' + units
+    try:
+        connection.sendall(request.encode('utf-8') + b'\n')
+        connection.shutdown(_socket.SHUT_WR)
+        response = b''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        connection.close()
+    if not response.endswith(b'\n'):
+        raise ConnectionError('Server closed the connection')
+    fields = response[:-1].decode('utf-8').split('\t')
+    return tuple(unescape_field(x) or None for x in fields)
+
+
+def main(arguments=None):
+    # arguments are parsed by hand since argparse is slow to import
+    arguments = list(sys.argv[1:] if arguments is None else arguments)
+    options = {'--to': None, '--socket': None, '--idle-timeout': '600'}
+    start = True
+    words = []
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in options and arguments:
+            options[argument] = arguments.pop(0)
+        elif argument == '--no-start':
+            start = False
+        elif argument in ['-h', '--help']:
+            print(__doc__.split('Usage:')[1].strip())
+            return 0
+        else:
+            words.append(argument)
+    if not words:
+        print('usage: python -m ucal.client [options] expression',
+              file=sys.stderr)
+        return 2
+    try:
+        text, _, error, message = evaluate(
+            ' '.join(words), options['--to'], options['--socket'],
+            float(options['--idle-timeout']), start)
+    except OSError as error:
+        print('Could not connect to the ucal server: %s' % error,
+              file=sys.stderr)
+        return 1
+    if error:
+        print('%s: %s' % (error, message), file=sys.stderr)
+        return 1
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,460 @@
+"""
+The server module serves evaluation requests over a local socket.
+
+Run it with "python -m ucal.server".  It listens on one TCP port, or on a
+Unix domain socket with --unix, which accepts any of the following.
+
+* JSON lines: each line is an expression as a JSON string, or an object
+  such as {"id": 1, "expression": "5 km in mi"} with optional "units".
+  One response object is written per line, in the order of the requests.
+* HTTP: "POST /evaluate" with a body of one such request or a list of
+  them, and "GET /stats" for latency statistics.
+* Plain text: each line is an expression, optionally followed by a tab and
+  the target units.  Each response line is the result text, units, error
+  and message separated by tabs, with tabs and newlines escaped.  This is
+  used by the thin client in client.py.
+
+Requests from all connections are put on a bounded queue, from which they
+are taken in micro-batches and evaluated by a pool of threads, or of
+processes with --processes.  When the queue is full, reading requests
+waits, so clients are slowed down rather than the server running out of
+memory.  Each response includes the time taken for that request in
+"latency_ms".  With --idle-timeout, the server stops after no requests
+have been made for that many seconds.
+
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from ucal import ucal
+from ucal import ucal_parallel
+from ucal.client import escape_field
+
+
+def evaluate_requests(requests, settings):
+    """
+    Return the EvaluationResult for each (expression, units) request.
+
+    Requests with the same units are evaluated together.  If evaluating a
+    group fails, each of its requests has the error as its result, and the
+    other groups are unaffected.
+
+    """
+    session = ucal.Session(*settings)
+    groups = collections.OrderedDict()
+    for index, (expression, units) in enumerate(requests):
+        try:
+            group = groups.setdefault(units, (units, []))
+        except TypeError:
+            # units which cannot be a key are evaluated on their own
+            group = groups.setdefault(('unhashable', index), (units, []))
+        group[1].append(index)
+    results = [None] * len(requests)
+    for units, indices in groups.values():
+        try:
+            records = list(session.evaluate_many(
+                [requests[i][0] for i in indices], units))
+        except Exception as error:
+            records = [ucal.EvaluationResult(requests[i][0], None, None,
+                                             units, None,
+                                             type(error).__name__,
+                                             str(error))
+                       for i in indices]
+        for index, record in zip(indices, records):
+            results[index] = record
+    return results
+
+
+def encode_result(result):
+    """Return the fields of the EvaluationResult to send to a client."""
+    response = collections.OrderedDict()
+    response['expression'] = result.expression
+    response['text'] = result.text
+    response['units'] = result.units
+    response['error'] = result.error
+    response['message'] = result.message
+    return response
+
+
+def encode_text_response(response):
+    """Return the response as a line of the plain text protocol."""
+    return '\t'.join(escape_field(response.get(x))
+                     for x in ['text', 'units', 'error', 'message'])
+
+
+def error_response(error, message):
+    """Return a response for a request which could not be evaluated."""
+    response = collections.OrderedDict()
+    response['error'] = error
+    response['message'] = message
+    return response
+
+
+class EvaluationServer:
+    """An EvaluationServer evaluates requests sent over a TCP socket."""
+
+    def __init__(self, host='127.0.0.1', port=8765, batch_size=256,
+                 batch_delay=0.002, queue_size=10000, workers=4,
+                 processes=False, path=None, idle_timeout=None):
+        """Initialize."""
+        self.host = host
+        self.port = port
+        # path of the Unix domain socket to listen on instead of a port
+        self.path = path
+        # seconds without requests after which the server stops, or None
+        self.idle_timeout = idle_timeout
+        # maximum number of requests evaluated together
+        self.batch_size = batch_size
+        # time in seconds to wait for more requests to add to a batch
+        self.batch_delay = batch_delay
+        # maximum number of requests waiting to be evaluated
+        self.queue_size = queue_size
+        # number of batches evaluated at once
+        self.workers = workers
+        self.processes = processes
+        self.settings = (ucal.working_precision_digits,
+                         ucal.output_precision_digits,
+                         ucal.get_backend().name)
+        # latency of recent requests in seconds
+        self.latencies = collections.deque(maxlen=10000)
+        self.request_count = 0
+        self.batch_count = 0
+        self.queue = None
+        self.server = None
+        self.executor = None
+        self.batcher = None
+        self.watcher = None
+        # inode of the socket file this server bound, see stop()
+        self.inode = None
+        # set when the server should stop
+        self.stopped = None
+        self.connection_count = 0
+        self.last_active = time.monotonic()
+
+    async def start(self):
+        """Start listening and evaluating requests."""
+        if self.processes:
+            table = ucal.get_unit_table(list(ucal.unit_def))
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=ucal_parallel.init_worker,
+                initargs=(table,))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers)
+        self.queue = asyncio.Queue(self.queue_size)
+        self.stopped = asyncio.Event()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+        if self.path:
+            if is_listening(self.path):
+                raise RuntimeError('A server is already listening on %s'
+                                   % self.path)
+            self.server = await asyncio.start_unix_server(
+                self.handle_connection, self.path)
+            os.chmod(self.path, 0o600)
+            self.inode = os.stat(self.path).st_ino
+        else:
+            self.server = await asyncio.start_server(self.handle_connection,
+                                                     self.host, self.port)
+            # find the port if it was chosen by the system
+            self.port = self.server.sockets[0].getsockname()[1]
+        if self.idle_timeout:
+            self.watcher = asyncio.ensure_future(self.stop_when_idle())
+
+    async def stop(self):
+        """Stop the server."""
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        if self.watcher:
+            self.watcher.cancel()
+        self.executor.shutdown(wait=False)
+        # another server started at the same time may have replaced the
+        # socket file, which is then left for it to remove
+        if self.path:
+            try:
+                if os.stat(self.path).st_ino == self.inode:
+                    os.remove(self.path)
+            except OSError:
+                pass
+
+    async def stop_when_idle(self):
+        """Set stopped once no requests are made for the idle timeout."""
+        while True:
+            remaining = self.last_active + self.idle_timeout - time.monotonic()
+            if remaining <= 0 and not self.connection_count:
+                self.stopped.set()
+                return
+            await asyncio.sleep(max(remaining, 0.1))
+
+    async def evaluate(self, expression, units=None):
+        """Return the EvaluationResult and latency of one request."""
+        start = time.perf_counter()
+        future = asyncio.get_event_loop().create_future()
+        # wait here while the queue is full
+        await self.queue.put((expression, units, future))
+        result = await future
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        self.request_count += 1
+        return result, latency
+
+    def take_waiting(self, batch):
+        """Add waiting requests to the batch, up to the batch size."""
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+    async def run_batches(self):
+        """Take batches of requests from the queue and evaluate them."""
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            batch = [await self.queue.get()]
+            self.take_waiting(batch)
+            if len(batch) < self.batch_size and self.batch_delay > 0:
+                await asyncio.sleep(self.batch_delay)
+                self.take_waiting(batch)
+            await slots.acquire()
+            asyncio.ensure_future(self.run_batch(batch, slots))
+
+    async def run_batch(self, batch, slots):
+        """Evaluate one batch of requests and set their results."""
+        self.batch_count += 1
+        try:
+            requests = [(expression, units)
+                        for expression, units, _ in batch]
+            results = await asyncio.get_event_loop().run_in_executor(
+                self.executor, evaluate_requests, requests, self.settings)
+        except Exception as error:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            slots.release()
+
+    async def respond(self, request):
+        """Return the response to one decoded request."""
+        if isinstance(request, str):
+            request = {'expression': request}
+        if (not isinstance(request, dict) or
+                not isinstance(request.get('expression'), str)):
+            return error_response('ValueError',
+                                  'Request has no expression.')
+        units = request.get('units')
+        if units is not None and not isinstance(units, str):
+            return error_response('ValueError',
+                                  'Request units must be a string.')
+        try:
+            result, latency = await self.evaluate(request['expression'],
+                                                  units)
+        except Exception as error:
+            return error_response(type(error).__name__, str(error))
+        response = encode_result(result)
+        if 'id' in request:
+            response['id'] = request['id']
+        response['latency_ms'] = round(latency * 1000.0, 3)
+        return response
+
+    async def respond_to_line(self, line):
+        """Return the response to one line of a JSON lines connection."""
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError as error:
+            return error_response('ValueError', str(error))
+        return await self.respond(request)
+
+    def get_stats(self):
+        """Return statistics of recent requests."""
+        stats = collections.OrderedDict()
+        stats['requests'] = self.request_count
+        stats['batches'] = self.batch_count
+        stats['queued'] = self.queue.qsize()
+        latencies = sorted(self.latencies)
+        if latencies:
+            stats['mean_ms'] = 1000.0 * sum(latencies) / len(latencies)
+            for percent in [50, 90, 99]:
+                index = min(len(latencies) - 1,
+                            len(latencies) * percent // 100)
+                stats['p%d_ms' % percent] = 1000.0 * latencies[index]
+        return stats
+
+    async def handle_connection(self, reader, writer):
+        """Serve one connection, using HTTP, JSON lines or plain text."""
+        self.connection_count += 1
+        try:
+            line = await reader.readline()
+            if line.startswith((b'GET ', b'POST ')):
+                await self.handle_http(line, reader, writer)
+            elif line.lstrip().startswith((b'{', b'"')):
+                await self.handle_lines(line, reader, writer,
+                                        self.respond_to_line, json.dumps)
+            else:
+                await self.handle_lines(line, reader, writer,
+                                        self.respond_to_text_line,
+                                        encode_text_response)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.connection_count -= 1
+            self.last_active = time.monotonic()
+
+    async def respond_to_text_line(self, line):
+        """Return the response to one line of a plain text connection."""
+        expression, _, units = line.decode('utf-8').strip().partition('\t')
+        return await self.respond({'expression': expression,
+                                   'units': units.strip() or None})
+
+    async def handle_lines(self, line, reader, writer, respond, encode):
+        """Serve a connection sending one request per line."""
+        # responses waiting to be written, in the order of the requests
+        responses = asyncio.Queue(self.batch_size)
+
+        async def write_responses():
+            while True:
+                task = await responses.get()
+                if task is None:
+                    return
+                response = await task
+                writer.write(encode(response).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        writing = asyncio.ensure_future(write_responses())
+        try:
+            while line:
+                if line.strip():
+                    task = asyncio.ensure_future(respond(line))
+                    await responses.put(task)
+                line = await reader.readline()
+            await responses.put(None)
+            await writing
+        finally:
+            writing.cancel()
+
+    async def handle_http(self, line, reader, writer):
+        """Serve a connection sending HTTP requests."""
+        while line:
+            method, path, version = line.decode('latin-1').split(None, 2)
+            headers = dict()
+            while True:
+                header = await reader.readline()
+                if not header.strip():
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            body = await reader.readexactly(length) if length else b''
+            status, response = await self.respond_to_http(method, path,
+                                                          body)
+            content = json.dumps(response).encode('utf-8')
+            keep_alive = (version.strip() == 'HTTP/1.1' and
+                          headers.get('connection', '').lower() != 'close')
+            writer.write(('HTTP/1.1 %s\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n'
+                          'Connection: %s\r\n\r\n'
+                          % (status, len(content),
+                             'keep-alive' if keep_alive else 'close')
+                          ).encode('latin-1') + content)
+            await writer.drain()
+            if not keep_alive:
+                return
+            line = await reader.readline()
+
+    async def respond_to_http(self, method, path, body):
+        """Return the status and response to one HTTP request."""
+        if method == 'GET' and path == '/stats':
+            return '200 OK', self.get_stats()
+        if method != 'POST' or path != '/evaluate':
+            return '404 Not Found', error_response('NotFound', path)
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError as error:
+            return '400 Bad Request', error_response('ValueError',
+                                                     str(error))
+        if isinstance(request, list):
+            responses = await asyncio.gather(
+                *[self.respond(x) for x in request])
+            return '200 OK', list(responses)
+        return '200 OK', await self.respond(request)
+
+
+def is_listening(path):
+    """Return True if a server is listening on the Unix domain socket."""
+    try:
+        with socket.socket(socket.AF_UNIX) as connection:
+            connection.connect(path)
+    except OSError:
+        return False
+    return True
+
+
+async def serve(server):
+    """Start the server and serve requests until it is stopped."""
+    await server.start()
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM,
+                                                    server.stopped.set)
+    except (NotImplementedError, AttributeError):
+        # signal handlers are not supported on Windows
+        pass
+    if server.path:
+        print('Serving on %s' % server.path)
+    else:
+        print('Serving on %s:%d' % (server.host, server.port))
+    try:
+        await server.stopped.wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m ucal.server',
+        description='Evaluate ucal expressions sent over a local socket.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH',
+                        help='listen on this Unix domain socket')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='seconds without requests before stopping')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='maximum number of requests in a batch')
+    parser.add_argument('--batch-delay', type=float, default=2.0,
+                        help='milliseconds to wait to fill a batch')
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help='maximum number of requests waiting')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of batches evaluated at once')
+    parser.add_argument('--processes', action='store_true',
+                        help='evaluate batches in processes, not threads')
+    args = parser.parse_args()
+    server = EvaluationServer(args.host, args.port, args.batch_size,
+                              args.batch_delay / 1000.0, args.queue_size,
+                              args.workers, args.processes, args.unix,
+                              args.idle_timeout)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(server))
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as error:
+        sys.exit(str(error))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,18 +14,38 @@ import ucal
 >>> ucal.evaluate("5V * 500mA")
 '2.5 W'
 >>> ucal.evaluate("1mi + 10km")
-'11609.344 m'
+'11.609344 km'
 
 """
 
-import inspect
 import math
+import os
+import bisect
+import contextlib
+import time
+import json
+import zlib
 import decimal
 import string
-import ast
 import re
-
+import collections
+import operator
+import fractions
+import threading
+import weakref
+
+# TOML unit packs need tomllib, or tomli before Python 3.11
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+from ucal import ucal_trace
 from ucal import ucal_units
+from ucal.ucal_backends import backends, backend_of_type
 
 ####################
 # START OF OPTIONS #
@@ -37,19 +57,38 @@ working_precision_digits = 32
 # output precision in base-10 decimal units
 output_precision_digits = 16
 
-# if True, will show debug output
-debug_output = False
-
 # if True, will verify conversions were done correctly
 verify_unit_conversions = True
 
+# if True, results without target units are written in the SI-prefixed
+# output unit which gives a value from 1 to 1000, such as "3 us"
+autoscale_output_units = True
+
+# number of parsed equations to keep in the token cache, 0 to disable it
+token_cache_size = 256
+
+# name of the numeric backend used to hold values: 'decimal', 'float' or
+# 'fraction' (see ucal_backends.py)
+numeric_backend = 'decimal'
+
+# directory holding the cache of resolved unit definitions, or None to
+# resolve them on every import (see unit_cache_path)
+unit_cache_directory = os.environ.get(
+    'UCAL_CACHE_DIR',
+    os.path.join(os.environ.get('LOCALAPPDATA') or
+                 os.environ.get('XDG_CACHE_HOME') or
+                 os.path.join(os.path.expanduser('~'), '.cache'), 'ucal'))
+
 ##################
 # END OF OPTIONS #
 ##################
 
 # define items to be imported with import *
 __all__ = ['evaluate', 'ParserError', 'interpret', 'infix_operators',
-           'QuantityError', 'unit_def', 'debug_output']
+           'QuantityError', 'unit_def', 'compile', 'CompiledExpression',
+           'token_cache', 'Session', 'evaluate_many', 'EvaluationResult',
+           'list_units', 'profiling', 'EvaluationProfile', 'set_trace_sink',
+           'define', 'load_pack']
 
 
 class QuantityError(Exception):
@@ -67,6 +106,217 @@ class ParserError(Exception):
     pass
 
 
+class UnitDictionary(dict):
+    """
+    A UnitDictionary maps unit names to a Quantity and tracks changes.
+
+    Every change to a name records a new stamp for it, so that anything
+    derived from a definition can check that it is still up to date.
+
+    Units may also be added as a pending definition, which is resolved the
+    first time the unit is looked up.  Pending units are included when
+    testing for and iterating over names.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initialize."""
+        super().__init__()
+        # incremented on every change
+        self.version = 0
+        # hold the version at which each name was last changed
+        self.stamps = dict()
+        # definitions which have not been resolved yet
+        # pending['ft'] = ('12 in', tokens of '12 in')
+        self.pending = dict()
+        # names of the units used by each pending definition
+        # dependencies['ft'] = ('in',)
+        self.dependencies = dict()
+        self.update(*args, **kwargs)
+
+    def touch(self, name):
+        """Record a change to the given name."""
+        self.version += 1
+        self.stamps[name] = self.version
+
+    def defer(self, name, definition, tokens, dependencies):
+        """Add a definition for the given unit to be resolved when used."""
+        self.pending[name] = (definition, tokens)
+        self.dependencies[name] = dependencies
+        if super().__contains__(name):
+            super().__delitem__(name)
+        self.touch(name)
+
+    def __missing__(self, name):
+        with unit_lock:
+            if name in self.pending:
+                resolve_unit(name)
+            elif not super().__contains__(name):
+                raise KeyError(name)
+        return super().__getitem__(name)
+
+    def __contains__(self, name):
+        return super().__contains__(name) or name in self.pending
+
+    def __iter__(self):
+        return iter(list(super().keys()) + list(self.pending))
+
+    def __len__(self):
+        return super().__len__() + len(self.pending)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def __setitem__(self, name, value):
+        # the value is stored first so that a unit being resolved is never
+        # missing to another thread
+        super().__setitem__(name, value)
+        self.pending.pop(name, None)
+        self.dependencies.pop(name, None)
+        self.touch(name)
+
+    def __delitem__(self, name):
+        if name in self.pending:
+            del self.pending[name]
+            del self.dependencies[name]
+        else:
+            super().__delitem__(name)
+        self.touch(name)
+
+    def pop(self, name, *default):
+        if name not in self:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        value = self[name]
+        del self[name]
+        return value
+
+    def popitem(self):
+        name, value = super().popitem()
+        self.touch(name)
+        return name, value
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        for name in list(self):
+            del self[name]
+
+
+class TokenCache:
+    """
+    A TokenCache is a bounded least-recently-used cache of parsed equations.
+
+    Equations are keyed with their whitespace normalized.  Each entry holds
+    the tokens along with the unit_def stamp of every unit bound into them,
+    and is discarded if any of those units have since changed.  Names which
+    are not units are left in the tokens as variables, and the entry is
+    also discarded if one of them is later defined as a unit.  The
+    conversion clauses and syntax error found by parse_equation() are kept
+    with them.
+
+    """
+
+    def __init__(self, maxsize):
+        """Initialize."""
+        # maximum number of entries, 0 to disable the cache
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def normalize(equation):
+        """Return the key used for the given equation."""
+        return ' '.join(equation.split())
+
+    def get(self, key, variables=None):
+        """
+        Return (tokens, variable_names, conversions, syntax_error) for the
+        given key, or None.
+
+        Entries which have a unit bound with the same name as one of the
+        given variables are not used.
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] != unit_def.version:
+                # names left as variables are only checked again once
+                # units have changed
+                if any(name in unit_def or split_prefixed_unit(name)
+                       for name in entry[3]):
+                    entry = None
+                else:
+                    entry = entry[:2] + (unit_def.version,) + entry[3:]
+                    self.entries[key] = entry
+            if entry is not None:
+                stamps = entry[1]
+                if all(unit_def.stamps.get(name) == stamp
+                       for name, stamp in stamps):
+                    if not variables or not any(name in variables
+                                                for name, _ in stamps):
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return (entry[0],) + entry[3:]
+                else:
+                    entry = None
+            if entry is None:
+                self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, tokens, units, conversions=(), syntax_error=None):
+        """
+        Store the tokens, which have the given unit names bound.
+
+        Return (tokens, variable_names, conversions, syntax_error) as
+        returned by get().
+
+        """
+        names = tuple(x[1] for x in tokens if x[0] == Token.variable)
+        entry = (tokens, names, conversions, syntax_error)
+        if self.maxsize <= 0:
+            return entry
+        stamps = tuple((name, unit_def.stamps.get(name)) for name in units)
+        with self.lock:
+            self.entries[key] = (tokens, stamps, unit_def.version) + entry[1:]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class Token:
     """The Token class defines various token types."""
     opening_parenthesis = '('
@@ -79,32 +329,168 @@ class Token:
     postfix_operator = 'postfix_op'
 
 
+def exact_exponent(exponent):
+    """
+    Return the given unit exponent as a Fraction.
+
+    Exponents such as 0.3333... which are very close to a simple fraction
+    are taken to be that fraction.
+
+    """
+    exponent = fractions.Fraction(exponent)
+    if exponent.denominator > 1000:
+        simple = exponent.limit_denominator(1000)
+        if abs(simple - exponent) < 1e-12:
+            return simple
+    return exponent
+
+
+class Dimension:
+    """
+    A Dimension holds the exponents of the base units of a quantity.
+
+    Dimensions are interned, so that there is a single Dimension for each
+    set of exponents and they may be compared by identity.  Exponents are
+    held exactly as a Fraction.  Results of multiplying, dividing and
+    raising a Dimension to a power are memoized.
+
+    Dimensions are only held by the intern table while they are in use,
+    and each memo holds at most memo_size results, so that evaluating
+    many different exponents does not use more and more memory.
+
+    """
+
+    __slots__ = ('exponents', 'products', 'quotients', 'powers',
+                 '__weakref__')
+
+    # interned dimensions keyed by their exponents
+    interned = weakref.WeakValueDictionary()
+
+    # largest number of results held by each memo of a Dimension
+    memo_size = 64
+
+    def __new__(cls, exponents):
+        # exponents which are equal to a Fraction also have the same hash
+        exponents = tuple(exponents)
+        self = Dimension.interned.get(exponents)
+        if self is not None:
+            return self
+        exponents = tuple(exact_exponent(x) for x in exponents)
+        self = Dimension.interned.get(exponents)
+        if self is None:
+            self = object.__new__(cls)
+            self.exponents = exponents
+            self.products = dict()
+            self.quotients = dict()
+            self.powers = dict()
+            # another thread may have added the same dimension
+            self = Dimension.interned.setdefault(exponents, self)
+        return self
+
+    def __reduce__(self):
+        return Dimension, (self.exponents,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __iter__(self):
+        return iter(self.exponents)
+
+    def __len__(self):
+        return len(self.exponents)
+
+    def __getitem__(self, index):
+        return self.exponents[index]
+
+    def __repr__(self):
+        return 'Dimension((%s))' % ', '.join(str(x) for x in self.exponents)
+
+    def __mul__(self, other):
+        result = self.products.get(other)
+        if result is None:
+            result = Dimension(map(operator.add,
+                                   self.exponents, other.exponents))
+            if len(self.products) >= Dimension.memo_size:
+                self.products.clear()
+            self.products[other] = result
+        return result
+
+    def __truediv__(self, other):
+        result = self.quotients.get(other)
+        if result is None:
+            result = Dimension(map(operator.sub,
+                                   self.exponents, other.exponents))
+            if len(self.quotients) >= Dimension.memo_size:
+                self.quotients.clear()
+            self.quotients[other] = result
+        return result
+
+    def __pow__(self, exponent):
+        result = self.powers.get(exponent)
+        if result is None:
+            power = exact_exponent(exponent)
+            result = Dimension(x * power for x in self.exponents)
+            if len(self.powers) >= Dimension.memo_size:
+                self.powers.clear()
+            self.powers[exponent] = result
+        return result
+
+
 class Quantity:
-    """A Quantity represents a physical quantity--a number with units."""
+    """
+    A Quantity represents a physical quantity--a number with units.
+
+    Quantities are immutable.  The units are the Dimension holding the
+    exponents of the base units.
+
+    """
+
+    __slots__ = ('value', 'units')
 
     def __init__(self, value=decimal.Decimal(0), units=None):
         """Initialize."""
-        self.value = decimal.Decimal(value)
-        if units is not None:
-            self.units = units
-        else:
-            self.units = [0.0] * unit_count
+        # values not of a backend number type are held as a Decimal
+        if type(value) not in backend_of_type:
+            value = decimal.Decimal(value)
+        if units is None:
+            units = unitless
+        elif type(units) is not Dimension:
+            units = Dimension(units)
+        object.__setattr__(self, 'value', value)
+        object.__setattr__(self, 'units', units)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Quantity objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Quantity objects are immutable')
+
+    def __reduce__(self):
+        return Quantity, (self.value, self.units)
 
     def __str__(self):
         """Convert to a human-readable string."""
         upper_units = []
         for x, y in zip(self.units, base_units):
-            if x == int(x):
-                x = int(x)
-            if x == 0.0:
+            if x == 0:
                 continue
-            elif x == 1.0:
+            elif x == 1:
                 upper_units.append(y)
-            elif x == -1.0:
+            elif x == -1:
                 upper_units.append('%s^-1' % y)
-            else:
+            elif x.denominator == 1:
                 upper_units.append('%s^%s' % (y, x))
-        value_str = '0' if self.value == 0 else str(self.value)
+            elif 10 ** 12 % x.denominator == 0 or x.denominator > 1000:
+                # exponents with a short decimal form, or which are not a
+                # simple fraction, are written as a decimal
+                upper_units.append('%s^%s' % (y, float(x)))
+            else:
+                upper_units.append('%s^(%s)' % (y, x))
+        value = self.backend.to_decimal(self.value)
+        value_str = '0' if value == 0 else str(value)
         if 'E' in value_str:
             base, exponent = value_str.split('E')
             exponent = str(int(exponent))
@@ -121,121 +507,158 @@ class Quantity:
     def __repr__(self):
         return 'Quantity(' + str(self) + ')'
 
+    @property
+    def backend(self):
+        """Return the numeric backend of the value."""
+        return backend_of_type[type(self.value)]
+
     def __eq__(self, other):
         if isinstance(other, Quantity):
-            return self.value == other.value and self.units == other.units
+            return self.value == other.value and self.units is other.units
         return self.value == other and self.is_unitless()
 
+    def __hash__(self):
+        # unitless quantities compare equal to their value
+        if self.units is unitless:
+            return hash(self.value)
+        return hash((self.value, self.units))
+
     def __add__(self, other):
-        if self.units != other.units:
+        if not isinstance(other, Quantity):
+            return NotImplemented
+        if self.units is not other.units:
             raise QuantityError('Inconsistent units', self, other)
-        return Quantity(value=self.value + other.value, units=list(self.units))
+        return Quantity(self.value + other.value, self.units)
 
     def __sub__(self, other):
-        if self.units != other.units:
+        if not isinstance(other, Quantity):
+            return NotImplemented
+        if self.units is not other.units:
             raise QuantityError('Inconsistent units', self, other)
-        return Quantity(value=self.value - other.value, units=list(self.units))
+        return Quantity(self.value - other.value, self.units)
 
     def __mul__(self, other):
-        return Quantity(value=self.value * other.value,
-                        units=[x + y for x, y in zip(self.units, other.units)])
+        if not isinstance(other, Quantity):
+            return NotImplemented
+        return Quantity(self.value * other.value, self.units * other.units)
 
     def __truediv__(self, other):
-        return Quantity(value=self.value / other.value,
-                        units=[x - y for x, y in zip(self.units, other.units)])
+        if not isinstance(other, Quantity):
+            return NotImplemented
+        return Quantity(self.value / other.value, self.units / other.units)
 
     def __neg__(self):
-        return Quantity(value=-self.value, units=self.units)
+        return Quantity(-self.value, self.units)
 
     def __pos__(self):
-        return Quantity(value=+self.value, units=self.units)
+        return Quantity(+self.value, self.units)
 
     def __mod__(self, other):
-        if self.units != other.units:
+        if not isinstance(other, Quantity):
+            return NotImplemented
+        if self.units is not other.units:
             raise QuantityError('Inconsistent units', self, other)
-        return Quantity(value=self.value % other.value,
-                        units=[0.0] * unit_count)
+        return Quantity(self.backend.mod(self.value, other.value))
 
     def __pow__(self, other):
+        if not isinstance(other, Quantity):
+            return NotImplemented
         if not other.is_unitless():
             raise QuantityError('Inconsistent units',
                                 'Values in the exponent must be unitless.',
                                 self)
-        return Quantity(value=self.value ** other.value,
-                        units=[x * float(other.value) for x in self.units])
+        if self.units is unitless:
+            units = unitless
+        else:
+            try:
+                units = self.units ** other.value
+            except (ValueError, OverflowError):
+                raise QuantityError('Invalid value', self, other)
+        return Quantity(self.backend.power(self.value, other.value), units)
 
     def matches_units(self, other):
         """Return True if this has the same units as the other value."""
-        return all(x == y for x, y in zip(self.units, other.units))
+        return self.units is other.units
 
     def is_unitless(self):
         """Return True if the value is unitless."""
-        return all(x == 0.0 for x in self.units)
+        return self.units is unitless
 
     def is_integer(self):
         """Return True if the value is an integer."""
-        return (self.is_unitless() and
-                self.value == self.value.to_integral_value())
+        return self.is_unitless() and self.backend.is_integral(self.value)
 
     def factorial(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units', self)
-        if self.value.to_integral_value() != self.value or self.value < 0:
+        if not self.backend.is_integral(self.value) or self.value < 0:
             raise QuantityError('Invalid value', self)
-        new_value = decimal.Decimal('1')
-        while self.value > 1:
-            new_value *= self.value
-            self.value -= 1
-        return Quantity(value=new_value,
-                        units=[0.0] * unit_count)
+        try:
+            return Quantity(self.backend.factorial(self.value))
+        except OverflowError:
+            raise QuantityError('Invalid value',
+                                'The result is too large to hold.', self)
 
     # functions are given with the prefix "function_"
     # for example, "sqrt(value)" would call "value.function_sqrt()"
     def function_sqrt(self):
-        return Quantity(value=self.value.sqrt(),
-                        units=[x / 2.0 for x in self.units])
+        return Quantity(self.backend.sqrt(self.value),
+                        self.units ** fractions.Fraction(1, 2))
 
     def function_sin(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units',
                                 'Exponent values must be unitless.',
                                 self)
-        return Quantity(value=math.sin(self.value),
-                        units=self.units)
+        return Quantity(self.backend.sin(self.value))
 
     def function_cos(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units',
                                 'Exponent values must be unitless.',
                                 self)
-        return Quantity(value=math.cos(self.value),
-                        units=self.units)
+        return Quantity(self.backend.cos(self.value))
 
     def function_tan(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units',
                                 'Exponent values must be unitless.',
                                 self)
-        return Quantity(value=math.tan(self.value),
-                        units=self.units)
+        return Quantity(self.backend.tan(self.value))
+
+    def function_asin(self):
+        if not self.is_unitless():
+            raise QuantityError('Inconsistent units', self)
+        if abs(self.value) > 1:
+            raise QuantityError('Invalid value', self)
+        return Quantity(self.backend.asin(self.value))
+
+    def function_acos(self):
+        if not self.is_unitless():
+            raise QuantityError('Inconsistent units', self)
+        if abs(self.value) > 1:
+            raise QuantityError('Invalid value', self)
+        return Quantity(self.backend.acos(self.value))
+
+    def function_atan(self):
+        if not self.is_unitless():
+            raise QuantityError('Inconsistent units', self)
+        return Quantity(self.backend.atan(self.value))
 
     def function_exp(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units',
                                 'Exponent values must be unitless.',
                                 self)
-        return Quantity(value=self.value.exp(),
-                        units=self.units)
+        return Quantity(self.backend.exp(self.value))
 
     def function_abs(self):
-        return Quantity(value=abs(self.value),
-                        units=self.units)
+        return Quantity(abs(self.value), self.units)
 
     def function_ln(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units', self)
-        return Quantity(value=self.value.ln(),
-                        units=self.units)
+        return Quantity(self.backend.ln(self.value))
 
     def function_log(self):
         return self.function_ln()
@@ -243,15 +666,39 @@ class Quantity:
     def function_log10(self):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units', self)
-        return Quantity(value=self.value.log10(),
-                        units=self.units)
+        return Quantity(self.backend.log10(self.value))
+
+    def function_log2(self):
+        if not self.is_unitless():
+            raise QuantityError('Inconsistent units', self)
+        return Quantity(self.backend.log2(self.value))
 
     def function_atan2(self, other):
         if not self.is_unitless():
             raise QuantityError('Inconsistent units', self, other)
         if not other.is_unitless():
             raise QuantityError('Inconsistent units', self, other)
-        return Quantity(value=math.atan2(self.value, other.value))
+        return Quantity(self.backend.atan2(self.value, other.value))
+
+    def check_gamma_argument(self):
+        """Raise a QuantityError if gamma is not defined for the value."""
+        if not self.is_unitless():
+            raise QuantityError('Inconsistent units', self)
+        # gamma has poles at zero and the negative integers
+        if self.backend.is_integral(self.value) and self.value <= 0:
+            raise QuantityError('Invalid value', self)
+
+    def function_gamma(self):
+        self.check_gamma_argument()
+        try:
+            return Quantity(self.backend.gamma(self.value))
+        except OverflowError:
+            raise QuantityError('Invalid value',
+                                'The result is too large to hold.', self)
+
+    def function_lgamma(self):
+        self.check_gamma_argument()
+        return Quantity(self.backend.lgamma(self.value))
 
 
 # rules for implicit multiplication
@@ -303,7 +750,27 @@ unit_systems = dict()
 unit_systems['SI'] = ['kg', 'm', 's', 'A', 'K', 'mol', 'cd', 'byte']
 
 # hold dictionary mapping unit name to a Quantity()
-unit_def = dict()
+unit_def = UnitDictionary()
+
+# hold the (definition, unit_def stamp) of each imported unit, with a
+# definition of None for base units
+unit_source = dict()
+
+# hold the names of the units used by the definition of each unit, see
+# get_unit_uses()
+# unit_uses['ft'] = ('in',)
+unit_uses = dict()
+
+# hold unit_def converted for each other numeric backend
+# backend_unit_def['float']['m'] = (unit_def stamp, Quantity)
+backend_unit_def = dict()
+
+# hold recently parsed equations
+token_cache = TokenCache(token_cache_size)
+
+# sink which trace events are sent to, or None while tracing is off (see
+# set_trace_sink() and ucal_trace.py)
+tracer = None
 
 # base unit system
 base_units = unit_systems['SI']
@@ -311,6 +778,9 @@ base_units = unit_systems['SI']
 # number of base units
 unit_count = len(base_units)
 
+# units of a unitless Quantity
+unitless = Dimension((0,) * unit_count)
+
 # natural units for output
 natural_unit = dict()
 natural_unit['N'] = 'force'
@@ -337,27 +807,91 @@ natural_unit['Mbps'] = 'data rate'
 natural_unit['byte'] = 'data'
 natural_unit['Hz'] = 'frequency'
 
-# hold conversion from a Quantity unit tuple to a natural output unit
-# natural_unit_map[(1.0, 0.0, ...)] = ('m', 'length', evaluate('m'))
+# held while resolving pending units
+unit_lock = threading.RLock()
+
+# hold conversion from a Quantity Dimension to a natural output unit
+# natural_unit_map[Dimension((1, 0, ...))] = ('m', 'length', evaluate('m'))
 natural_unit_map = dict()
 
+# prefixes of the output units results may be scaled to, and their powers
+# of ten
+output_prefixes = {'p': -12, 'n': -9, 'u': -6, 'm': -3, '': 0, 'k': 3,
+                   'M': 6, 'G': 9, 'T': 12}
+
+# the ways units may be written with a prefix, as (prefixes, units which
+# may take them, format of the definition from the power and the unit)
+prefix_tables = [
+    (ucal_units.si_prefixes, ucal_units.si_prefixed_units, '1e%d %s'),
+    (ucal_units.si_prefix_names, ucal_units.si_named_units, '1e%d %s'),
+    (ucal_units.binary_prefixes, ucal_units.binary_prefixed_units,
+     '1024^%d %s'),
+    (ucal_units.binary_prefix_names, ucal_units.binary_named_units,
+     '1024^%d %s')]
+
+# hold names which may be read as more than one unit with a prefix, and
+# the definitions they may have
+# ambiguous_units['daX'] = ['1e1 X', '1e-1 aX']
+ambiguous_units = dict()
+
+# hold the names of the units defined as a prefix and a unit, which are
+# only listed if the prefix is in ucal_units.listed_prefixes
+prefixed_units = set()
+
+# hold the units of each Dimension sorted by magnitude, built when needed
+# dimension_index[Dimension((1, 0, ...))] = [(Decimal('1E-9'), 'nm'), ...]
+dimension_index = dict()
+
+# unit_def version the dimension_index was built at
+dimension_index_version = None
+
+# hold the units results of each Dimension are written in, along with the
+# unit_def version they were found at and the names of the units they may
+# use, see get_output_units(), while the Dimension is in use
+# output_units[Dimension((1, 0, ...))] = (version, {'m', 'km', ...}, units)
+output_units = weakref.WeakKeyDictionary()
+
+
+def index_operators(operators):
+    """Return a dict mapping a first character to the operators it starts."""
+    table = dict()
+    for symbol in sorted(operators, key=len, reverse=True):
+        table.setdefault(symbol[0], []).append(symbol)
+    return table
+
+
+# operators and functions are called through the operator module so that
+# they apply to any quantity type, such as a Quantity or QuantityArray
+
 # prefix operators and their corresponding precedence and functions
 prefix_operators = dict()
-prefix_operators['-'] = (2, Quantity.__neg__)
-prefix_operators['+'] = (2, Quantity.__pos__)
+prefix_operators['-'] = (2, operator.neg)
+prefix_operators['+'] = (2, operator.pos)
 
 # infix operators and their corresponding precedence and functions
 infix_operators = dict()
-infix_operators['+'] = (4, Quantity.__add__)
-infix_operators['-'] = (4, Quantity.__sub__)
-infix_operators['/'] = (3, Quantity.__truediv__)
-infix_operators['*'] = (3, Quantity.__mul__)
-infix_operators['%'] = (3, Quantity.__mod__)
-infix_operators['^'] = (1, Quantity.__pow__)
+infix_operators['+'] = (4, operator.add)
+infix_operators['-'] = (4, operator.sub)
+infix_operators['/'] = (3, operator.truediv)
+infix_operators['*'] = (3, operator.mul)
+infix_operators['%'] = (3, operator.mod)
+infix_operators['^'] = (1, operator.pow)
+
+# token added for implicit multiplication, which trace events find by
+# identity
+implicit_multiplication_token = (Token.infix_operator, infix_operators['*'])
 
 # postfix operators and their corresponding precedence and functions
 postfix_operators = dict()
-postfix_operators['!'] = (1, Quantity.factorial)
+postfix_operators['!'] = (1, operator.methodcaller('factorial'))
+
+# map the first character of each operator to the operators it starts
+prefix_operator_table = index_operators(prefix_operators)
+infix_operator_table = index_operators(infix_operators)
+postfix_operator_table = index_operators(postfix_operators)
+
+# infix operators which are evaluated from right to left
+right_associative_operators = {operator.pow}
 
 # valid starting characters for variables and functions
 starting_variable_characters = string.ascii_letters
@@ -376,8 +910,27 @@ valid_number_patterns.append(r'[+-]?[0-9]+\.?[0-9]*(?:[eE][-+]?[0-9]+)?')
 # number with digit after decimal
 valid_number_patterns.append(r'[+-]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?')
 
-# compile number patterns
-valid_number_regex = [re.compile(x) for x in valid_number_patterns]
+# compile number patterns into a single regex which tries them in order
+valid_number_regex = re.compile(
+    '|'.join('(?:%s)' % x for x in valid_number_patterns))
+
+# compile the pattern for variables and functions
+variable_regex = re.compile('[%s][%s]*'
+                            % (re.escape(starting_variable_characters),
+                               re.escape(following_variable_characters)))
+
+# words which may start a conversion clause, such as "1 ft in m", in the
+# order they are tried
+conversion_words = ['to', 'as', 'in']
+
+# conversion targets which write an integer in another base
+number_base_targets = {'hex', 'bin', 'binary'}
+
+# token types which a value immediately precedes
+value_token_types = {Token.closing_parenthesis,
+                     Token.variable,
+                     Token.value,
+                     Token.postfix_operator}
 
 # hold dictionary mapping math function strings to functions
 math_functions = dict()
@@ -387,429 +940,1485 @@ def find_math_functions():
     """Return math functions defined in this file."""
     global math_functions
     # determine functions and how many arguments each of them take
-    # math_functions['sqrt'] -> (Quantity.function_sqrt, arg_count)
+    # math_functions['sqrt'] -> (arg_count, methodcaller('function_sqrt'))
     math_functions = dict()
     prefix = 'function_'
-    names = inspect.getmembers(Quantity, predicate=inspect.isfunction)
-    names = [x for x in names if x[0].startswith(prefix)]
-    if debug_output:
-        print('Adding %d functions.' % (len(names)))
+    names = [x for x in sorted(vars(Quantity).items())
+             if x[0].startswith(prefix)]
     for f in names:
         name = f[0][len(prefix):]
-        math_functions[name] = (len(inspect.getfullargspec(f[1])[0]), f[1])
+        math_functions[name] = (f[1].__code__.co_argcount,
+                                operator.methodcaller(f[0]))
+
+
+def set_trace_sink(sink):
+    """
+    Send trace events to the given sink, or stop tracing if it is None.
 
+    The sink is called with each ucal_trace.TraceEvent, from any thread.
 
-def parse_value_at_start(text):
-    """Return the string of the value at the start, or None if not found."""
-    for pattern in valid_number_regex:
-        match = pattern.match(text)
-        if match:
-            assert text.startswith(match.group(0))
-            return match.group(0)
+    """
+    global tracer
+    tracer = sink
+
+
+def trace(kind, **fields):
+    """Send a trace event of the given kind to the sink, if any."""
+    sink = tracer
+    if sink is not None:
+        sink(ucal_trace.TraceEvent(kind, time.time(), threading.get_ident(),
+                                   fields))
+
+
+def get_backend(backend=None):
+    """Return the numeric backend with the given name, or the default."""
+    if backend is None:
+        backend = numeric_backend
+    if isinstance(backend, str):
+        if backend not in backends:
+            raise ValueError('Unknown numeric backend "%s"' % backend)
+        return backends[backend]
+    return backend
+
+
+def evaluate_value(text, backend=None):
+    """Evaluate the string value and return a number of the backend."""
+    backend = get_backend(backend)
+    prefix = text.lstrip('+-')[:2].lower()
+    if prefix == '0x' or prefix == '0b':
+        return backend.number(int(text, 0))
+    return backend.number(text)
+
+
+def match_operator(table, equation, i):
+    """Return the operator from the table found at equation[i], or None."""
+    for symbol in table.get(equation[i], ()):
+        if equation.startswith(symbol, i):
+            return symbol
     return None
 
 
-def parse_variable_at_start(text):
-    """Return the string of the variable at the start, or None if not found."""
-    if not text or not text[0] in starting_variable_characters:
-        return None
-    i = 1
-    while i < len(text) and text[i] in following_variable_characters:
-        i += 1
-    return text[:i]
+def tokenize(equation, backend=None):
+    """
+    Parse the equation into a validated list of (type, info) tokens.
 
+    This is done in a single pass.  Percent signs and implicit
+    multiplication are resolved and the token sequence is checked as tokens
+    are found.  Operators are replaced with their (order, function) info
+    and values are converted to a Quantity using the given numeric backend.
+    Variables and functions are left as names.
 
-def add_implicit_multiplication(tokens):
     """
-    Add implicit multiplication between tokens where necessary.
+    tokens, _, syntax_error = scan_tokens(equation, backend)
+    if syntax_error is not None:
+        raise ParserError(syntax_error)
+    return tokens
 
-    implicit parenthesis rules:
-    1) between a value and a variable:
-       7 mm -> 7 * mm
-    2) between a variable and a variable:
-       in lbs -> in * lbs
-    3) between a closing parenthesis and a variable
-       (2 * 12) mm -> (2 * 12) * mm
-    4) between parentheses
-       (8)(9) -> (8) * (9)
 
+def scan_tokens(equation, backend=None):
     """
-    added_any = False
+    Return (tokens, conversions, syntax_error) for the equation.
+
+    This does the work of tokenize(), but an invalid token sequence is
+    returned as the syntax_error message rather than raised, since the
+    equation may still be valid as a conversion such as "1 m in (ft)".
+
+    A conversion word ("to", "as" or "in") following a value outside of
+    parentheses may start a conversion clause.  For each of these which
+    splits the equation into a valid expression and target, conversions
+    holds (left_end, right_start, word_start, target_start, percentage),
+    where the expression is tokens[:left_end] and the target is
+    tokens[right_start:], and the positions of the word and the target in
+    the equation follow.  If percentage is True, the expression ends with a
+    % sign which is a percentage.  Only the last conversion of each word is
+    kept, in the order they should be tried.
+
+    While tracing, events are sent for the tokens, including those found
+    before an error is raised.
+
+    """
+    tokens = []
+    try:
+        return collect_tokens(equation, backend, tokens)
+    finally:
+        if tracer is not None:
+            trace_tokens(tokens)
+
+
+def collect_tokens(equation, backend, tokens):
+    """Add the tokens of the equation to the list, see scan_tokens()."""
+    backend = get_backend(backend)
+    percent = Quantity(value=backend.number('0.01'))
+    # type of the last token parsed from the equation
+    parsed_type = None
+    # type of the last token added, including implicit tokens
+    last_type = None
+    # index of a % sign which may turn out to be a percent sign
+    percent_index = None
+    # text of the first and last token
+    first_text = None
+    last_text = None
+    # parenthesis nesting level
+    level = 0
+    balanced = True
+    # message of the first invalid token sequence found
+    syntax_error = None
+    # index of the first and last tokens not allowed where they were found
+    first_error = None
+    last_error = None
+    # possible conversion clauses found
+    candidates = []
+    # (left_end, word_start, word) of a conversion word just added
+    conversion = None
     i = 0
-    rules = implicit_multiplication_rules
-    while i < len(tokens) - 1:
-        if tokens[i][0] in rules and tokens[i + 1][0] in rules[tokens[i][0]]:
-            if debug_output:
-                if not added_any:
-                    print('Adding implicit parentheses:')
-                    added_any = True
-            if debug_output:
-                print('- adding implicit * between %s and %s'
-                      % (tokens[i], tokens[i + 1]))
-            tokens.insert(i + 1, ['infix_op', '*'])
-        i += 1
-    if debug_output:
-        if added_any:
-            print('- we now have %d tokens' % len(tokens))
-            print('  ' + ' '.join(x[1] for x in tokens))
-            print('  ' + ' '.join('^' * len(x[1]) for x in tokens))
-
-
-def parse_to_tokens(equation):
-    """Take the equation and parse it into tokens."""
-    if debug_output:
-        print('\nParsing equation "%s"' % equation)
-    # set to true if a value immediately preceded the current character
-    parsed_values = []
-    while equation:
-        if debug_output:
-            print('-->', equation, parsed_values)
-        # trim equation if necessary
-        if equation and equation[0].isspace():
-            equation = equation.lstrip()
-            continue
-        # see if a value immediately preceeded this position
-        if not parsed_values:
-            value_before = False
+    length = len(equation)
+    while True:
+        # skip whitespace
+        while i < length and equation[i].isspace():
+            i += 1
+        if i == length:
+            break
+        start = i
+        character = equation[i]
+        value_before = parsed_type in value_token_types
+        operator = None
+        if character == '(':
+            this_type = Token.opening_parenthesis
+            text = character
+        elif character == ')':
+            this_type = Token.closing_parenthesis
+            text = character
         else:
-            if (parsed_values[-1][0] == Token.closing_parenthesis or
-                    parsed_values[-1][0] == Token.variable or
-                    parsed_values[-1][0] == Token.value or
-                    parsed_values[-1][0] == Token.postfix_operator):
-                value_before = True
+            # look for infix operator if value was preceeding
+            if value_before:
+                operator = match_operator(infix_operator_table, equation, i)
+            if operator is not None:
+                this_type = Token.infix_operator
+                text = operator
             else:
-                value_before = False
-        # look for parenthesis
-        if equation.startswith('('):
-            parsed_values.append([Token.opening_parenthesis, '('])
-            equation = equation[1:]
+                # try to parse a variable or function, then a value
+                match = variable_regex.match(equation, i)
+                if match:
+                    text = match.group(0)
+                    if equation.startswith('(', match.end()):
+                        this_type = Token.function
+                    else:
+                        this_type = Token.variable
+                else:
+                    match = valid_number_regex.match(equation, i)
+                    if match:
+                        text = match.group(0)
+                        this_type = Token.value
+                    else:
+                        # look for a postfix operator if value was
+                        # preceeding and a prefix operator otherwise
+                        if value_before:
+                            this_type = Token.postfix_operator
+                            operator = match_operator(postfix_operator_table,
+                                                      equation, i)
+                        else:
+                            this_type = Token.prefix_operator
+                            operator = match_operator(prefix_operator_table,
+                                                      equation, i)
+                        if operator is None:
+                            message = ('Symbol "%s" is not recognized'
+                                       % character)
+                            raise ParserError(message, equation[i:])
+                        text = operator
+        i += len(text)
+        parsed_type = this_type
+        # a % sign before a conversion word is a percentage
+        percent_before = percent_index is not None
+        # a % sign following a value and followed by an infix operator or
+        # closing parenthesis is a percentage, which becomes "* 0.01"
+        if percent_index is not None:
+            if (this_type == Token.infix_operator or
+                    this_type == Token.closing_parenthesis):
+                tokens[percent_index] = (Token.infix_operator,
+                                         infix_operators['*'])
+                tokens.append((Token.value, percent))
+                last_type = Token.value
+            percent_index = None
+        # the target of a conversion starts with the token after the word
+        if conversion is not None:
+            left_end, word_start, word, percentage = conversion
+            right = len(tokens)
+            if (last_type in implicit_multiplication_rules and
+                    this_type in implicit_multiplication_rules[last_type]):
+                right += 1
+            candidates.append((word, left_end, right, word_start, start,
+                               percentage))
+            conversion = None
+        left_end = len(tokens)
+        # add implicit multiplication where necessary
+        if (last_type in implicit_multiplication_rules and
+                this_type in implicit_multiplication_rules[last_type]):
+            if Token.infix_operator not in token_can_follow[last_type]:
+                syntax_error = 'Invalid syntax'
+                if first_error is None:
+                    first_error = len(tokens)
+                last_error = len(tokens)
+            tokens.append(implicit_multiplication_token)
+            last_type = Token.infix_operator
+        # check this token may follow the previous one
+        if last_type is not None:
+            if this_type not in token_can_follow[last_type]:
+                syntax_error = 'Invalid syntax'
+                if first_error is None:
+                    first_error = len(tokens)
+                last_error = len(tokens)
+        # a conversion word following a value may start a conversion
+        if (this_type == Token.variable and text in conversion_words and
+                (value_before or percent_before) and level == 0):
+            conversion = (left_end, start, text, percent_before)
+        # add this token
+        if this_type == Token.value:
+            info = Quantity(value=evaluate_value(text, backend))
+        elif this_type == Token.infix_operator:
+            if text == '%' and last_type == Token.value:
+                percent_index = len(tokens)
+            info = infix_operators[text]
+        elif this_type == Token.prefix_operator:
+            info = prefix_operators[text]
+        elif this_type == Token.postfix_operator:
+            info = postfix_operators[text]
+        else:
+            info = text
+            if this_type == Token.opening_parenthesis:
+                level += 1
+            elif this_type == Token.closing_parenthesis:
+                level -= 1
+                if level < 0:
+                    balanced = False
+        tokens.append((this_type, info))
+        last_type = this_type
+        if first_text is None:
+            first_text = text
+        last_text = text
+    # a trailing % sign following a value is a percentage
+    if percent_index is not None:
+        tokens[percent_index] = (Token.infix_operator, infix_operators['*'])
+        tokens.append((Token.value, percent))
+        last_text = '%'
+    # check for empty token list
+    if not tokens:
+        raise ParserError('Empty expression')
+    # check for balanced parenthesis
+    if not balanced or level != 0:
+        raise ParserError('Unbalanced parentheses')
+    # check for correct starting token
+    if tokens[0][0] not in token_can_start:
+        raise ParserError('Invalid starting token "%s"' % first_text,
+                          [tokens[0][0], token_text(tokens[0])])
+    # check for correct ending token
+    if tokens[-1][0] not in token_can_end:
+        raise ParserError('Invalid ending token "%s"' % last_text,
+                          [tokens[-1][0], token_text(tokens[-1])])
+    # keep the last conversion of each word which splits the equation into
+    # a valid expression and target
+    conversions = dict()
+    for candidate in candidates:
+        left_end, right = candidate[1:3]
+        if first_error is not None and first_error < left_end:
             continue
-        if equation.startswith(')'):
-            parsed_values.append([Token.closing_parenthesis, ')'])
-            equation = equation[1:]
+        if last_error is not None and last_error > right:
             continue
-        # look for infix operator if value was preceeding
-        if value_before:
-            found_operator = False
-            for operator in infix_operators.keys():
-                if equation.startswith(operator):
-                    found_operator = True
-                    parsed_values.append([Token.infix_operator,
-                                          operator])
-                    equation = equation[len(operator):]
-                    break
-            if found_operator:
-                continue
-        # try to parse a variable or function
-        result = parse_variable_at_start(equation)
-        if result is not None:
-            equation = equation[len(result):]
-            if equation and equation[0] == '(':
-                parsed_values.append([Token.function, result])
-            else:
-                parsed_values.append([Token.variable, result])
+        if tokens[right][0] not in token_can_start:
             continue
-        # try to parse a value
-        result = parse_value_at_start(equation)
-        if result is not None:
-            parsed_values.append([Token.value, result])
-            equation = equation[len(result):]
+        conversions[candidate[0]] = candidate[1:]
+    conversions = [conversions[x] for x in conversion_words
+                   if x in conversions]
+    return tokens, conversions, syntax_error
+
+
+def token_text(token):
+    """Return the text of the token for trace events and errors."""
+    kind, info = token
+    if isinstance(info, tuple):
+        # operators are held as (precedence, function)
+        for table in (infix_operators, prefix_operators, postfix_operators):
+            for symbol, value in table.items():
+                if value is info:
+                    return symbol
+    return str(info)
+
+
+def trace_tokens(tokens):
+    """Send trace events for the tokens found by scan_tokens()."""
+    for i, token in enumerate(tokens):
+        if token is implicit_multiplication_token:
+            trace('implicit-multiply-inserted', index=i)
+        trace('token-emitted', index=i, type=token[0],
+              text=token_text(token))
+
+
+def lookup_unit(name, backend=None):
+    """
+    Return the Quantity defined for the given unit in the given backend.
+
+    Values are usually held as a Decimal in unit_def.  For other backends
+    they are converted when first used, except that backends which are exact
+    evaluate imported unit definitions again so that "1 / 12 ft" remains
+    exact.  Raise KeyError if the unit is undefined.
+
+    """
+    backend = get_backend(backend)
+    quantity = unit_def[name]
+    if type(quantity.value) is backend.number_type:
+        return quantity
+    stamp = unit_def.stamps[name]
+    table = backend_unit_def.setdefault(backend.name, dict())
+    entry = table.get(name)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    source = unit_source.get(name)
+    if backend.exact and source is not None and source[1] == stamp:
+        if source[0] is None:
+            value = Quantity(value=backend.number(1),
+                             units=quantity.units)
+        else:
+            value = calculate(source[0], backend)
+    else:
+        value = convert_quantity(quantity, backend)
+    table[name] = (stamp, value)
+    return value
+
+
+def convert_quantity(quantity, backend):
+    """Return the Quantity with its value held by the given backend."""
+    if type(quantity.value) is backend.number_type:
+        return quantity
+    value = quantity.backend.to_decimal(quantity.value)
+    return Quantity(value=backend.from_decimal(value), units=quantity.units)
+
+
+def parse_equation(equation, backend, variables=None):
+    """
+    Return (tokens, variable_names, conversions, syntax_error) for the
+    equation, with units bound, from the token cache if possible.
+
+    Each conversion is (left, expression, target, dimension) for a clause
+    such as "1 ft in m", where left holds the tokens of the expression and
+    dimension is that of the target, or None for a number base such as
+    "hex".  Only targets which are valid units are
+    kept.  The syntax_error is the message of an invalid token sequence,
+    which only matters if no conversion is used.
+
+    """
+    key = (backend.name, TokenCache.normalize(equation))
+    entry = token_cache.get(key, variables)
+    if entry is not None:
+        if tracer is not None:
+            # scan again so that the trace is the same as on a cache miss
+            scan_tokens(key[1], backend)
+        return entry
+    text = key[1]
+    tokens, candidates, syntax_error = scan_tokens(text, backend)
+    # replace all units with proper values
+    units_in_equation = []
+    for i, x in enumerate(tokens):
+        if (x[0] == Token.variable and
+                not (variables and x[1] in variables) and is_unit(x[1])):
+            units_in_equation.append(x[1])
+            tokens[i] = (Token.value, lookup_unit(x[1], backend))
+    # find the units of each target, which are parsed with the equation
+    conversions = []
+    for candidate in candidates:
+        left_end, right_start, word_start, target_start, percentage = candidate
+        left = tokens[:left_end]
+        if percentage:
+            left[-1] = (Token.infix_operator, infix_operators['*'])
+            left.append((Token.value,
+                         Quantity(value=backend.number('0.01'))))
+        expression = text[:word_start].rstrip()
+        target = text[target_start:]
+        if target.lower() in number_base_targets:
+            conversions.append((left, expression, target.lower(), None))
             continue
-        # look for prefix operators if value was not immediately preceeding
-        if not value_before:
-            found_operator = False
-            for operator in prefix_operators.keys():
-                if equation.startswith(operator):
-                    found_operator = True
-                    parsed_values.append([Token.prefix_operator,
-                                          operator])
-                    equation = equation[len(operator):]
-                    break
-            if found_operator:
-                continue
-        # look for postfix operator if value was preceeding
-        if value_before:
-            found_operator = False
-            for operator in postfix_operators.keys():
-                if equation.startswith(operator):
-                    found_operator = True
-                    parsed_values.append([Token.postfix_operator,
-                                          operator])
-                    equation = equation[len(operator):]
-                    break
-            if found_operator:
-                continue
-        # we don't know what to do here
-        message = 'Symbol "%s" is not recognized' % equation[0]
-        raise ParserError(message, equation)
-    if debug_output:
-        print('- found %d tokens' % (len(parsed_values)))
-        print('- ' + ' '.join(x[1] for x in parsed_values))
-        print('- ' + ' '.join('^' * len(x[1]) for x in parsed_values))
-    return parsed_values
-
-
-def evaluate_flat_tokens(tokens):
-    """Evaluate the given non-parenthesis tokens."""
-    if debug_output:
-        print('Evaluating tokens ', tokens)
+        right = tokens[right_start:]
+        if any(x[0] == Token.variable for x in right):
+            continue
+        try:
+            dimension = evaluate_tokens(right).units
+        except (QuantityError, ParserError):
+            continue
+        conversions.append((left, expression, target, dimension))
+    return token_cache.put(key, tokens, units_in_equation,
+                           tuple(conversions), syntax_error)
+
+
+def bind_variables(tokens, equation, variables, backend):
+    """Return the tokens with each variable replaced by its value."""
     tokens = list(tokens)
-    # ensure no parenthesis are present
-    assert not any(x[0] == Token.opening_parenthesis for x in tokens)
-    assert not any(x[0] == Token.closing_parenthesis for x in tokens)
-    # evaluate functions
-    function_indices = [i
-                        for i, x in enumerate(tokens)
-                        if x[0] == Token.function]
-    for i in reversed(function_indices):
-        if tokens[i][1] not in math_functions:
-            message = 'Function "%s" not recognized' % (tokens[i][1])
-            raise ParserError(message)  # 'Unrecognized function', message)
-        this_function = math_functions[tokens[i][1]]
-        if this_function[0] != 1:
-            message = 'Functions with 2+ arguments not supported'
-            raise ParserError(message)  # 'Invalid function', message)
-        this_value = this_function[1](tokens[i + 1][1])
-        del tokens[i + 1]
-        tokens[i] = [Token.value, this_value]
-    # evaluate exponentiation from right to left
-    for i in reversed(range(1, len(tokens))):
-        if (tokens[i][0] == Token.infix_operator and
-                tokens[i][1][-1] == Quantity.__pow__):
-            assert tokens[i - 1][0] == Token.value
-            assert tokens[i + 1][0] == Token.value
-            tokens[i - 1: i + 2] = [[Token.value,
-                                     tokens[i][1][-1](tokens[i - 1][1],
-                                                      tokens[i + 1][1])]]
-        elif (tokens[i][0] == Token.postfix_operator and
-                tokens[i][1][-1] == Quantity.factorial):
-            assert tokens[i - 1][0] == Token.value
-            tokens[i - 1: i + 1] = [[Token.value,
-                                     tokens[i][1][-1](tokens[i - 1][1])]]
-    # evaluate everything else left to right
-    while len(tokens) > 1:
-        # get the lowest order of operations present in the equation and
-        # evaluate them
-        this_order = min(x[1][0]
-                         for x in tokens
-                         if (x[0] == Token.infix_operator or
-                             x[0] == Token.prefix_operator))
-        i = 0
-        while i < len(tokens):
-            if (tokens[i][0] == Token.prefix_operator and
-                    tokens[i][1][0] == this_order):
-                assert tokens[i + 1][0] == Token.value
-                tokens[i: i + 2] = [[Token.value,
-                                     tokens[i][1][-1](tokens[i + 1][1])]]
-            elif (tokens[i][0] == Token.infix_operator and
-                  tokens[i][1][0] == this_order):
-                assert tokens[i - 1][0] == Token.value
-                assert tokens[i + 1][0] == Token.value
-                tokens[i - 1: i + 2] = [[Token.value,
-                                         tokens[i][1][-1](tokens[i - 1][1],
-                                                          tokens[i + 1][1])]]
-                i -= 1
-            i += 1
-    # at this point, it should be a single value
-    assert len(tokens) == 1
-    assert tokens[0][0] == Token.value
-    assert isinstance(tokens[0][1], Quantity)
-    return tokens[0][1]
+    for i, x in enumerate(tokens):
+        if x[0] != Token.variable:
+            continue
+        if not variables or x[1] not in variables:
+            # variable not recognized
+            raise ParserError(undefined_message(x[1]), equation)
+        tokens[i] = (Token.value, convert_quantity(variables[x[1]], backend))
+    return tokens
+
+
+def calculate(equation, backend=None, variables=None, profile=None):
+    """
+    Evaluate the string equation and return the result as a Quantity.
+
+    Values are held by the given numeric backend, or by the default one
+    given by numeric_backend.  Names found in the given variables dict are
+    bound to their value, in place of any unit of the same name.  If an
+    EvaluationProfile is given, the time of each stage is added to it.
+
+    """
+    backend = get_backend(backend)
+    tokens, names, _, syntax_error = parse_equation(equation, backend,
+                                                    variables)
+    if profile is not None:
+        profile.mark('parse', tokens)
+    if syntax_error is not None:
+        raise ParserError(syntax_error)
+    if names:
+        tokens = bind_variables(tokens, equation, variables, backend)
+        if profile is not None:
+            profile.mark('bind')
+    result = evaluate_tokens(tokens)
+    if profile is not None:
+        profile.mark('evaluate')
+    return result
+
+
+def calculate_conversion(equation, backend=None, variables=None,
+                         profile=None):
+    """
+    Return (result, target_units) for an equation such as "1 ft in m".
+
+    The equation is parsed once, along with any conversion clause.  A
+    clause is used if its target has the same units as the result, or is a
+    number base such as "hex", else the equation is evaluated as a whole,
+    as for "1 in kg".  If there is no clause, target_units is None.  If an
+    EvaluationProfile is given, the time of each stage is added to it.
+
+    """
+    backend = get_backend(backend)
+    tokens, names, conversions, syntax_error = parse_equation(
+        equation, backend, variables)
+    if profile is not None:
+        profile.mark('parse', tokens)
+    for i, (left, _, target, dimension) in enumerate(conversions):
+        if profile is not None and i:
+            # time spent on a clause which was not used
+            profile.mark('convert')
+        if names:
+            if any(x[0] == Token.variable and
+                   not (variables and x[1] in variables) for x in left):
+                continue
+            left = bind_variables(left, equation, variables, backend)
+        try:
+            result = evaluate_tokens(left)
+        except (QuantityError, ParserError):
+            continue
+        if dimension is None or result.units is dimension:
+            if profile is not None:
+                profile.mark('evaluate')
+            return result, target
+    if profile is not None and conversions:
+        profile.mark('convert')
+    if syntax_error is not None:
+        raise ParserError(syntax_error)
+    if names:
+        tokens = bind_variables(tokens, equation, variables, backend)
+        if profile is not None:
+            profile.mark('bind')
+    result = evaluate_tokens(tokens)
+    if profile is not None:
+        profile.mark('evaluate')
+    return result, None
+
+
+class ExpressionNode:
+    """
+    An ExpressionNode is one node of a parsed expression tree.
+
+    A node is either a constant (value is a Quantity), a variable (name is
+    set) or an operation (function is applied to the nodes in arguments).
+
+    """
+
+    def __init__(self, value=None, name=None, function=None, arguments=()):
+        """Initialize."""
+        self.value = value
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+
+    def __repr__(self):
+        if self.name is not None:
+            return 'ExpressionNode(%s)' % self.name
+        if self.function is None:
+            return 'ExpressionNode(%s)' % self.value
+        return 'ExpressionNode(%s, %s)' % (getattr(self.function,
+                                                   '__name__',
+                                                   self.function),
+                                           self.arguments)
+
+
+def build_expression_tree(tokens):
+    """
+    Return the root ExpressionNode of the given tokens.
+
+    Tokens must have been through tokenize().  Values become constants and
+    variables which have not been replaced with values remain variables.
+
+    The tree is built in a single pass with the shunting-yard algorithm.
+    Operators with a lower order of operations bind more tightly, and an
+    operator stays on the stack while an incoming operator may be part of
+    its right operand.  This is the case when the incoming order is at most
+    the order of the stacked operator minus one, or at most its order if it
+    is right-associative, so that "2^3^2" is "2^(3^2)" and "3^2!" is
+    "3^(2!)".
+
+    """
+    # stack of operand nodes
+    output = []
+    # stack of (type, info, highest_order_of_right_operand) for operators
+    # and (type, None, None) for opening parentheses
+    operators = []
+
+    def reduce():
+        """Apply the operator at the top of the stack to its operands."""
+        kind, info, _ = operators.pop()
+        if kind == Token.infix_operator:
+            right = output.pop()
+            output[-1] = ExpressionNode(function=info[1],
+                                        arguments=(output[-1], right))
+        else:
+            output[-1] = ExpressionNode(function=info[1],
+                                        arguments=(output[-1],))
+
+    def reduce_below(order):
+        """Apply stacked operators whose right operand ends before order."""
+        while operators and operators[-1][2] is not None and (
+                order > operators[-1][2]):
+            reduce()
+
+    for kind, info in tokens:
+        if kind == Token.value:
+            output.append(ExpressionNode(value=info))
+        elif kind == Token.variable:
+            output.append(ExpressionNode(name=info))
+        elif kind == Token.opening_parenthesis:
+            operators.append((kind, None, None))
+        elif kind == Token.closing_parenthesis:
+            reduce_below(math.inf)
+            operators.pop()
+            # apply a function to its parenthesis group
+            if operators and operators[-1][0] == Token.function:
+                function = operators.pop()[1]
+                output[-1] = ExpressionNode(function=function,
+                                            arguments=(output[-1],))
+        elif kind == Token.function:
+            if info not in math_functions:
+                message = 'Function "%s" not recognized' % info
+                raise ParserError(message)
+            this_function = math_functions[info]
+            if this_function[0] != 1:
+                message = 'Functions with 2+ arguments not supported'
+                raise ParserError(message)
+            operators.append((kind, this_function[1], None))
+        elif kind == Token.prefix_operator:
+            operators.append((kind, info, info[0] - 1))
+        elif kind == Token.postfix_operator:
+            reduce_below(info[0])
+            output[-1] = ExpressionNode(function=info[1],
+                                        arguments=(output[-1],))
+        else:
+            assert kind == Token.infix_operator
+            reduce_below(info[0])
+            if info[1] in right_associative_operators:
+                operators.append((kind, info, info[0]))
+            else:
+                operators.append((kind, info, info[0] - 1))
+    reduce_below(math.inf)
+    assert not operators
+    assert len(output) == 1
+    return output[0]
+
+
+# messages of the errors raised by the float and fraction backends
+number_error_messages = {
+    ValueError: 'The value is outside the domain of the function.',
+    ZeroDivisionError: 'Division by zero.',
+    OverflowError: 'The result is too large to hold.'}
+
+
+@contextlib.contextmanager
+def number_errors():
+    """
+    Raise errors of float and Fraction operations as a QuantityError.
+
+    Errors of the decimal backend, which are also ArithmeticError, are
+    raised unchanged.
+
+    """
+    try:
+        yield
+    except tuple(number_error_messages) as error:
+        if isinstance(error, decimal.DecimalException):
+            raise
+        for error_type, message in number_error_messages.items():
+            if isinstance(error, error_type):
+                raise QuantityError('Invalid value', message)
+        raise
+
+
+def check_finite(result):
+    """Return the Quantity, or raise a QuantityError if it is not finite."""
+    if type(result.value) is float and not math.isfinite(result.value):
+        raise QuantityError('Invalid value',
+                            'The result is too large to hold.', result)
+    return result
+
+
+def evaluate_tree(root):
+    """Return the value of the given ExpressionNode as a Quantity."""
+    values = []
+    # stack of (node, True if its arguments have been evaluated)
+    pending = [(root, False)]
+    with number_errors():
+        while pending:
+            node, ready = pending.pop()
+            if node.function is None:
+                if node.name is not None:
+                    message = 'Variable "%s" is undefined.' % node.name
+                    raise ParserError(message)
+                values.append(node.value)
+            elif ready:
+                count = len(node.arguments)
+                arguments = values[-count:]
+                del values[-count:]
+                values.append(node.function(*arguments))
+            else:
+                pending.append((node, True))
+                pending.extend((x, False) for x in reversed(node.arguments))
+    assert len(values) == 1
+    return check_finite(values[0])
 
 
 def evaluate_tokens(tokens):
     """Return the result of the given equation as a Quantity."""
-    if debug_output:
-        print('\nstart of calculate2:')
-        for x in tokens:
-            print(x)
-    # eliminate any parenthesis
-    tokens = list(tokens)
-    opening_index = []
-    found = True
-    while found:
-        found = False
-        # print tokens
-        for i, x in enumerate(tokens):
-            if x[0] == Token.opening_parenthesis:
-                opening_index.append(i)
-                found = True
-            elif x[1] == Token.closing_parenthesis:
-                # eliminate this parenthesis level
-                # print 'before ->', tokens
-                value = evaluate_flat_tokens(tokens[opening_index[-1] + 1:i])
-                tokens[opening_index[-1]:i + 1] = [[Token.value, value]]
-                # print 'after ->', tokens
-                opening_index = opening_index[:-1]
-                break
-    value = evaluate_flat_tokens(tokens)
+    if tracer is not None:
+        trace('evaluation-started', tokens=len(tokens))
+    value = evaluate_tree(build_expression_tree(tokens))
     assert isinstance(value, Quantity)
     return value
 
 
-def check_token_syntax(tokens):
-    """Check the syntax of the tokens and report any error found."""
-    if debug_output:
-        print('\nChecking token syntax')
-    # check for empty token list
-    if not tokens:
-        raise ParserError('Empty expression')
-    # check for balanced parenthesis
-    level = 0
-    for x in tokens:
-        if x[0] == Token.opening_parenthesis:
-            level += 1
-        if x[0] == Token.closing_parenthesis:
-            level -= 1
-            if level < 0:
-                raise ParserError('Unbalanced parentheses')
-    if level != 0:
-        raise ParserError('Unbalanced parentheses')
-    # check for correct starting token
-    if tokens[0][0] not in token_can_start:
-        raise ParserError('Invalid starting token "%s"' % (tokens[-1][-1]),
-                          tokens[0])
-    # check for correct starting token
-    if tokens[-1][0] not in token_can_end:
-        raise ParserError('Invalid ending token "%s"' % (tokens[-1][-1]),
-                          tokens[-1])
-    # check for valid token sequence
-    for i in range(1, len(tokens)):
-        if tokens[i][0] not in token_can_follow[tokens[i - 1][0]]:
-            raise ParserError('Invalid syntax')
-    if debug_output:
-        print('- passed')
-
-
-def interpret_percent_sign(tokens):
-    """
-    Interpret the % symbol as a percent sign or as an infix operator.
-
-    """
-    # the percent sign is allowed immediately following a number and must be
-    # followed by an infix operator, or be the last token
-    i = 1
-    while i < len(tokens):
-        if tokens[i - 1][0] == Token.value and tokens[i][1] == '%':
-            if debug_output:
-                print(i, tokens)
-            if (i == len(tokens) - 1 or
-                    (tokens[i + 1][0] == Token.infix_operator or
-                     tokens[i + 1][0] == Token.closing_parenthesis)):
-                if debug_output:
-                    print('Interpreted %% as percent sign at index %d' % i)
-                tokens[i][0] = Token.value
-                tokens[i][1] = '0.01'
-                tokens.insert(i, [Token.infix_operator, '*'])
-                if debug_output:
-                    print(tokens)
-                i += 1
-        i += 1
-
-
-def evaluate_value(text):
-    """Evaluate the string value and return a Decimal."""
-    if text[:2].lower() == '0x' or text[:2].lower() == '0b':
-        return decimal.Decimal(ast.literal_eval(text))
-    return decimal.Decimal(text)
-
-
-def calculate(equation):
+class CompiledExpression:
     """
-    Evaluate the string equation and return the result as a Quantity.
+    A CompiledExpression is an equation parsed once for repeated evaluation.
+
+    Units are looked up when the expression is compiled, constant
+    subexpressions are folded and identical subexpressions are shared, so
+    evaluate() only performs the remaining arithmetic.  Names which are not
+    defined units are left as variables and are bound when evaluate() is
+    called, or else to the variables of default_session such as "Ans".
+    Names given in variables are also left as variables, even if they are
+    defined units.
+
+    Usage:
+    >>> force = ucal.compile('mass * 9.80665 m/s^2')
+    >>> ucal.to_string(force.evaluate(mass=ucal.calculate('2 kg')))
+    '19.6133 N'
 
     """
-    # store units used by the equation
-    units_in_equation = []
-    # replace all constants with their actual values
-    # tokenize the equation
-    tokens = parse_to_tokens(equation)
-    # process % as a percent sign or as an infix operator
-    interpret_percent_sign(tokens)
-    # add implicit multiplication where necessary
-    add_implicit_multiplication(tokens)
-    # ensure syntax is valid
-    check_token_syntax(tokens)
-    # replace operators with their function info
-    for x in tokens:
-        if x[0] == Token.prefix_operator:
-            x[1] = prefix_operators[x[1]]
-        elif x[0] == Token.infix_operator:
-            x[1] = infix_operators[x[1]]
-        elif x[0] == Token.postfix_operator:
-            x[1] = postfix_operators[x[1]]
-    # convert each value to a Quantity
-    for x in tokens:
-        if x[0] == Token.value:
-            x[1] = Quantity(value=evaluate_value(x[1]))
-    # replace all variables and units with proper values
-    for x in tokens:
-        if x[0] == Token.variable:
-            # see if it's a unit
-            if x[1] in unit_def:
-                units_in_equation.append(x[1])
-                x[0] = Token.value
-                x[1] = unit_def[x[1]]
+
+    def __init__(self, equation, variables=(), backend=None):
+        """Initialize."""
+        self.equation = equation
+        self.backend = get_backend(backend)
+        # register values, with None for those computed during evaluation
+        self.registers = []
+        # list of (register, variable_name) to bind on evaluation
+        self.variables = []
+        # list of (register, function, argument_registers) to compute
+        self.instructions = []
+        # map a constant value, variable or operation to its register
+        self.register_of = dict()
+        tokens = tokenize(equation, self.backend)
+        # bind units now
+        for i, x in enumerate(tokens):
+            if (x[0] == Token.variable and x[1] not in variables and
+                    is_unit(x[1])):
+                tokens[i] = (Token.value, lookup_unit(x[1], self.backend))
+        self.result = self.add_node(build_expression_tree(tokens))
+
+    def is_constant(self, register):
+        """Return True if the given register is known at compile time."""
+        return self.registers[register] is not None
+
+    def add_register(self, key, value=None):
+        """Return a new register holding the given value."""
+        self.registers.append(value)
+        self.register_of[key] = len(self.registers) - 1
+        return len(self.registers) - 1
+
+    def add_constant(self, value):
+        """Return the register holding the given constant Quantity."""
+        key = ('constant', str(value.value), value.units)
+        if key in self.register_of:
+            return self.register_of[key]
+        return self.add_register(key, value)
+
+    def add_operation(self, function, arguments):
+        """Return the register holding the result of the given operation."""
+        # fold the operation if all of its arguments are constant
+        if all(self.is_constant(x) for x in arguments):
+            with number_errors():
+                value = function(*[self.registers[x] for x in arguments])
+            return self.add_constant(value)
+        key = ('operation', function, tuple(arguments))
+        if key in self.register_of:
+            return self.register_of[key]
+        register = self.add_register(key)
+        self.instructions.append((register, function, tuple(arguments)))
+        return register
+
+    @staticmethod
+    def find_factors(node):
+        """
+        Return the (node, is_divisor) factors of a chain of * and /.
+
+        Return None if the node is not a multiplication or division.
+
+        """
+        if (node.function != operator.mul and
+                node.function != operator.truediv):
+            return None
+        factors = []
+        pending = [(node, False)]
+        while pending:
+            this_node, inverted = pending.pop()
+            if this_node.function == operator.mul:
+                pending.append((this_node.arguments[1], inverted))
+                pending.append((this_node.arguments[0], inverted))
+            elif this_node.function == operator.truediv:
+                pending.append((this_node.arguments[1], not inverted))
+                pending.append((this_node.arguments[0], inverted))
+            else:
+                factors.append((this_node, inverted))
+        return factors
+
+    def add_node(self, root):
+        """Return the register holding the result of the given node."""
+        # map id(node) to the register holding its result
+        register_of_node = dict()
+        # stack of (node, children) where children is None until the
+        # node's children have been added
+        pending = [(root, None)]
+        while pending:
+            node, children = pending.pop()
+            if node.name is not None:
+                key = ('variable', node.name)
+                if key not in self.register_of:
+                    self.variables.append((self.add_register(key),
+                                           node.name))
+                register_of_node[id(node)] = self.register_of[key]
+            elif node.function is None:
+                register_of_node[id(node)] = self.add_constant(node.value)
+            elif children is None:
+                factors = self.find_factors(node)
+                if factors is None:
+                    children = node.arguments
+                else:
+                    children = [x[0] for x in factors]
+                pending.append((node, (children, factors)))
+                pending.extend((x, None) for x in children)
+            else:
+                children, factors = children
+                if factors is None:
+                    register = self.add_operation(
+                        node.function,
+                        [register_of_node[id(x)] for x in children])
+                else:
+                    register = self.add_product(
+                        [(register_of_node[id(x)], inverted)
+                         for x, inverted in factors])
+                register_of_node[id(node)] = register
+        return register_of_node[id(root)]
+
+    def add_product(self, factors):
+        """
+        Return the register holding the product of the given factors.
+
+        Factors are given as (register, is_divisor).  All constant factors
+        are folded together, so that "x * kg * m / s^2" evaluates
+        "kg * m / s^2" only once.
+
+        """
+        # combine the constant factors
+        one = Quantity(value=self.backend.number(1))
+        constant = None
+        variable_factors = []
+        for register, inverted in factors:
+            if not self.is_constant(register):
+                variable_factors.append((register, inverted))
+                continue
+            if constant is None:
+                constant = one
+            if inverted:
+                constant = constant / self.registers[register]
             else:
-                # variable not recognized
-                message = 'Variable "%s" is undefined.' % x[1]
-                raise ParserError(message, equation)
-    return evaluate_tokens(tokens)
+                constant = constant * self.registers[register]
+        if not variable_factors:
+            return self.add_constant(constant)
+        # multiply the remaining factors in their original order
+        register, inverted = variable_factors[0]
+        if inverted:
+            if constant is None:
+                constant = one
+            register = self.add_operation(
+                operator.truediv, [self.add_constant(constant), register])
+            constant = None
+        for other, inverted in variable_factors[1:]:
+            function = operator.truediv if inverted else operator.mul
+            register = self.add_operation(function, [register, other])
+        if constant is not None:
+            register = self.add_operation(
+                operator.mul, [register, self.add_constant(constant)])
+        return register
+
+    def evaluate(self, **variables):
+        """Return the result as a Quantity with the given variables bound."""
+        registers = list(self.registers)
+        for register, name in self.variables:
+            if name in variables:
+                registers[register] = variables[name]
+            elif name in unit_def:
+                registers[register] = lookup_unit(name, self.backend)
+            elif name in default_session.variables:
+                registers[register] = convert_quantity(
+                    default_session.variables[name], self.backend)
+            else:
+                raise ParserError(undefined_message(name), self.equation)
+        with number_errors():
+            for register, function, arguments in self.instructions:
+                registers[register] = function(*[registers[x]
+                                                 for x in arguments])
+        return check_finite(registers[self.result])
+
+
+def compile(equation, variables=(), backend=None):
+    """Return a CompiledExpression for repeated evaluation of the equation."""
+    return CompiledExpression(equation, variables, backend)
+
+
+def find_unit_cycle(names, dependencies):
+    """
+    Return a list of unit names which depend on each other in a cycle.
+
+    The dependencies function returns the names used by a given unit.  The
+    cycle is given from the unit first reached from the given names and
+    ends with that unit again, for example ['a', 'b', 'a'].  Return None if
+    there is no cycle.
+
+    """
+    # state of each unit: True while its dependencies are being visited,
+    # False once they are known not to be part of a cycle
+    visiting = dict()
+    for start in names:
+        if start in visiting:
+            continue
+        visiting[start] = True
+        path = [start]
+        children = [iter(dependencies(start))]
+        while path:
+            for child in children[-1]:
+                state = visiting.get(child)
+                if state is None:
+                    visiting[child] = True
+                    path.append(child)
+                    children.append(iter(dependencies(child)))
+                    break
+                if state:
+                    return path[path.index(child):] + [child]
+            else:
+                visiting[path.pop()] = False
+                children.pop()
+    return None
+
+
+def find_unit_names(tokens):
+    """Return the names of the variables in the tokens, in order."""
+    return tuple(collections.OrderedDict.fromkeys(
+        x[1] for x in tokens if x[0] == Token.variable))
+
+
+def get_unit_uses(name):
+    """Return the names of the units used by the definition of the unit."""
+    if name in unit_def.dependencies:
+        return unit_def.dependencies[name]
+    source = unit_source.get(name)
+    if (source is None or source[0] is None or
+            source[1] != unit_def.stamps.get(name)):
+        return ()
+    uses = unit_uses.get(name)
+    if uses is None:
+        uses = find_unit_names(tokenize(source[0]))
+        unit_uses[name] = uses
+    return uses
+
+
+def find_dependent_units(names):
+    """
+    Return the set of units which use any of the given units.
+
+    This includes units which use them through other units.
+
+    """
+    users = dict()
+    for unit in unit_def:
+        for other in get_unit_uses(unit):
+            users.setdefault(other, []).append(unit)
+    found = set()
+    stack = list(names)
+    while stack:
+        for unit in users.get(stack.pop(), ()):
+            if unit not in found:
+                found.add(unit)
+                stack.append(unit)
+    return found
+
+
+def define_units(definitions):
+    """
+    Add the given unit definitions to be resolved when first used.
+
+    The definitions are a dict such as {'ft': '12 in'}.  A ValueError is
+    raised, and no unit is added, if a definition uses a unit which is not
+    defined or if definitions use each other in a cycle.  Units which use a
+    unit being redefined are resolved again when next used.
+
+    """
+    definitions = dict(definitions)
+    # units with a prefix which are added with those given
+    prefixed = set()
+    tokens = dict()
+    dependencies = dict()
+    for name, definition in definitions.items():
+        tokens[name] = tokenize(definition)
+        dependencies[name] = find_unit_names(tokens[name])
+    for name in sorted(dependencies):
+        for other in dependencies[name]:
+            if other in dependencies or other in unit_def:
+                continue
+            # units with a prefix, such as "km", are added with the units
+            # which use them
+            split = split_prefixed_unit(
+                other, lambda x: x in dependencies or x in unit_def)
+            if len(split) != 1:
+                raise ValueError('Unit "%s" is defined as "%s" but "%s" is '
+                                 'not defined'
+                                 % (name, definitions[name], other))
+            prefixed.add(other)
+            definitions[other] = split[0]
+            tokens[other] = tokenize(split[0])
+            dependencies[other] = (split[0].split()[-1],)
+    with unit_lock:
+        # resolved units which use a redefined unit are added again
+        changed = [x for x in definitions if x in unit_def]
+        if changed:
+            for name in sorted(find_dependent_units(changed)):
+                if name in definitions or name in unit_def.pending:
+                    continue
+                definitions[name] = unit_source[name][0]
+                tokens[name] = tokenize(definitions[name])
+                dependencies[name] = find_unit_names(tokens[name])
+        cycle = find_unit_cycle(
+            sorted(dependencies),
+            lambda x: dependencies[x] if x in dependencies
+            else get_unit_uses(x))
+        if cycle:
+            raise ValueError('Unit definitions form a cycle: %s'
+                             % ' -> '.join(cycle))
+        for name, definition in definitions.items():
+            unit_def.defer(name, definition, tokens[name],
+                           dependencies[name])
+            unit_uses[name] = dependencies[name]
+        prefixed_units.difference_update(definitions)
+        prefixed_units.update(prefixed)
+
+
+def check_unit_name(name):
+    """Raise ValueError if the name cannot be defined as a unit."""
+    try:
+        valid = tokenize(name) == [(Token.variable, name)]
+    except (ParserError, TypeError, AttributeError):
+        valid = False
+    if not valid:
+        raise ValueError('"%s" is not a valid unit name' % (name,))
+    if name in base_units:
+        raise ValueError('"%s" is a base unit and cannot be redefined'
+                         % name)
+
+
+def define(name, definition):
+    """
+    Define a unit, or change the definition of a unit, at runtime.
+
+    The definition is checked now and resolved when the unit is first used.
+    Units which use a redefined unit are resolved again, and cached results
+    which depend on it are discarded.  A ValueError is raised, and nothing
+    is changed, if the name is not valid or the definition uses a unit
+    which is not defined.
+
+    Usage:
+    >>> define('furlong', '220 yd')
+    >>> interpret('1 furlong in m')
+    '201.168 m'
+
+    """
+    check_unit_name(name)
+    if not isinstance(definition, str):
+        raise ValueError('Unit "%s" must be defined by a string' % name)
+    define_units({name: definition})
+
+
+def load_pack(path):
+    """
+    Define the units of a unit pack file and return their names.
+
+    A pack is a TOML file, or a JSON file if its name ends in ".json",
+    with a table "units" of definitions such as {"furlong": "220 yd"}.  The
+    units are defined together as by define(), so they may use each other
+    in any order, and none of them is defined if any is invalid.
+
+    """
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            pack = json.load(f)
+    else:
+        if tomllib is None:
+            raise ValueError('Reading the TOML unit pack "%s" requires '
+                             'Python 3.11 or the tomli package' % path)
+        with open(path, 'rb') as f:
+            pack = tomllib.load(f)
+    units = pack.get('units') if isinstance(pack, dict) else None
+    if not isinstance(units, dict):
+        raise ValueError('Unit pack "%s" has no table "units"' % path)
+    for name, definition in units.items():
+        check_unit_name(name)
+        if not isinstance(definition, str):
+            raise ValueError('Unit "%s" in unit pack "%s" must be defined '
+                             'by a string' % (name, path))
+    define_units(units)
+    return list(units)
+
+
+def split_prefixed_unit(name, defined=None):
+    """
+    Return the definitions the name has as a unit written with a prefix.
+
+    For example, "km" gives ['1e3 m'] and "KiB" gives ['1024^1 B'].  More
+    than one definition means the name is ambiguous.  Conversion words and
+    the names of functions and number bases give no definitions.  The
+    defined function tells whether a unit without a prefix is defined, and
+    by default tests whether it is in unit_def.
+
+    """
+    # reserved words are never read as a unit, such as "as" for attoseconds
+    if (name in conversion_words or name.lower() in number_base_targets or
+            name in math_functions):
+        return []
+    if defined is None:
+        defined = unit_def.__contains__
+    definitions = []
+    for prefixes, stems, text in prefix_tables:
+        for prefix, power in prefixes.items():
+            stem = name[len(prefix):]
+            if name.startswith(prefix) and stem in stems and defined(stem):
+                definitions.append(text % (power, stem))
+    return definitions
+
+
+def define_prefixed_unit(name):
+    """
+    Define the unit if the name is that of a unit with a prefix.
+
+    Return True if it was defined.  The definition is kept in unit_def, so
+    the name is only split once.  Names which may be read as more than one
+    unit are not defined, and are added to ambiguous_units.
+
+    """
+    definitions = split_prefixed_unit(name)
+    if len(definitions) != 1:
+        if definitions:
+            ambiguous_units[name] = definitions
+            if tracer is not None:
+                trace('unit-ambiguous', unit=name, definitions=definitions)
+        return False
+    with unit_lock:
+        if name not in unit_def:
+            define_units({name: definitions[0]})
+            prefixed_units.add(name)
+    return True
+
+
+def is_unit(name):
+    """Return True if the name is a unit, defining it if it has a prefix."""
+    return name in unit_def or define_prefixed_unit(name)
+
+
+def undefined_message(name):
+    """Return the error message for a name which is not defined."""
+    if name in ambiguous_units:
+        return ('Unit "%s" is ambiguous and may be %s.'
+                % (name, ' or '.join('"%s"' % x
+                                     for x in ambiguous_units[name])))
+    return 'Variable "%s" is undefined.' % name
+
+
+def resolve_unit(name):
+    """Resolve the pending definition of the unit and any units it uses."""
+    # find pending units in the order they must be resolved, so that
+    # evaluating each definition never needs to resolve another
+    order = []
+    visited = {name}
+    stack = [(name, iter(unit_def.dependencies[name]))]
+    while stack:
+        for other in stack[-1][1]:
+            if other in unit_def.pending and other not in visited:
+                visited.add(other)
+                stack.append((other, iter(unit_def.dependencies[other])))
+                break
+        else:
+            order.append(stack.pop()[0])
+    with unit_context():
+        for unit in order:
+            definition, tokens = unit_def.pending[unit]
+            value = evaluate_tokens([(Token.value, unit_def[x[1]])
+                                     if x[0] == Token.variable else x
+                                     for x in tokens])
+            # verify the name is read as this unit
+            if verify_unit_conversions:
+                assert tokenize(unit) == [(Token.variable, unit)]
+            unit_def[unit] = value
+            unit_source[unit] = (definition, unit_def.stamps[unit])
+    if tracer is not None:
+        for unit in order:
+            trace('unit-resolved', unit=unit,
+                  definition=unit_source[unit][0], value=str(unit_def[unit]))
 
 
 def import_units():
-    """Read in and convert units from ucal_units."""
-    global unit_def
-    global natural_unit
-    # get the set of units to import
-    new_units = dict(ucal_units.units)
+    """Add the units from ucal_units, which are resolved when first used."""
     # add base unit definitions
     for i, unit_name in enumerate(base_units):
+        units = [0] * unit_count
+        units[i] = 1
         unit_def[unit_name] = Quantity(value=decimal.Decimal('1'),
-                                       units=[0.0] * unit_count)
-        unit_def[unit_name].units[i] = 1.0
-    # convert each unit to a Quantity
-    while new_units:
-        # print units.keys()
-        decoded_something = False
-        for key in list(new_units.keys()):
-            value = new_units[key]
-            tokens = parse_to_tokens(value)
-            add_implicit_multiplication(tokens)
-            # print key, value, tokens
-            # check to see if all variables are defined units
-            this_units = [x[1] in unit_def
-                          for x in tokens
-                          if x[0] == Token.variable]
-            # if not all units are defined, skip it for now
-            if this_units:
-                if not all(this_units):
-                    continue
-            # evaluate it and add this unit definition
-            unit_def[key] = calculate(value)
-            decoded_something = True
-            del new_units[key]
-        # if we couldn't decode anything, the remaining units are ill-defined
-        if not decoded_something:
-            print('ERROR: could not decode all units')
-            for x in sorted(new_units.keys()):
-                print('* %s: %s' % (x, new_units[x]))
-            raise ValueError
-    # verify that all unit definitions match units
-    if verify_unit_conversions:
-        for key, value in unit_def.items():
-            left = calculate(key)
-            assert left.units == value.units
+                                       units=units)
+        unit_source[unit_name] = (None, unit_def.stamps[unit_name])
+    define_units(ucal_units.units)
+
+
+# increment when a change to this file changes resolved unit definitions
+unit_cache_format = 2
+
+# names of the files written by save_unit_cache(), see unit_cache_path()
+unit_cache_pattern = re.compile(r'units-[0-9a-f]{8}\.json$')
+
+# seconds after which cache files which have not been used are removed,
+# which is long enough that other installs sharing the directory keep
+# theirs
+unit_cache_max_age = 30 * 24 * 3600
+
+
+def unit_cache_path():
+    """
+    Return the path of the unit cache file, or None if it is disabled.
+
+    The file name holds a hash of everything the resolved units depend on,
+    so that a change to the unit definitions or precision uses a new file.
+
+    """
+    if not unit_cache_directory:
+        return None
+    source = repr((unit_cache_format,
+                   sorted(ucal_units.units.items()),
+                   base_units,
+                   sorted(natural_unit.items()),
+                   working_precision_digits))
+    key = zlib.crc32(source.encode('utf-8'))
+    return os.path.join(unit_cache_directory, 'units-%08x.json' % key)
+
+
+def encode_quantity(quantity):
+    """Return the given Quantity as a list for the cache."""
+    return [str(quantity.value)] + [int(x) if x.denominator == 1 else str(x)
+                                    for x in quantity.units]
+
+
+def decode_quantity(item):
+    """Return the Quantity encoded by encode_quantity()."""
+    return Quantity(value=decimal.Decimal(item[0]),
+                    units=[fractions.Fraction(x) if isinstance(x, str) else x
+                           for x in item[1:]])
+
+
+def get_unit_table(names=None):
+    """
+    Return the given units, resolved, as a dict which may be saved as JSON.
+
+    By default the table holds the units of ucal_units and the base units.
+    The natural_unit_map is also included.
+
+    """
+    if names is None:
+        names = [x for x in unit_def
+                 if x in ucal_units.units or x in base_units]
+    table = dict()
+    table['units'] = dict()
+    for name in names:
+        value = encode_quantity(unit_def[name])
+        # only keep a definition which still matches the value
+        source = unit_source.get(name)
+        if source is None or source[1] != unit_def.stamps[name]:
+            source = (None, None)
+        table['units'][name] = [source[0]] + value
+    table['natural'] = [[value[0], value[1], encode_quantity(value[2])]
+                        for value in natural_unit_map.values()]
+    return table
+
+
+def set_unit_table(table):
+    """
+    Set the units held in a table returned by get_unit_table().
+
+    The table is checked before anything is changed.
+
+    """
+    units = [(name, item[0], decode_quantity(item[1:]))
+             for name, item in table['units'].items()]
+    natural = [(item[0], item[1], decode_quantity(item[2]))
+               for item in table['natural']]
+    for name, definition, value in units:
+        unit_def[name] = value
+        if definition is not None or name in base_units:
+            unit_source[name] = (definition, unit_def.stamps[name])
+    for name, measure, value in natural:
+        natural_unit_map[value.units] = (name, measure, value)
+
+
+def save_unit_cache(path):
+    """
+    Write the resolved unit definitions to the given cache file.
+
+    Cache files for other unit definitions in the same directory are
+    removed if they have not been used for unit_cache_max_age seconds.
+    Nothing is written if the directory is not writable.
+
+    """
+    table = get_unit_table()
+    # write to a temporary file first so that readers never see part of it
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'w') as f:
+            json.dump(table, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+    except OSError:
+        if tracer is not None:
+            trace('unit-cache-failed', path=path, operation='write')
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        return
+    prune_unit_cache(path)
+
+
+def prune_unit_cache(path):
+    """Remove the unused cache files in the directory of path."""
+    directory, current = os.path.split(path)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    oldest = time.time() - unit_cache_max_age
+    for name in names:
+        if name != current and unit_cache_pattern.match(name):
+            other = os.path.join(directory, name)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(other) < oldest:
+                    os.remove(other)
+
+
+def load_unit_cache(path):
+    """
+    Read resolved unit definitions from the given cache file.
+
+    Return True if they were loaded, or False if the file does not exist
+    or cannot be read, in which case nothing is changed.
+
+    """
+    try:
+        with open(path) as f:
+            set_unit_table(json.load(f))
+    except (OSError, ValueError, TypeError, KeyError, IndexError,
+            AttributeError, ArithmeticError):
+        if tracer is not None:
+            trace('unit-cache-failed', path=path, operation='read')
+        return False
+    return True
+
+
+def load_units():
+    """Resolve the unit definitions, using the unit cache if possible."""
+    path = unit_cache_path()
+    if path is not None and load_unit_cache(path):
+        # mark the file as used so that it is not pruned
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return
+    import_units()
+    create_natural_unit_map()
+    if path is not None:
+        save_unit_cache(path)
 
 
 def create_natural_unit_map():
     """Populate the natural_unit_map variable."""
     global natural_unit_map
-    # natural_unit_map[(1.0, 0.0, ...)] = ('m', 'length', evaluate('m'))
-    for key in sorted(natural_unit.keys()):
-        # get the units of this
-        value = calculate(key)
-        natural_unit_map[tuple(value.units)] = (key, natural_unit[key], value)
+    # natural_unit_map[Dimension((1, 0, ...))] = ('m', 'length', evaluate('m'))
+    with unit_context():
+        for key in sorted(natural_unit.keys()):
+            # get the units of this
+            value = calculate(key)
+            natural_unit_map[value.units] = (key, natural_unit[key], value)
+
+
+def get_dimension_index():
+    """Return the dimension_index, building it if units have changed."""
+    global dimension_index, dimension_index_version
+    with unit_lock:
+        if dimension_index_version != unit_def.version:
+            # units with a prefix are only listed with the listed prefixes,
+            # so that the index does not depend on which have been used
+            names = [x for x in unit_def if x not in prefixed_units]
+            for stem, prefixes in sorted(ucal_units.listed_prefixes.items()):
+                names.extend(prefix + stem for prefix in prefixes
+                             if is_unit(prefix + stem) and
+                             prefix + stem in prefixed_units)
+            index = dict()
+            # looking up each unit resolves any which are pending
+            for name in names:
+                quantity = unit_def[name]
+                index.setdefault(quantity.units, []).append(
+                    (quantity.value, name))
+            for units in index.values():
+                units.sort()
+            dimension_index = index
+            dimension_index_version = unit_def.version
+        return dimension_index
+
+
+def list_units(units):
+    """
+    Return the names of the units with the given dimension, by magnitude.
+
+    The units may be given as a string such as "m/s", a Quantity or a
+    Dimension.
+
+    Units written with a prefix, such as "kHz", are listed with the
+    prefixes given for them in ucal_units.listed_prefixes.
+
+    Usage:
+    >>> list_units('Hz')
+    ['Hz', 'kHz', 'MHz', 'GHz']
+
+    """
+    if isinstance(units, str):
+        units = calculate(units).units
+    elif isinstance(units, Quantity):
+        units = units.units
+    return [name for _, name in get_dimension_index().get(units, ())]
+
+
+def find_output_units(dimension):
+    """Return the (magnitudes, names, index) for get_output_units()."""
+    if dimension in natural_unit_map:
+        name, _, value = natural_unit_map[dimension]
+    else:
+        # use the shortest named unit with a magnitude of 1, if any
+        names = [x[1] for x in get_dimension_index().get(dimension, ())
+                 if x[0] == 1]
+        if not names:
+            return None
+        name = min(names, key=lambda x: (len(x), x))
+        value = unit_def[name]
+    units = [(value.value, name)]
+    if autoscale_output_units and is_unit(name):
+        # find the unit without a prefix, such as "bps" for "Mbps"
+        stem = name
+        for prefix in output_prefixes:
+            if (prefix and name.startswith(prefix) and
+                    name[len(prefix):] in unit_def and
+                    unit_def[name[len(prefix):]].units is dimension):
+                stem = name[len(prefix):]
+        stem_value = unit_def[stem].value
+        units = []
+        for prefix, power in output_prefixes.items():
+            other = prefix + stem
+            if not is_unit(other):
+                continue
+            value = unit_def[other]
+            if (value.units is dimension and
+                    value.value == stem_value.scaleb(power)):
+                units.append((value.value, other))
+        units.sort()
+    names = [x[1] for x in units]
+    return [x[0] for x in units], names, names.index(name)
+
+
+def get_output_units(dimension):
+    """
+    Return the units results of the given Dimension are written in.
+
+    This is (magnitudes, names, index), where the units are those of the
+    natural unit with any of the output_prefixes, sorted by magnitude, and
+    index is that of the natural unit.  Dimensions with no natural unit use
+    a unit with a magnitude of 1 if there is one, else this returns None.
+
+    """
+    entry = output_units.get(dimension)
+    if entry is not None and entry[0] != unit_def.version:
+        # only find the units again if one they may use has changed
+        names = entry[1]
+        if names is None or any(unit_def.stamps.get(x, 0) > entry[0]
+                                for x in names):
+            entry = None
+        else:
+            entry = (unit_def.version,) + entry[1:]
+            output_units[dimension] = entry
+    if entry is None:
+        units = find_output_units(dimension)
+        entry = (unit_def.version, find_output_dependencies(dimension),
+                 units)
+        output_units[dimension] = entry
+    return entry[2]
+
+
+def find_output_dependencies(dimension):
+    """
+    Return the names of the units get_output_units() may use for the given
+    Dimension, or None if it may use any unit.
+
+    """
+    if dimension not in natural_unit_map:
+        return None
+    name = natural_unit_map[dimension][0]
+    stems = set(name[len(prefix):] for prefix in output_prefixes
+                if name.startswith(prefix))
+    return set(prefix + stem
+               for prefix in output_prefixes for stem in stems)
 
 
 def get_measure(quantity):
@@ -819,21 +2428,16 @@ def get_measure(quantity):
     For example, get_measure('m') should return 'length'.
 
     """
-    check = tuple(quantity.units)
-    if check in natural_unit_map:
-        return natural_unit_map[check][1]
+    if quantity.units in natural_unit_map:
+        return natural_unit_map[quantity.units][1]
     return None
 
 
 def to_string(quantity, output_units=None, include_measure=False):
     """Convert the given Quantity to a string."""
-    if debug_output:
-        print('Converting "%s" with output_units=%s'
-              % (quantity, output_units))
-    # round exponents to the nearest 1e-5 to
-    # get rid of roundoff errors
-    quantity.units = [math.floor(x * 1.0e5 + 0.5) / 1.0e5
-                      for x in quantity.units]
+    backend = quantity.backend
+    # value is rounded to the current precision
+    rounding = decimal.Decimal('1.' + '0' * decimal.getcontext().prec)
     if include_measure:
         measure = get_measure(quantity)
         if measure:
@@ -844,123 +2448,562 @@ def to_string(quantity, output_units=None, include_measure=False):
         measure = ''
     # see if the output units match
     if (output_units in unit_def and
-            quantity.units == unit_def[output_units].units):
-        if debug_output:
-            print('- found match in unit definitions')
-        quantity.value /= unit_def[output_units].value
-        quantity.value *= decimal.Decimal(
-            '1.' + '0' * decimal.getcontext().prec)
-        value_str = str(quantity.value)
+            quantity.units is unit_def[output_units].units):
+        if tracer is not None:
+            trace('output-formatted', units=output_units, method='target')
+        value = backend.to_decimal(
+            quantity.value / lookup_unit(output_units, backend).value)
+        value_str = str(value * rounding)
         if '.' in value_str:
             value_str = value_str.rstrip('0').rstrip('.')
         return "%s %s%s" % (value_str, output_units, measure)
     elif isinstance(output_units, str):
-        units_quantity = calculate(output_units)
+        units_quantity = calculate(output_units, backend)
         if quantity.matches_units(units_quantity):
-            if debug_output:
-                print('- found match to derived output units')
-            quantity.value /= units_quantity.value
-            quantity.value *= decimal.Decimal(
-                '1.' + '0' * decimal.getcontext().prec)
-            value_str = str(quantity.value)
+            if tracer is not None:
+                trace('output-formatted', units=output_units,
+                      method='derived')
+            value = backend.to_decimal(
+                quantity.value / units_quantity.value)
+            value_str = str(value * rounding)
             if '.' in value_str:
                 value_str = value_str.rstrip('0').rstrip('.')
             return '%s %s%s' % (value_str, output_units, measure)
     # otherwise look for the default units for this type
-    key = tuple(quantity.units)
-    if key in natural_unit_map:
-        if debug_output:
-            print('- found match in unit_measure')
-        quantity.value /= natural_unit_map[key][2].value
-        quantity.value *= decimal.Decimal(
-            '1.' + '0' * decimal.getcontext().prec)
-        value_str = str(quantity.value)
+    key = quantity.units
+    scales = None if key is unitless else get_output_units(key)
+    if scales is not None:
+        magnitudes, names, index = scales
+        value = backend.to_decimal(quantity.value)
+        # choose the largest unit which gives a value of at least 1
+        if value and len(names) > 1:
+            index = bisect.bisect_right(magnitudes, abs(value * rounding))
+            index = max(index - 1, 0)
+        value_str = str(value / magnitudes[index] * rounding)
         if '.' in value_str:
             value_str = value_str.rstrip('0').rstrip('.')
-        return "%s %s%s" % (value_str, natural_unit_map[key][0], measure)
+        if tracer is not None:
+            trace('output-formatted', units=names[index], method='natural')
+        return "%s %s%s" % (value_str, names[index], measure)
     # or output in base SI units
-    quantity.value *= decimal.Decimal('1.' + '0' * decimal.getcontext().prec)
-    if debug_output:
-        print('- no match found, using base units')
+    quantity = Quantity(value=backend.to_decimal(quantity.value) * rounding,
+                        units=quantity.units)
+    if tracer is not None:
+        trace('output-formatted', units=None, method='base')
     return '%s%s' % (str(quantity), measure)
 
 
-def interpret(equation):
-    """Return the result of the equation which may include unit specifiers."""
-    # set high working precision
-    decimal.getcontext().prec = working_precision_digits
-    # set to True when we find an intepreted result
-    interpreted_result = False
-    # see if the equation is written in the form "x in y"
-    separators = ['to', 'as', 'in']
-    result = None
-    target_units = None
-    for word in separators:
-        word = ' ' + word + ' '
-        if word not in equation:
-            continue
-        possible_equation, possible_units = equation.rsplit(word, 1)
+def split_conversion(equation):
+    """
+    Return (equation, target_units) for an equation such as "x in y".
+
+    The target units are None if the equation has no valid conversion.  A
+    number base such as "hex" is given in lower case.
+
+    """
+    conversions = parse_equation(equation, get_backend())[2]
+    for _, expression, target, _ in conversions:
+        return expression, target
+    return equation, None
+
+
+# a result of evaluate_many(), where the value is a Quantity in base units,
+# dimension is its Dimension, units are the target units or None and text
+# is the result formatted as by interpret(); error is the name of the
+# exception raised, if any, and message is its message
+EvaluationResult = collections.namedtuple(
+    'EvaluationResult',
+    ['expression', 'value', 'dimension', 'units', 'text', 'error',
+     'message'])
+
+# functions called with the EvaluationProfile of each evaluation by a
+# Session while profiling() is in use
+profile_callbacks = ()
+
+# lock held while changing profile_callbacks
+profile_lock = threading.Lock()
+
+
+def perf_counter_ns():
+    """Return time.perf_counter() as a whole number of nanoseconds."""
+    return int(time.perf_counter() * 1000000000)
+
+
+class EvaluationProfile:
+    """
+    An EvaluationProfile holds the time taken by each stage of evaluating
+    one equation, and the size of the equation.
+
+    Times are in nanoseconds from time.perf_counter(), and stages holds
+    the total time of each stage that was reached, in order:
+
+    * parse: tokenizing and binding units, or finding them in the cache
+    * convert: trying conversion clauses such as "in ft" which were not used
+    * bind: binding variables
+    * evaluate: evaluating the expression
+    * format: writing the result as a string
+    * error: from the last stage until an exception was raised
+
+    The size is given by the number of tokens, the deepest nesting of
+    parentheses and the working precision.  If the evaluation raised an
+    exception, error is its name.
+
+    """
+
+    __slots__ = ('equation', 'stages', 'token_count', 'depth', 'precision',
+                 'cached', 'error', 'start', 'last', 'hits')
+
+    def __init__(self, equation):
+        """Initialize."""
+        self.equation = equation
+        self.stages = dict()
+        self.token_count = 0
+        self.depth = 0
+        self.precision = decimal.getcontext().prec
+        # True if the tokens were found in the token cache
+        self.cached = False
+        self.error = None
+        self.hits = token_cache.hits
+        self.start = self.last = perf_counter_ns()
+
+    def __repr__(self):
+        return 'EvaluationProfile(%r, %r)' % (self.equation, self.stages)
+
+    def mark(self, stage, tokens=None):
+        """
+        Add the time since the last mark to the given stage.
+
+        If tokens are given, the size of the equation is found from them.
+
+        """
+        now = perf_counter_ns()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+        if tokens is not None:
+            self.cached = token_cache.hits != self.hits
+            self.token_count = len(tokens)
+            level = 0
+            for kind, _ in tokens:
+                if kind == Token.opening_parenthesis:
+                    level += 1
+                    self.depth = max(self.depth, level)
+                elif kind == Token.closing_parenthesis:
+                    level -= 1
+
+    @property
+    def total_ns(self):
+        """Return the time from the start to the last mark."""
+        return self.last - self.start
+
+    def as_dict(self):
+        """Return the fields as a dict, such as to be written as JSON."""
+        return {'equation': self.equation,
+                'stages': dict(self.stages),
+                'total_ns': self.total_ns,
+                'token_count': self.token_count,
+                'depth': self.depth,
+                'precision': self.precision,
+                'cached': self.cached,
+                'error': self.error}
+
+
+def report_profile(profile, error=None):
+    """Pass the finished profile to each of the profile callbacks."""
+    if error is not None:
+        profile.mark('error')
+        profile.error = type(error).__name__
+    for callback in profile_callbacks:
+        callback(profile)
+
+
+@contextlib.contextmanager
+def profiling(callback=None):
+    """
+    Profile each evaluation by a Session within the block.
+
+    The callback is called with an EvaluationProfile after each equation
+    is evaluated by Session.interpret(), Session.calculate() or
+    evaluate_many(), in any thread.  If no callback is given, the profiles
+    are added to the list which is returned by the context manager.  While
+    no profiling is in use, this costs a single check per evaluation.
+
+    Usage:
+    >>> with profiling() as profiles:
+    ...     interpret('1 ft in m')
+    '0.3048 m'
+    >>> sorted(profiles[0].stages)
+    ['evaluate', 'format', 'parse']
+
+    """
+    global profile_callbacks
+    profiles = []
+    if callback is None:
+        callback = profiles.append
+    with profile_lock:
+        profile_callbacks = profile_callbacks + (callback,)
+    try:
+        yield profiles
+    finally:
+        with profile_lock:
+            callbacks = list(profile_callbacks)
+            callbacks.remove(callback)
+            profile_callbacks = tuple(callbacks)
+
+
+def local_context(digits):
+    """
+    Return a context manager for a local decimal context.
+
+    The context is a copy of the current one with the given precision and
+    the widest exponent range, so that values such as 1000000! do not
+    overflow.
+
+    """
+    context = decimal.getcontext().copy()
+    context.prec = digits
+    context.Emax = decimal.MAX_EMAX
+    context.Emin = decimal.MIN_EMIN
+    return decimal.localcontext(context)
+
+
+def unit_context():
+    """
+    Return a context manager for the decimal context units are resolved in.
+
+    This is a new context at the module working precision rather than a copy
+    of the current one, so that the value of a unit does not depend on the
+    context which happened to be active when it was first used.
+
+    """
+    return decimal.localcontext(decimal.Context(
+        prec=working_precision_digits, Emax=decimal.MAX_EMAX,
+        Emin=decimal.MIN_EMIN))
+
+
+class Session:
+    """
+    A Session evaluates equations with its own precision and variables.
+
+    The result of the last call to interpret() is held as the variable
+    "Ans", and other variables may be added to the variables dict.  All
+    arithmetic is done in a local decimal context, so that sessions may be
+    used from separate threads at the same time.  Precisions and the
+    numeric backend default to the module options if they are None.
+
+    Usage:
+    >>> session = ucal.Session(output_precision_digits=6)
+    >>> session.interpret('2 pi')
+    '6.28319'
+    >>> session.variables['r'] = session.calculate('3 m')
+    >>> session.interpret('Ans * r')
+    '18.8496 m'
+
+    """
+
+    def __init__(self, working_precision_digits=None,
+                 output_precision_digits=None, backend=None):
+        """Initialize."""
+        self.working_precision_digits = working_precision_digits
+        self.output_precision_digits = output_precision_digits
+        self.backend = backend
+        # values of variables by name, including "Ans"
+        self.variables = dict()
+
+    def working_context(self):
+        """Return a context manager for the working precision."""
+        return local_context(self.working_precision_digits or
+                             working_precision_digits)
+
+    def output_context(self):
+        """Return a context manager for the output precision."""
+        return local_context(self.output_precision_digits or
+                             output_precision_digits)
+
+    def calculate(self, equation, backend=None):
+        """Return the result of the equation as a Quantity."""
+        with self.working_context():
+            if not profile_callbacks:
+                return calculate(equation, backend or self.backend,
+                                 self.variables)
+            profile = EvaluationProfile(equation)
+            try:
+                result = calculate(equation, backend or self.backend,
+                                   self.variables, profile)
+            except Exception as error:
+                report_profile(profile, error)
+                raise
+            report_profile(profile)
+            return result
+
+    def find_result(self, equation, backend, profile=None):
+        """
+        Return (result, target_units) for the equation.
+
+        The equation may end with a conversion such as "in ft" or "in hex",
+        in which case target_units is the part after the separator, else it
+        is None.
+
+        """
+        return calculate_conversion(equation, backend, self.variables,
+                                    profile)
+
+    def format_result(self, result, target_units):
+        """Return the result found by find_result() as a string."""
+        if target_units == 'hex':
+            if not result.is_integer():
+                return 'only integers can be written as hex'
+            return '0x' + hex(int(result.value))[2:].upper()
+        elif target_units == 'bin' or target_units == 'binary':
+            if not result.is_integer():
+                return 'only integers can be written as binary'
+            return bin(int(result.value))
+        # round results for output
+        with self.output_context():
+            return to_string(+result, target_units)
+
+    def interpret(self, equation, backend=None):
+        """
+        Return the result of the equation which may include unit specifiers.
+
+        The result is also stored as "Ans".
+
+        """
+        backend = get_backend(backend or self.backend)
+        with self.working_context():
+            if not profile_callbacks:
+                result, target_units = self.find_result(equation, backend)
+                # save answer as "Ans"
+                self.variables['Ans'] = result
+                return self.format_result(result, target_units)
+            profile = EvaluationProfile(equation)
+            try:
+                result, target_units = self.find_result(equation, backend,
+                                                        profile)
+                self.variables['Ans'] = result
+                text = self.format_result(result, target_units)
+                profile.mark('format')
+            except Exception as error:
+                report_profile(profile, error)
+                raise
+            report_profile(profile)
+            return text
+
+    def evaluate_one(self, expression, units, backend, unit_values):
+        """Return the EvaluationResult for evaluate_many()."""
+        profile = None
         try:
-            result = calculate(possible_equation)
-            if possible_units.lower() == 'hex':
-                if not result.is_integer():
-                    return 'only integers can be written as hex'
-                result = hex(int(result.value.to_integral_value()))
-                result = '0x' + result[2:].upper()
-                unit_def['Ans'] = result
-                return result
-            elif (possible_units.lower() == 'bin' or
-                  possible_units.lower() == 'binary'):
-                if not result.is_integer():
-                    return 'only integers can be written as binary'
-                result = bin(int(result.value.to_integral_value()))
-                unit_def['Ans'] = result
+            with self.working_context():
+                if profile_callbacks:
+                    profile = EvaluationProfile(expression)
+                if units is None:
+                    result, target_units = self.find_result(
+                        expression, backend, profile)
+                else:
+                    result = calculate(expression, backend, self.variables,
+                                       profile)
+                    target_units = units
+                    if units not in unit_values:
+                        unit_values[units] = calculate(units, backend)
+                    if not result.matches_units(unit_values[units]):
+                        raise QuantityError('Inconsistent units', result,
+                                            unit_values[units])
+                text = self.format_result(result, target_units)
+                if profile is not None:
+                    profile.mark('format')
+        except Exception as error:
+            if profile is not None:
+                report_profile(profile, error)
+            message = error.args[0] if error.args else ''
+            if not isinstance(message, str):
+                # decimal exceptions hold a list of signals
+                message = type(error).__name__
+            return EvaluationResult(expression, None, None, None, None,
+                                    type(error).__name__, message)
+        if profile is not None:
+            report_profile(profile)
+        return EvaluationResult(expression, result, result.units,
+                                target_units, text, None, None)
+
+    def evaluate_many(self, expressions, units=None, backend=None,
+                      cache_size=4096):
+        """
+        Yield an EvaluationResult for each of the given expressions.
+
+        Expressions are read from the iterable as results are consumed, so
+        any number of them may be evaluated in constant memory.  Errors are
+        returned in the result rather than raised.  Results of the most
+        recent cache_size distinct expressions are reused for repeats, and
+        target units are evaluated once per call.  Expressions may use the
+        variables of the session but "Ans" is not changed.
+
+        """
+        backend = get_backend(backend or self.backend)
+        # results of recent expressions keyed by their normalized text
+        results = collections.OrderedDict()
+        # value of each target unit
+        unit_values = dict()
+        # unit_def version the results and unit values were found at
+        version = unit_def.version
+        for expression in expressions:
+            if unit_def.version != version:
+                results.clear()
+                unit_values.clear()
+                version = unit_def.version
+            key = TokenCache.normalize(expression)
+            record = results.get(key)
+            if record is not None:
+                results.move_to_end(key)
+                if record.expression != expression:
+                    record = record._replace(expression=expression)
+                yield record
+                continue
+            record = self.evaluate_one(expression, units, backend,
+                                       unit_values)
+            if cache_size > 0:
+                results[key] = record
+                if len(results) > cache_size:
+                    results.popitem(last=False)
+            if len(unit_values) > cache_size:
+                unit_values.clear()
+            yield record
+
+    def evaluate(self, equation, units=None, backend=None, **variables):
+        """Return the result of the equation as evaluate() does."""
+        backend = get_backend(backend or self.backend)
+        with self.working_context():
+            if variables:
+                return self.evaluate_with_variables(equation, units,
+                                                    variables, backend)
+            result = calculate(equation, backend, self.variables)
+            if units is not None:
+                # if units don't match, raise an error
+                unit_value = calculate(units, backend)
+                if not result.matches_units(unit_value):
+                    raise ParserError
+                result = Quantity(value=result.value / unit_value.value)
+        with self.output_context():
+            if units is None:
+                return to_string(+result)
+            return to_string(+result), units
+
+    def evaluate_with_variables(self, equation, units, variables, backend):
+        """Return the result of evaluate() with the given variables bound."""
+        # the equation may end with a conversion such as "in fps"
+        equation, target_units = split_conversion(equation)
+        if units is None:
+            units = target_units
+        bindings = dict(self.variables)
+        # QuantityArray, imported only if an array is bound
+        array_type = None
+        for name, value in variables.items():
+            if isinstance(value, int):
+                value = Quantity(value=backend.number(value))
+            elif isinstance(value, decimal.Decimal):
+                value = Quantity(value=backend.from_decimal(value))
+            elif isinstance(value, float):
+                value = Quantity(value=backend.number(repr(value)))
+            elif not isinstance(value, Quantity):
+                from ucal.ucal_array import QuantityArray as array_type
+                if not isinstance(value, array_type):
+                    value = array_type(value)
+            bindings[name] = value
+        result = CompiledExpression(equation, bindings,
+                                    backend).evaluate(**bindings)
+        # an array may be bound but not used, giving a single Quantity
+        is_array = array_type is not None and isinstance(result, array_type)
+        if units is not None and units.lower() in number_base_targets:
+            if is_array:
+                raise ParserError('Arrays cannot be written as %s'
+                                  % units.lower(), equation)
+            return self.format_result(result, units.lower()), units
+        if is_array:
+            if units is None:
                 return result
-            units_check = calculate(possible_units)
-            assert result.matches_units(units_check)
-            target_units = possible_units
-            interpreted_result = True
-            break
-        except (AssertionError, QuantityError, ParserError):
-            pass
-    # if we didn't find a result, calculate the entire equation
-    if not interpreted_result:
-        target_units = None
-        result = calculate(equation)
-    # save answer as "Ans"
-    unit_def['Ans'] = result
-    # round results for output
-    decimal.getcontext().prec = output_precision_digits
-    return to_string(+result, target_units)
+            return result.to(units), units
+        if units is not None:
+            unit_value = calculate(units, backend)
+            if not result.matches_units(unit_value):
+                raise ParserError
+            result = Quantity(value=result.value / unit_value.value)
+        with self.output_context():
+            if units is None:
+                return to_string(+result)
+            return to_string(+result), units
+
 
+# session used by the module-level interpret() and evaluate()
+default_session = Session()
 
-def evaluate(equation, units=None):
+
+def evaluate_many(expressions, units=None, backend=None, cache_size=4096,
+                  workers=None, chunk_size=1000, ordered=True):
+    """
+    Yield an EvaluationResult for each of the given expressions.
+
+    Expressions may include unit specifiers as with interpret(), or else
+    all results are converted to the given units.  Errors are held in the
+    error and message fields of the result rather than being raised.
+
+    If workers is given, expressions are evaluated in chunks of chunk_size
+    by that many processes (see ucal_parallel.py), and if ordered is False
+    the results of each chunk are yielded as soon as it is done.
+
+    Usage:
+    >>> for result in evaluate_many(['1 ft in in', '1 ft + 1 s']):
+    ...     print(result.text, result.error)
+    12 in None
+    None QuantityError
+
+    """
+    if workers:
+        from ucal import ucal_parallel
+        session = default_session
+        if backend is not None:
+            session = Session(backend=backend)
+            session.variables = default_session.variables
+        return ucal_parallel.evaluate_many(expressions, units, workers,
+                                           chunk_size, ordered, session)
+    return default_session.evaluate_many(expressions, units, backend,
+                                         cache_size)
+
+
+def interpret(equation, backend=None):
+    """
+    Return the result of the equation which may include unit specifiers.
+
+    Values are held by the given numeric backend, or by the default one
+    given by numeric_backend.  The result is stored as "Ans" in
+    default_session.
+
+    """
+    return default_session.interpret(equation, backend)
+
+
+def evaluate(equation, units=None, backend=None, **variables):
     """
     Evaluate the equation and return the result in the given units.
 
+    Other keyword arguments bind variables in the equation to a number, a
+    Quantity or a QuantityArray.  If any of them is a QuantityArray (or a
+    sequence, which is converted to one) the result is a QuantityArray, or
+    a NumPy array and the units if the units are given.  Units may also be
+    given within the equation as with interpret().  Values are held by the
+    given numeric backend, or by the default one given by numeric_backend.
+
     Usage:
     >>> evaluate('5km + 1mi')
     (6609.344, 'm')
     >>> evaluate('5km + 1mi', units='mi')
     (4.10685596118667, 'mi')
+    >>> evaluate('sqrt(2 * g * h) in fps', h=QuantityArray([1, 10], 'ft'))
+    (array([ 8.02172657, 25.36692672]), 'fps')
 
     """
-    # try to evaluate in the requested units
-    if units is not None:
-        unit_value = calculate(units)
-        value = calculate(equation)
-        # if units don't match, raise an error
-        if not value.matches_units(unit_value):
-            raise ParserError
-        result = Quantity(value=value.value / unit_value.value, units=None)
-        return to_string(result), units
-    # evaluate in any units
-    return to_string(+calculate(equation))
+    return default_session.evaluate(equation, units, backend, **variables)
 
 
 find_math_functions()
-import_units()
-create_natural_unit_map()
+load_units()
 
 if __name__ == "__main__":
     pass
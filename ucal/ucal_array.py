@@ -0,0 +1,354 @@
+"""
+The ucal_array module provides arrays of quantities backed by NumPy.
+
+A QuantityArray holds a NumPy array of values in base SI units along with a
+single set of unit exponents shared by every element.  Units are therefore
+checked once per operation and the arithmetic is done by NumPy.
+
+Usage:
+
+>>> import numpy
+>>> import ucal
+>>> heights = ucal.QuantityArray(numpy.array([1.0, 10.0, 30.0]), 'ft')
+>>> ucal.evaluate('sqrt(2 * g * h) in fps', h=heights)
+(array([ 8.02172657, 25.36692672, 43.93680591]), 'fps')
+
+"""
+
+import decimal
+import fractions
+import math
+
+import numpy
+
+from ucal import ucal
+from ucal.ucal_backends import backends
+
+# object arrays hold Decimal values
+decimal_backend = backends['decimal']
+
+# factorials of 0 to 170 as floats, larger ones overflow
+float_factorials = numpy.array([float(math.factorial(n))
+                                for n in range(171)])
+
+
+def vectorize_with_overflow(function):
+    """Return the float function for arrays, giving inf where it overflows."""
+    def call(x):
+        try:
+            return function(x)
+        except OverflowError:
+            return math.inf
+    vectorized = numpy.vectorize(call, otypes=[float])
+
+    def call_array(values):
+        # inf is the expected result, so numpy need not warn of it
+        with numpy.errstate(over='ignore'):
+            return vectorized(values)
+    return call_array
+
+
+float_gamma = vectorize_with_overflow(math.gamma)
+float_lgamma = vectorize_with_overflow(math.lgamma)
+
+
+class QuantityArray:
+    """A QuantityArray is an array of numbers sharing the same units."""
+
+    def __init__(self, value, units=None, dtype=float):
+        """
+        Initialize.
+
+        The units may be given as a string such as 'ft', in which case the
+        values are converted to base units, or as a list of unit exponents.
+
+        """
+        value = numpy.asarray(value, dtype=dtype)
+        if units is None:
+            units = ucal.unitless
+        elif isinstance(units, str):
+            unit_value = ucal.calculate(units)
+            value = value * self.coerce(unit_value.value, value.dtype)
+            units = unit_value.units
+        if type(units) is not ucal.Dimension:
+            units = ucal.Dimension(units)
+        self.value = value
+        self.units = units
+
+    @staticmethod
+    def coerce(number, dtype):
+        """Return the given Decimal converted for use in an array."""
+        if dtype == object:
+            return number
+        return float(number)
+
+    def as_other(self, other):
+        """Return other as a QuantityArray or None if not supported."""
+        if isinstance(other, QuantityArray):
+            return other
+        if isinstance(other, ucal.Quantity):
+            return self.new(self.coerce(other.value, self.value.dtype),
+                            units=other.units)
+        return None
+
+    def new(self, value, units=None):
+        """Return a QuantityArray of the given values keeping their type."""
+        return QuantityArray(value, units=units, dtype=None)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __getitem__(self, index):
+        value = self.value[index]
+        if isinstance(value, numpy.ndarray):
+            return self.new(value, units=self.units)
+        return ucal.Quantity(value=decimal.Decimal(str(value)),
+                             units=self.units)
+
+    def __repr__(self):
+        units = str(ucal.Quantity(value=1, units=self.units))[2:]
+        if units:
+            return 'QuantityArray(%s, %s)' % (self.value, units)
+        return 'QuantityArray(%s)' % self.value
+
+    def __add__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        if self.units is not other.units:
+            raise ucal.QuantityError('Inconsistent units', self, other)
+        return self.new(self.value + other.value, units=self.units)
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        if self.units is not other.units:
+            raise ucal.QuantityError('Inconsistent units', self, other)
+        return self.new(self.value - other.value, units=self.units)
+
+    def __rsub__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return other.__sub__(self)
+
+    def __mul__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return self.new(self.value * other.value,
+                        units=self.units * other.units)
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __truediv__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return self.new(self.value / other.value,
+                        units=self.units / other.units)
+
+    def __rtruediv__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return other.__truediv__(self)
+
+    def __neg__(self):
+        return self.new(-self.value, units=self.units)
+
+    def __pos__(self):
+        return self.new(+self.value, units=self.units)
+
+    def __mod__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        if self.units is not other.units:
+            raise ucal.QuantityError('Inconsistent units', self, other)
+        return self.new(numpy.fmod(self.value, other.value))
+
+    def __rmod__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return other.__mod__(self)
+
+    def __pow__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        if not other.is_unitless():
+            raise ucal.QuantityError('Inconsistent units',
+                                     'Values in the exponent must be '
+                                     'unitless.',
+                                     self)
+        if self.is_unitless():
+            units = self.units
+        else:
+            # every element must share the same units
+            exponent = numpy.unique(other.value)
+            if len(exponent) != 1:
+                raise ucal.QuantityError('Inconsistent units',
+                                         'Exponents of values with units '
+                                         'must be the same.',
+                                         self)
+            units = self.units ** exponent[0]
+        return self.new(self.value ** other.value, units=units)
+
+    def __rpow__(self, other):
+        other = self.as_other(other)
+        if other is None:
+            return NotImplemented
+        return other.__pow__(self)
+
+    def matches_units(self, other):
+        """Return True if this has the same units as the other value."""
+        return self.units is other.units
+
+    def is_unitless(self):
+        """Return True if the values are unitless."""
+        return self.units is ucal.unitless
+
+    def to(self, units):
+        """Return the values as a NumPy array in the given units."""
+        unit_value = ucal.calculate(units)
+        if not self.matches_units(unit_value):
+            raise ucal.QuantityError('Inconsistent units', self, unit_value)
+        return self.value / self.coerce(unit_value.value, self.value.dtype)
+
+    def check_unitless(self):
+        """Raise a QuantityError if the values are not unitless."""
+        if not self.is_unitless():
+            raise ucal.QuantityError('Inconsistent units', self)
+
+    def apply(self, function):
+        """Return the function applied to each value of an object array."""
+        return numpy.array([function(x) for x in self.value.flat],
+                           dtype=object).reshape(self.value.shape)
+
+    def factorial(self):
+        self.check_unitless()
+        if (numpy.any(self.value != numpy.floor(self.value)) or
+                numpy.any(self.value < 0)):
+            raise ucal.QuantityError('Invalid value', self)
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.factorial))
+        values = self.value.astype(float)
+        index = numpy.minimum(values, len(float_factorials) - 1).astype(int)
+        return self.new(numpy.where(values < len(float_factorials),
+                                    float_factorials[index], math.inf))
+
+    # functions match those of Quantity with the prefix "function_"
+    def function_sqrt(self):
+        if self.value.dtype == object:
+            value = self.apply(lambda x: x.sqrt())
+        else:
+            value = numpy.sqrt(self.value)
+        return self.new(value, units=self.units ** fractions.Fraction(1, 2))
+
+    def function_sin(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.sin))
+        return self.new(numpy.sin(self.value))
+
+    def function_cos(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.cos))
+        return self.new(numpy.cos(self.value))
+
+    def function_tan(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.tan))
+        return self.new(numpy.tan(self.value))
+
+    def check_unit_interval(self):
+        """Raise a QuantityError if any value is outside [-1, 1]."""
+        self.check_unitless()
+        if numpy.any(numpy.abs(self.value) > 1):
+            raise ucal.QuantityError('Invalid value', self)
+
+    def function_asin(self):
+        self.check_unit_interval()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.asin))
+        return self.new(numpy.arcsin(self.value))
+
+    def function_acos(self):
+        self.check_unit_interval()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.acos))
+        return self.new(numpy.arccos(self.value))
+
+    def function_atan(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.atan))
+        return self.new(numpy.arctan(self.value))
+
+    def function_exp(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(lambda x: x.exp()))
+        return self.new(numpy.exp(self.value))
+
+    def function_abs(self):
+        return self.new(numpy.abs(self.value), units=self.units)
+
+    def function_ln(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(lambda x: x.ln()))
+        return self.new(numpy.log(self.value))
+
+    def function_log(self):
+        return self.function_ln()
+
+    def function_log10(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(lambda x: x.log10()))
+        return self.new(numpy.log10(self.value))
+
+    def function_log2(self):
+        self.check_unitless()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.log2))
+        return self.new(numpy.log2(self.value))
+
+    def function_atan2(self, other):
+        other = self.as_other(other)
+        self.check_unitless()
+        other.check_unitless()
+        if self.value.dtype == object and other.value.dtype == object:
+            atan2 = numpy.frompyfunc(decimal_backend.atan2, 2, 1)
+            return self.new(atan2(self.value, other.value))
+        return self.new(numpy.arctan2(self.value.astype(float),
+                                      other.value.astype(float)))
+
+    def check_gamma_argument(self):
+        """Raise a QuantityError if gamma is not defined for the values."""
+        self.check_unitless()
+        if numpy.any((self.value <= 0) &
+                     (self.value == numpy.floor(self.value))):
+            raise ucal.QuantityError('Invalid value', self)
+
+    def function_gamma(self):
+        self.check_gamma_argument()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.gamma))
+        return self.new(float_gamma(self.value))
+
+    def function_lgamma(self):
+        self.check_gamma_argument()
+        if self.value.dtype == object:
+            return self.new(self.apply(decimal_backend.lgamma))
+        return self.new(float_lgamma(self.value))
@@ -0,0 +1,574 @@
+"""
+Numeric backends used by ucal.py to hold the value of a Quantity.
+
+Each backend wraps one number type and provides the operations a Quantity
+needs beyond basic arithmetic.  The following backends are available.
+
+* decimal: decimal.Decimal at the working precision (the default)
+* float: Python floats, which are fastest but hold ~15 significant digits
+* fraction: fractions.Fraction, which is exact for values such as 0.3048
+  and 1/12 and falls back to Decimal at the working precision for
+  irrational results such as sqrt(2)
+
+"""
+
+import decimal
+import fractions
+import math
+
+# factorials of integers up to this are calculated exactly and then rounded
+# to the working precision, and larger ones through the gamma function
+exact_factorial_limit = 2000
+
+# inexact results with more digits than this before the point are not held
+# as a Fraction, since making the integer would take too long
+fraction_digits_limit = 100000
+
+# Bernoulli numbers B(0), B(1), ... calculated so far
+bernoulli_numbers = [fractions.Fraction(1)]
+
+# constants at each precision they have been calculated at, such as
+# constants[('pi', 32)]
+constants = dict()
+
+
+def get_bernoulli_numbers(count):
+    """Return a list of at least the first count Bernoulli numbers."""
+    global bernoulli_numbers
+    numbers = bernoulli_numbers
+    if len(numbers) < count:
+        # extend a copy so that other threads never see a partial list
+        numbers = list(numbers)
+        while len(numbers) < count:
+            n = len(numbers)
+            total = 0
+            binomial = 1
+            for k, number in enumerate(numbers):
+                total += binomial * number
+                binomial = binomial * (n + 1 - k) // (k + 1)
+            numbers.append(-total / (n + 1))
+        bernoulli_numbers = numbers
+    return numbers
+
+
+def calculate_pi(digits):
+    """Return pi to the given number of digits."""
+    # sum the Chudnovsky series by binary splitting, where each term adds
+    # about 14 digits
+    c3_over_24 = 640320 ** 3 // 24
+
+    def split(a, b):
+        if b - a == 1:
+            if a == 0:
+                p = q = 1
+            else:
+                p = (6 * a - 5) * (2 * a - 1) * (6 * a - 1)
+                q = a * a * a * c3_over_24
+            t = p * (13591409 + 545140134 * a)
+            if a % 2:
+                t = -t
+            return p, q, t
+        middle = (a + b) // 2
+        p_a, q_a, t_a = split(a, middle)
+        p_b, q_b, t_b = split(middle, b)
+        return p_a * p_b, q_a * q_b, q_b * t_a + p_a * t_b
+
+    _, q, t = split(0, digits // 14 + 2)
+    with decimal.localcontext() as context:
+        context.prec = digits
+        return (426880 * decimal.Decimal(10005).sqrt() *
+                decimal.Decimal(q) / decimal.Decimal(t))
+
+
+def calculate_ln2(digits):
+    """Return ln(2) to the given number of digits."""
+    with decimal.localcontext() as context:
+        context.prec = digits
+        return decimal.Decimal(2).ln()
+
+
+# functions which calculate each constant to a given number of digits
+constant_functions = {'pi': calculate_pi, 'ln2': calculate_ln2}
+
+
+def get_constant(name):
+    """Return the named constant at the current precision."""
+    precision = decimal.getcontext().prec
+    key = (name, precision)
+    value = constants.get(key)
+    if value is None:
+        value = +constant_functions[name](precision + 5)
+        constants[key] = value
+    return value
+
+
+def integer_digits(x):
+    """Return the number of digits in the integer part of x."""
+    return max(x.adjusted() + 1, 0)
+
+
+def guarded_context(digits=10):
+    """
+    Return a context manager for a local context with guard digits.
+
+    The precision is increased by the given digits and the exponent range
+    is made as wide as possible.
+
+    """
+    context = decimal.getcontext().copy()
+    context.prec += digits
+    context.Emax = decimal.MAX_EMAX
+    context.Emin = decimal.MIN_EMIN
+    return decimal.localcontext(context)
+
+
+def reduce_angle(x):
+    """
+    Return (r, quadrant) where x = r + quadrant * pi / 2 and |r| <= pi / 4.
+
+    The quadrant is from 0 to 3.
+
+    """
+    half_pi = get_constant('pi') / 2
+    quadrant = (x / half_pi).to_integral_value()
+    if not quadrant:
+        return x, 0
+    return x - quadrant * half_pi, int(quadrant) % 4
+
+
+def sin_series(x):
+    """Return sin(x) summed by its Taylor series, for small x."""
+    x_squared = x * x
+    total = term = x
+    n = 1
+    while True:
+        term *= -x_squared / ((n + 1) * (n + 2))
+        n += 2
+        if total + term == total:
+            return total
+        total += term
+
+
+def cos_series(x):
+    """Return cos(x) summed by its Taylor series, for small x."""
+    x_squared = x * x
+    total = term = decimal.Decimal(1)
+    n = 0
+    while True:
+        term *= -x_squared / ((n + 1) * (n + 2))
+        n += 2
+        if total + term == total:
+            return total
+        total += term
+
+
+def decimal_atan(x):
+    """Return atan(x) at the current precision."""
+    if x < 0:
+        return -decimal_atan(-x)
+    if x > 1:
+        return get_constant('pi') / 2 - decimal_atan(1 / x)
+    # halve the angle with atan(x) = 2 atan(x / (1 + sqrt(1 + x^2))) until
+    # the series converges quickly
+    doublings = 0
+    while x > decimal.Decimal('0.1'):
+        x /= 1 + (1 + x * x).sqrt()
+        doublings += 1
+    x_squared = x * x
+    total = power = x
+    n = 1
+    while True:
+        power *= -x_squared
+        n += 2
+        term = power / n
+        if total + term == total:
+            break
+        total += term
+    return total * 2 ** doublings
+
+
+def decimal_atan2(y, x):
+    """Return atan2(y, x) at the current precision."""
+    if x > 0:
+        return decimal_atan(y / x)
+    if x < 0:
+        if y.is_signed():
+            return decimal_atan(y / x) - get_constant('pi')
+        return decimal_atan(y / x) + get_constant('pi')
+    if y > 0:
+        return get_constant('pi') / 2
+    if y < 0:
+        return -get_constant('pi') / 2
+    return y
+
+
+def decimal_log_gamma(x):
+    """
+    Return ln|gamma(x)| and the sign of gamma(x) for a Decimal x.
+
+    The value is calculated at the precision of the current context, which
+    the caller should set with enough guard digits.  The argument is first
+    shifted up using gamma(x + 1) = x gamma(x) until the Stirling series
+    converges quickly, and then the series is summed.
+
+    """
+    context = decimal.getcontext()
+    # below this the series would need too many terms
+    lower_limit = context.prec // 2 + 10
+    product = decimal.Decimal(1)
+    while x < lower_limit:
+        product *= x
+        x += 1
+    sign = 1 if product > 0 else -1
+    half = decimal.Decimal('0.5')
+    result = ((x - half) * x.ln() - x +
+              (2 * get_constant('pi')).ln() * half - abs(product).ln())
+    epsilon = decimal.Decimal(1).scaleb(
+        max(result.adjusted(), 0) - context.prec)
+    x_squared = x * x
+    power = x
+    count = 2
+    while True:
+        numbers = get_bernoulli_numbers(count + 1)
+        coefficient = numbers[count] / (count * (count - 1))
+        term = (decimal.Decimal(coefficient.numerator) /
+                (coefficient.denominator * power))
+        result += term
+        if abs(term) < epsilon:
+            break
+        power *= x_squared
+        count += 2
+    return result, sign
+
+
+class DecimalBackend:
+    """Numbers are held as decimal.Decimal using the current context."""
+
+    name = 'decimal'
+    number_type = decimal.Decimal
+    # if True, unit definitions are evaluated exactly in this backend
+    exact = False
+
+    def number(self, value):
+        """Return the given int or string as a number."""
+        return decimal.Decimal(value)
+
+    def from_decimal(self, value):
+        """Return the given Decimal as a number."""
+        return value
+
+    def to_decimal(self, value):
+        """Return the number as a Decimal."""
+        return value
+
+    def is_integral(self, value):
+        """Return True if the number is an integer."""
+        return value == value.to_integral_value()
+
+    def power(self, base, exponent):
+        return base ** exponent
+
+    def mod(self, x, y):
+        return x % y
+
+    def sqrt(self, value):
+        return value.sqrt()
+
+    def exp(self, value):
+        return value.exp()
+
+    def ln(self, value):
+        return value.ln()
+
+    def log10(self, value):
+        return value.log10()
+
+    def sin(self, value):
+        with guarded_context(10 + integer_digits(value)):
+            r, quadrant = reduce_angle(value)
+            if quadrant % 2:
+                result = cos_series(r)
+            else:
+                result = sin_series(r)
+            if quadrant >= 2:
+                result = -result
+        return +result
+
+    def cos(self, value):
+        with guarded_context(10 + integer_digits(value)):
+            r, quadrant = reduce_angle(value)
+            if quadrant % 2:
+                result = sin_series(r)
+            else:
+                result = cos_series(r)
+            if quadrant in (1, 2):
+                result = -result
+        return +result
+
+    def tan(self, value):
+        with guarded_context(10 + integer_digits(value)):
+            r, quadrant = reduce_angle(value)
+            if quadrant % 2:
+                result = -cos_series(r) / sin_series(r)
+            else:
+                result = sin_series(r) / cos_series(r)
+        return +result
+
+    def asin(self, value):
+        with guarded_context():
+            result = decimal_atan2(value, ((1 - value) * (1 + value)).sqrt())
+        return +result
+
+    def acos(self, value):
+        with guarded_context():
+            result = decimal_atan2(((1 - value) * (1 + value)).sqrt(), value)
+        return +result
+
+    def atan(self, value):
+        with guarded_context():
+            result = decimal_atan(value)
+        return +result
+
+    def atan2(self, y, x):
+        with guarded_context():
+            result = decimal_atan2(y, x)
+        return +result
+
+    def log2(self, value):
+        with guarded_context():
+            result = value.ln() / get_constant('ln2')
+        return +result
+
+    def factorial(self, value):
+        n = int(value)
+        if n <= exact_factorial_limit:
+            # math.factorial multiplies by binary splitting
+            return +decimal.Decimal(math.factorial(n))
+        return self.gamma(value + 1)
+
+    def gamma(self, value):
+        if self.is_integral(value) and value <= exact_factorial_limit:
+            return self.factorial(value - 1)
+        with guarded_context(10 + integer_digits(value)):
+            result, sign = decimal_log_gamma(value)
+            result = sign * result.exp()
+        # round to the working precision, which may overflow
+        return +result
+
+    def lgamma(self, value):
+        # so that lgamma(1) and lgamma(2) are exactly zero
+        if self.is_integral(value) and value <= exact_factorial_limit:
+            return self.factorial(value - 1).ln()
+        with guarded_context(10 + integer_digits(value)):
+            result, _ = decimal_log_gamma(value)
+        return +result
+
+
+class FloatBackend:
+    """Numbers are held as Python floats."""
+
+    name = 'float'
+    number_type = float
+    exact = False
+
+    def number(self, value):
+        """Return the given int or string as a number."""
+        return float(value)
+
+    def from_decimal(self, value):
+        """Return the given Decimal as a number."""
+        return float(value)
+
+    def to_decimal(self, value):
+        """Return the number as a Decimal."""
+        return decimal.Decimal(repr(value))
+
+    def is_integral(self, value):
+        """Return True if the number is an integer."""
+        return value.is_integer()
+
+    def power(self, base, exponent):
+        return math.pow(base, exponent)
+
+    def mod(self, x, y):
+        return math.fmod(x, y)
+
+    def sqrt(self, value):
+        return math.sqrt(value)
+
+    def exp(self, value):
+        return math.exp(value)
+
+    def ln(self, value):
+        return math.log(value)
+
+    def log10(self, value):
+        return math.log10(value)
+
+    def sin(self, value):
+        return math.sin(value)
+
+    def cos(self, value):
+        return math.cos(value)
+
+    def tan(self, value):
+        return math.tan(value)
+
+    def asin(self, value):
+        return math.asin(value)
+
+    def acos(self, value):
+        return math.acos(value)
+
+    def atan(self, value):
+        return math.atan(value)
+
+    def atan2(self, y, x):
+        return math.atan2(y, x)
+
+    def log2(self, value):
+        return math.log2(value)
+
+    def factorial(self, value):
+        # larger factorials overflow a float
+        if value > 170:
+            raise OverflowError('%s! is too large for a float' % value)
+        return float(math.factorial(int(value)))
+
+    def gamma(self, value):
+        return math.gamma(value)
+
+    def lgamma(self, value):
+        return math.lgamma(value)
+
+
+def integer_root(value, n):
+    """Return the n-th root of the integer value if it is exact, or None."""
+    if value < 0:
+        return None
+    if value < 2:
+        return value
+    # start above the root and descend with Newton's method
+    root = 1 << ((value.bit_length() + n - 1) // n)
+    while True:
+        next_root = ((n - 1) * root + value // root ** (n - 1)) // n
+        if next_root >= root:
+            break
+        root = next_root
+    if root ** n == value:
+        return root
+    return None
+
+
+class FractionBackend:
+    """Numbers are held exactly as fractions.Fraction."""
+
+    name = 'fraction'
+    number_type = fractions.Fraction
+    exact = True
+
+    def number(self, value):
+        """Return the given int or string as a number."""
+        return fractions.Fraction(value)
+
+    def from_decimal(self, value):
+        """Return the given Decimal as a number."""
+        return fractions.Fraction(value)
+
+    def to_decimal(self, value):
+        """Return the number as a Decimal at the current precision."""
+        return (decimal.Decimal(value.numerator) /
+                decimal.Decimal(value.denominator))
+
+    def is_integral(self, value):
+        """Return True if the number is an integer."""
+        return value.denominator == 1
+
+    def inexact(self, function, *values):
+        """
+        Return the function evaluated through Decimal as a Fraction.
+
+        Raise OverflowError if the result is too large to hold as one.
+
+        """
+        result = function(*[self.to_decimal(x) for x in values])
+        if not result.is_finite():
+            raise ValueError('%s cannot be held as a fraction' % result)
+        if result.adjusted() > fraction_digits_limit:
+            raise OverflowError('%s is too large to hold as a fraction'
+                                % result)
+        return fractions.Fraction(result)
+
+    def power(self, base, exponent):
+        if exponent.denominator == 1:
+            return base ** exponent.numerator
+        # roots of exact powers such as (9/4)^(1/2) are exact
+        numerator = integer_root(base.numerator, exponent.denominator)
+        denominator = integer_root(base.denominator, exponent.denominator)
+        if numerator is not None and denominator is not None:
+            return fractions.Fraction(numerator,
+                                      denominator) ** exponent.numerator
+        return self.inexact(lambda x, y: x ** y, base, exponent)
+
+    def mod(self, x, y):
+        # truncate the quotient to match the sign convention of Decimal
+        return x - y * int(x / y)
+
+    def sqrt(self, value):
+        return self.power(value, fractions.Fraction(1, 2))
+
+    def exp(self, value):
+        if value == 0:
+            return fractions.Fraction(1)
+        return self.inexact(decimal.Decimal.exp, value)
+
+    def ln(self, value):
+        return self.inexact(decimal.Decimal.ln, value)
+
+    def log10(self, value):
+        return self.inexact(decimal.Decimal.log10, value)
+
+    def sin(self, value):
+        return self.inexact(backends['decimal'].sin, value)
+
+    def cos(self, value):
+        return self.inexact(backends['decimal'].cos, value)
+
+    def tan(self, value):
+        return self.inexact(backends['decimal'].tan, value)
+
+    def asin(self, value):
+        return self.inexact(backends['decimal'].asin, value)
+
+    def acos(self, value):
+        return self.inexact(backends['decimal'].acos, value)
+
+    def atan(self, value):
+        return self.inexact(backends['decimal'].atan, value)
+
+    def atan2(self, y, x):
+        return self.inexact(backends['decimal'].atan2, y, x)
+
+    def log2(self, value):
+        return self.inexact(backends['decimal'].log2, value)
+
+    def factorial(self, value):
+        if value <= exact_factorial_limit:
+            return fractions.Fraction(math.factorial(int(value)))
+        return self.inexact(backends['decimal'].factorial, value)
+
+    def gamma(self, value):
+        if value.denominator == 1 and value <= exact_factorial_limit:
+            return self.factorial(value - 1)
+        return self.inexact(backends['decimal'].gamma, value)
+
+    def lgamma(self, value):
+        return self.inexact(backends['decimal'].lgamma, value)
+
+
+# available backends by name
+backends = dict((x.name, x)
+                for x in (DecimalBackend(), FloatBackend(), FractionBackend()))
+
+# map a number type to its backend
+backend_of_type = dict((x.number_type, x) for x in backends.values())
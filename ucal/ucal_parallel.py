@@ -0,0 +1,148 @@
+"""
+The ucal_parallel module evaluates batches of expressions in a process pool.
+
+Expressions are split into chunks which are evaluated by worker processes
+with Session.evaluate_many().  Each worker starts from the unit table
+already resolved in this process, so units are not resolved or verified
+again in every worker.
+
+Usage:
+
+>>> from ucal.ucal_parallel import EvaluationPool
+>>> with EvaluationPool(workers=4) as pool:
+...     for result in pool.evaluate_many(['1 ft in in', '1 mi in ft']):
+...         print(result.text)
+12 in
+5280 ft
+
+"""
+
+import collections
+import itertools
+import multiprocessing
+import queue
+
+from ucal import ucal
+
+
+def init_worker(table):
+    """Set the unit table of a new worker process."""
+    ucal.set_unit_table(table)
+
+
+def evaluate_chunk(expressions, units, settings, variables, cache_size):
+    """Return the list of results of evaluate_many() in a worker."""
+    session = ucal.Session(*settings)
+    session.variables.update(variables)
+    return list(session.evaluate_many(expressions, units,
+                                      cache_size=cache_size))
+
+
+def split_chunks(iterable, chunk_size):
+    """Yield lists of up to chunk_size items from the iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class EvaluationPool:
+    """
+    An EvaluationPool is a pool of processes used to evaluate expressions.
+
+    The pool is created once and may be used for any number of batches.
+    It takes the unit definitions of this process when it is created, and
+    evaluates expressions with the precision, backend and variables of the
+    given session, or of ucal.default_session.
+
+    """
+
+    def __init__(self, workers=None, session=None):
+        """Initialize."""
+        # number of worker processes, or None for one per CPU
+        self.workers = workers or multiprocessing.cpu_count()
+        self.session = session or ucal.default_session
+        table = ucal.get_unit_table(list(ucal.unit_def))
+        self.pool = multiprocessing.Pool(self.workers,
+                                         initializer=init_worker,
+                                         initargs=(table,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes."""
+        self.pool.terminate()
+        self.pool.join()
+
+    def evaluate_many(self, expressions, units=None, chunk_size=1000,
+                      ordered=True, cache_size=4096):
+        """
+        Yield an EvaluationResult for each of the expressions.
+
+        The expressions are sent to the workers in chunks of chunk_size.
+        If ordered is True, results are yielded in the order of the
+        expressions, else each chunk is yielded as soon as it is done.  At
+        most two chunks per worker are read ahead of the results used, so
+        memory stays flat for any number of expressions.
+
+        """
+        session = self.session
+        settings = (session.working_precision_digits or
+                    ucal.working_precision_digits,
+                    session.output_precision_digits or
+                    ucal.output_precision_digits,
+                    ucal.get_backend(session.backend).name)
+        arguments = (units, settings, dict(session.variables), cache_size)
+        window = 2 * self.workers
+        # chunks sent to the workers, in order
+        pending = collections.deque()
+        # chunks done by the workers, when not ordered
+        done = queue.Queue()
+        outstanding = 0
+        for chunk in split_chunks(expressions, chunk_size):
+            if ordered:
+                pending.append(self.pool.apply_async(
+                    evaluate_chunk, (chunk,) + arguments))
+                if len(pending) >= window:
+                    yield from pending.popleft().get()
+            else:
+                self.pool.apply_async(evaluate_chunk, (chunk,) + arguments,
+                                      callback=done.put,
+                                      error_callback=done.put)
+                outstanding += 1
+                if outstanding >= window:
+                    yield from self.get_done(done)
+                    outstanding -= 1
+        while pending:
+            yield from pending.popleft().get()
+        while outstanding:
+            yield from self.get_done(done)
+            outstanding -= 1
+
+    @staticmethod
+    def get_done(done):
+        """Return the next list of results from the queue of done chunks."""
+        results = done.get()
+        if isinstance(results, BaseException):
+            raise results
+        return results
+
+
+def evaluate_many(expressions, units=None, workers=None, chunk_size=1000,
+                  ordered=True, session=None):
+    """
+    Yield an EvaluationResult for each expression, using a process pool.
+
+    A pool is created for this call.  Use an EvaluationPool directly to
+    evaluate several batches with the same worker processes.
+
+    """
+    with EvaluationPool(workers, session) as pool:
+        yield from pool.evaluate_many(expressions, units, chunk_size,
+                                      ordered)
@@ -0,0 +1,115 @@
+"""
+Trace events which describe how ucal evaluates an expression.
+
+Tracing is off until a sink is set with ucal.ucal.set_trace_sink().  A sink
+is any callable which takes a TraceEvent, such as one of the sinks below,
+and may be called from any thread.  While no sink is set, ucal makes one
+check per call of the functions which would send events.
+
+The kinds of event and their fields are the following.
+
+* token-emitted: index, type and text of each token of an equation
+* implicit-multiply-inserted: index of a "*" token which was not written
+* evaluation-started: number of tokens being evaluated
+* unit-resolved: unit, its definition and its value in base units
+* unit-ambiguous: name which may be read as more than one unit with a
+  prefix, and the definitions it may have
+* output-formatted: units the result was written in, and how they were
+  found ('target', 'derived', 'natural' or 'base')
+* unit-cache-failed: path of the unit cache and the operation which failed
+
+Usage:
+>>> from ucal import ucal, ucal_trace
+>>> sink = ucal_trace.RingBufferSink()
+>>> ucal.set_trace_sink(sink)
+>>> ucal.interpret('2 ft')
+'609.6 mm'
+>>> ucal.set_trace_sink(None)
+>>> sink.events[-1].kind
+'output-formatted'
+
+"""
+
+import collections
+import json
+import logging
+import threading
+
+# a trace event, where time is from time.time(), thread is the identifier
+# of the thread which sent it and fields is a dict of its fields
+TraceEvent = collections.namedtuple('TraceEvent',
+                                    ['kind', 'time', 'thread', 'fields'])
+
+
+def event_as_dict(event):
+    """Return the event as a dict, with its fields at the top level."""
+    result = {'event': event.kind, 'time': event.time,
+              'thread': event.thread}
+    result.update(event.fields)
+    return result
+
+
+class LoggingSink:
+    """A LoggingSink sends each event to a logger."""
+
+    def __init__(self, logger='ucal', level=logging.DEBUG):
+        """Initialize."""
+        if isinstance(logger, str):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, '%s %s', event.kind,
+                            json.dumps(event.fields, default=str))
+
+
+class RingBufferSink:
+    """A RingBufferSink keeps the most recent events in memory."""
+
+    def __init__(self, size=10000):
+        """Initialize."""
+        self.events = collections.deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(list(self.events))
+
+    def clear(self):
+        """Remove all events."""
+        self.events.clear()
+
+
+class JsonLinesSink:
+    """
+    A JsonLinesSink writes each event as a line of JSON.
+
+    Lines are written whole, so events from separate threads are never
+    interleaved within a line.
+
+    """
+
+    def __init__(self, file):
+        """Initialize with a path or a file object opened for text."""
+        self.owned = isinstance(file, str)
+        if self.owned:
+            file = open(file, 'a', encoding='utf-8')
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event_as_dict(event), default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        """Close the file if it was opened by this sink."""
+        if self.owned:
+            self.file.close()
@@ -4,11 +4,6 @@
 units = dict()
 
 # length
-units['mm'] = '1e-3 m'
-units['km'] = '1e3 m'
-units['cm'] = '1e-2 m'
-units['um'] = '1e-6 m'
-units['nm'] = '1e-9 m'
 units['ft'] = '0.3048 m'
 units['feet'] = 'ft'
 units['in'] = '1 / 12 ft'
@@ -41,7 +36,6 @@ units['quart'] = '2 pint'
 units['gallon'] = 'gal'
 units['gal'] = '231 in^3'
 units['L'] = '1e-3 m^3'
-units['mL'] = '1e-3 L'
 
 # mass
 units['lb'] = '0.45359237 kg'
@@ -53,41 +47,28 @@ units['ton'] = '2000 lb'
 
 # force
 units['N'] = '1 kg * m / s^2'
-units['kN'] = '1e3 N'
 units['lbf'] = 'lb * g'
 
 # energy
 units['J'] = '1 N * m'
-units['mJ'] = '1e-3 J'
-units['kJ'] = '1e3 J'
-units['MJ'] = '1e6 J'
-units['GJ'] = '1e9 J'
 units['Btu'] = '1055.06 J'
 units['btu'] = 'Btu'
 units['BTU'] = 'Btu'
-units['kWh'] = 'kW * hr'
+units['Wh'] = 'W * hr'
 units['kWhr'] = 'kWh'
 
 # current over time
-units['mAh'] = 'mA*hr'
-units['mAhr'] = 'mAh'
 units['Ah'] = 'A*hr'
+units['mAhr'] = 'mAh'
 units['Ahr'] = 'Ah'
 
 # power
 units['W'] = '1 J / s'
-units['mW'] = '1e-3 W'
-units['kW'] = '1e3 W'
-units['MW'] = '1e6 W'
-units['GW'] = '1e9 W'
 # metric horsepower
 units['hp'] = '75 kg * g * 1m / (1s)'
 
 # pressure
 units['Pa'] = 'N / m^2'
-units['kPa'] = '1e3 Pa'
-units['MPa'] = '1e6 Pa'
-units['GPa'] = '1e9 Pa'
 units['psi'] = 'lbf / in^2'
 units['ksi'] = '1e3 psi'
 units['atm'] = '101325 Pa'
@@ -95,62 +76,33 @@ units['cmHg'] = '10 mmHg'
 units['mmHg'] = '133.322387415 Pa'
 units['Torr'] = '1 / 760 atm'
 units['bar'] = '100 kPa'
-units['mbar'] = '0.001 bar'
 
 # charge
 units['C'] = 'A * s'
 
 # electrical storage
 units['F'] = 'C / V'
-units['mF'] = '1e-3 F'
-units['uF'] = '1e-6 F'
-units['nF'] = '1e-9 F'
-units['pF'] = '1e-12 F'
 
 # electrical resistance
 units['Ohm'] = 'V / A'
-units['uOhm'] = '1e-6 Ohm'
-units['mOhm'] = '1e-3 Ohm'
-units['kOhm'] = '1e3 Ohm'
-units['MOhm'] = '1e6 Ohm'
 
 # electrical inductance
 units['H'] = 'Ohm * s'
-units['mH'] = '1e-3 H'
-units['uH'] = '1e-6 H'
-units['nH'] = '1e-9 H'
 
 # current
-units['mA'] = '1e-3 A'
-units['uA'] = '1e-6 A'
-units['nA'] = '1e-9 A'
-units['pA'] = '1e-12 A'
 
 # voltage
 units['V'] = 'W / A'
-units['kV'] = '1e3 V'
-units['MV'] = '1e6 V'
-units['mV'] = '1e-3 V'
-units['uV'] = '1e-6 V'
-units['nV'] = '1e-9 V'
-units['pV'] = '1e-12 V'
 
 # density
 units['pcf'] = 'lb / ft^3'
 
 # frequency
 units['Hz'] = '1 / s'
-units['kHz'] = '1e3 Hz'
-units['MHz'] = '1e6 Hz'
-units['GHz'] = '1e9 Hz'
 
 # time
 units['sec'] = 's'
 units['seconds'] = 's'
-units['ms'] = '1e-3 s'
-units['us'] = '1e-6 s'
-units['ns'] = '1e-9 s'
-units['ps'] = '1e-12 s'
 units['min'] = '60 s'
 units['mins'] = 'min'
 units['minutes'] = 'min'
@@ -169,29 +121,14 @@ units['month'] = '(1 year) / 12'
 units['months'] = 'month'
 
 # data
+units['B'] = 'byte'
 units['bytes'] = 'byte'
 units['bit'] = '(1 / 8) byte'
 units['bits'] = 'bit'
-units['kB'] = '1e3 byte'
-units['MB'] = '1e6 byte'
-units['GB'] = '1e9 byte'
-units['TB'] = '1e12 byte'
-units['kbit'] = '1e3 bit'
-units['Mbit'] = '1e6 bit'
-units['Gbit'] = '1e9 bit'
-units['Tbit'] = '1e12 bit'
 
 # data rate
 units['bps'] = 'bit / s'
-units['kbps'] = 'kbit / s'
-units['Mbps'] = 'Mbit / s'
-units['Gbps'] = 'Gbit / s'
-units['Tbps'] = 'Tbit / s'
 units['Bps'] = 'byte / s'
-units['kBps'] = 'kB / s'
-units['MBps'] = 'MB / s'
-units['GBps'] = 'GB / s'
-units['TBps'] = 'TB / s'
 
 # angular units
 units['deg'] = 'pi / 180'
@@ -206,3 +143,57 @@ units['c'] = '299792458 m/s'
 units['g'] = '9.80665 m/s^2'
 units['pi'] = '3.141592653589793238462643383279502884197169399375105820974'
 units['e'] = '2.7182818284590452353602874713526624977572470936999595749669'
+
+# SI prefixes, and their powers of ten
+si_prefixes = {'y': -24, 'z': -21, 'a': -18, 'f': -15, 'p': -12, 'n': -9,
+               'u': -6, 'm': -3, 'c': -2, 'd': -1, 'da': 1, 'h': 2, 'k': 3,
+               'M': 6, 'G': 9, 'T': 12, 'P': 15, 'E': 18, 'Z': 21, 'Y': 24}
+si_prefix_names = {'yocto': -24, 'zepto': -21, 'atto': -18, 'femto': -15,
+                   'pico': -12, 'nano': -9, 'micro': -6, 'milli': -3,
+                   'centi': -2, 'deci': -1, 'deca': 1, 'hecto': 2,
+                   'kilo': 3, 'mega': 6, 'giga': 9, 'tera': 12, 'peta': 15,
+                   'exa': 18, 'zetta': 21, 'yotta': 24}
+
+# binary prefixes, and their powers of 1024
+binary_prefixes = {'Ki': 1, 'Mi': 2, 'Gi': 3, 'Ti': 4, 'Pi': 5, 'Ei': 6,
+                   'Zi': 7, 'Yi': 8}
+binary_prefix_names = {'kibi': 1, 'mebi': 2, 'gibi': 3, 'tebi': 4,
+                       'pebi': 5, 'exbi': 6, 'zebi': 7, 'yobi': 8}
+
+# units which may be written with an SI prefix, such as "km" or "GPa"
+si_prefixed_units = ['m', 's', 'A', 'N', 'J', 'Wh', 'Ah', 'W', 'Pa', 'bar',
+                     'F', 'Ohm', 'H', 'V', 'Hz', 'L', 'B', 'bit', 'bps',
+                     'Bps']
+
+# units which may be written with an SI prefix name, such as "kilobyte"
+si_named_units = ['byte', 'bytes', 'bit', 'bits']
+
+# units which may be written with a binary prefix, such as "KiB" or "Mibps"
+binary_prefixed_units = ['B', 'bit', 'bps', 'Bps']
+
+# units which may be written with a binary prefix name, such as "mebibyte"
+binary_named_units = ['byte', 'bytes', 'bit', 'bits']
+
+# prefixes each unit is listed with by list_units(), although any prefix
+# above may be used in an expression or to write a result
+listed_prefixes = {
+    'm': ['n', 'u', 'm', 'c', 'k'],
+    's': ['p', 'n', 'u', 'm'],
+    'A': ['p', 'n', 'u', 'm'],
+    'N': ['k'],
+    'J': ['m', 'k', 'M', 'G'],
+    'Wh': ['k'],
+    'Ah': ['m'],
+    'W': ['m', 'k', 'M', 'G'],
+    'Pa': ['k', 'M', 'G'],
+    'bar': ['m'],
+    'F': ['p', 'n', 'u', 'm'],
+    'Ohm': ['u', 'm', 'k', 'M'],
+    'H': ['n', 'u', 'm'],
+    'V': ['p', 'n', 'u', 'm', 'k', 'M'],
+    'Hz': ['k', 'M', 'G'],
+    'L': ['m'],
+    'B': ['k', 'M', 'G', 'T'],
+    'bit': ['k', 'M', 'G', 'T'],
+    'bps': ['k', 'M', 'G', 'T'],
+    'Bps': ['k', 'M', 'G', 'T']}